@@ -0,0 +1,26 @@
+#!/usr/bin/python3
+
+"""
+  default on_heartbeat handler for bandwidth_shared : logs how much was
+  transferred by the instance, and how long it waited for bandwidth shared
+  with the other instances and processes of the host.
+
+"""
+
+class Hb_Bandwidth(object): 
+
+    def __init__(self,parent):
+        parent.logger.debug( "hb_bandwidth initialized" )
+          
+    def perform(self,parent):
+
+        if not hasattr(parent,'bandwidth') or parent.bandwidth == None :
+           return True
+
+        parent.bandwidth.log_stats()
+
+        return True
+
+hb_bandwidth = Hb_Bandwidth(self)
+
+self.on_heartbeat = hb_bandwidth.perform
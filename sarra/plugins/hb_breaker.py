@@ -0,0 +1,25 @@
+#!/usr/bin/python3
+
+"""
+  default on_heartbeat handler reporting the circuit breakers not closed :
+  remote hosts where transfers are not attempted (open), or being probed (half-open).
+
+"""
+
+class Hb_Breaker(object): 
+
+    def __init__(self,parent):
+        parent.logger.debug( "hb_breaker initialized" )
+          
+    def perform(self,parent):
+
+        if not hasattr(parent,'breaker') or parent.breaker == None :
+           return True
+
+        parent.breaker.log_state()
+
+        return True
+
+hb_breaker = Hb_Breaker(self)
+
+self.on_heartbeat = hb_breaker.perform
@@ -4,13 +4,30 @@
   default on_heartbeat handler to clean the cache.
   by invoking parent.cache.save() it will only write out the values that are still relevant.
 
+  also reports the cache hits (duplicates), misses (new entries) and evictions
+  (entries dropped to stay within cache_max_entries/cache_max_bytes) since the last heartbeat.
+
 """
 
 class Hb_Cache(object): 
 
     def __init__(self,parent):
-        self.last_time  = time.time()
-        self.last_count = 0
+        self.last_time      = time.time()
+        self.last_count     = 0
+        self.last_hits      = 0
+        self.last_misses    = 0
+        self.last_evictions = 0
+
+    def stats(self,cache):
+        hits      = cache.hits      - self.last_hits
+        misses    = cache.misses    - self.last_misses
+        evictions = cache.evictions - self.last_evictions
+
+        self.last_hits      = cache.hits
+        self.last_misses    = cache.misses
+        self.last_evictions = cache.evictions
+
+        return "hits %d misses %d evictions %d (%d bytes)" % (hits, misses, evictions, cache.bytes)
           
     def perform(self,parent):
         self.logger     = parent.logger
@@ -26,8 +43,8 @@ class Hb_Cache(object):
            now       = time.time()
            new_count = parent.cache.count
 
-           self.logger.info("hb_cache was %d, but since %5.2f sec, increased up to %d, now saved %d entries" % 
-                           ( self.last_count, now-self.last_time, count, new_count))
+           self.logger.info("hb_cache was %d, but since %5.2f sec, increased up to %d, now saved %d entries, %s" % 
+                           ( self.last_count, now-self.last_time, count, new_count, self.stats(parent.cache)))
 
            self.last_time  = now
            self.last_count = new_count
@@ -35,7 +52,7 @@ class Hb_Cache(object):
         else :
 
            parent.cache.save()
-           self.logger.info("hb_cache saved (%d)" % len(parent.cache.cache_dict))
+           self.logger.info("hb_cache saved (%d) %s" % (parent.cache.count, self.stats(parent.cache)))
 
         return True
 
@@ -0,0 +1,26 @@
+#!/usr/bin/python3
+
+"""
+  default on_heartbeat handler for download_threads : logs how many downloads
+  were done by the threads, how busy they were, and how long the instance waited
+  for a thread to be free.
+
+"""
+
+class Hb_Download(object): 
+
+    def __init__(self,parent):
+        parent.logger.debug( "hb_download initialized" )
+          
+    def perform(self,parent):
+
+        if not hasattr(parent,'download_pool') or parent.download_pool == None :
+           return True
+
+        parent.download_pool.log_stats()
+
+        return True
+
+hb_download = Hb_Download(self)
+
+self.on_heartbeat = hb_download.perform
@@ -0,0 +1,27 @@
+#!/usr/bin/python3
+
+"""
+  default on_heartbeat handler for http downloads : closes the kept-alive
+  connections idle for more than http_keepalive, and logs how many connections
+  were created, reused and how many tls sessions were resumed.
+
+"""
+
+class Hb_Http(object): 
+
+    def __init__(self,parent):
+        parent.logger.debug( "hb_http initialized" )
+          
+    def perform(self,parent):
+
+        if not hasattr(parent,'http_pool') or parent.http_pool == None :
+           return True
+
+        parent.http_pool.clean()
+        parent.http_pool.log_stats()
+
+        return True
+
+hb_http = Hb_Http(self)
+
+self.on_heartbeat = hb_http.perform
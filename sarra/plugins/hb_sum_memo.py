@@ -0,0 +1,40 @@
+#!/usr/bin/python3
+
+"""
+  default on_heartbeat handler for sum_memo : saves the memo of the checksums
+  (dropping the files that vanished, a few thousand entries checked at each
+  heartbeat) and reports the files whose checksum came
+  from the memo (hits), the ones that were read (misses) and the entries evicted
+  to stay within sum_memo_max_entries since the last heartbeat.
+
+"""
+
+class Hb_Sum_Memo(object): 
+
+    def __init__(self,parent):
+        parent.logger.debug( "hb_sum_memo initialized" )
+        self.last_hits      = 0
+        self.last_misses    = 0
+        self.last_evictions = 0
+          
+    def perform(self,parent):
+
+        if not hasattr(parent,'memo') or parent.memo == None :
+           return True
+
+        memo = parent.memo
+        memo.save()
+
+        parent.logger.info("hb_sum_memo %d entries, hits %d misses %d evictions %d" % \
+                          (len(memo.memo), memo.hits - self.last_hits, memo.misses - self.last_misses, \
+                           memo.evictions - self.last_evictions))
+
+        self.last_hits      = memo.hits
+        self.last_misses    = memo.misses
+        self.last_evictions = memo.evictions
+
+        return True
+
+hb_sum_memo = Hb_Sum_Memo(self)
+
+self.on_heartbeat = hb_sum_memo.perform
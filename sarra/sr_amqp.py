@@ -39,7 +39,7 @@ except: pass
 try   : import pika
 except: pass
 
-import logging, os, random, sys, time
+import collections, logging, os, random, select, sys, time
 
 try :    
          from sr_util            import *
@@ -257,6 +257,35 @@ class Consumer:
 
       self.exchange_type = 'topic'
 
+      # push mode : basic_consume fills a local buffer of deliveries
+
+      self.push          = False
+      self.consumer_tag  = None
+      self.deliveries    = collections.deque()
+
+      # ack batching : one basic_ack(multiple) for many messages
+
+      self.ack_batch     = 1
+      self.ack_interval  = 1.0
+      self.ack_pending   = 0
+      self.ack_last_tag  = None
+      self.ack_first     = 0
+      self.before_ack    = None
+
+      # adaptive prefetch : keep about prefetch_window seconds of work
+      # prefetched, within prefetch_min and prefetch_max 
+      # (push mode only : basic_qos does not limit basic_get. The queue
+      #  depth comes from a passive queue_declare at each adjustment.)
+
+      self.prefetch_min    = 0
+      self.prefetch_max    = 0
+      self.prefetch_window = 2.0
+      self.prefetch_check  = 10.0
+      self.avg_time        = None
+      self.queue_depth     = None
+      self.queue_name      = None
+      self.last_adjust     = time.time()
+
       self.hc.add_build(self.build)
 
       self.retry_msg = raw_message(self.logger)
@@ -265,9 +294,80 @@ class Consumer:
       if self.hc.use_pika :
          self.for_pika_msg = raw_message(self.logger)
 
+   def add_before_ack(self,func):
+       self.before_ack = func
+
+   def add_ack_batch(self,count,interval=1.0):
+       self.ack_batch    = count
+       self.ack_interval = interval
+
    def add_prefetch(self,prefetch):
        self.prefetch = prefetch
 
+   def add_prefetch_bounds(self,prefetch_min,prefetch_max):
+       self.prefetch_min = max(1,prefetch_min)
+       self.prefetch_max = max(self.prefetch_min,prefetch_max)
+       if self.prefetch < self.prefetch_min : self.prefetch = self.prefetch_min
+       if self.prefetch > self.prefetch_max : self.prefetch = self.prefetch_max
+
+   def adjust_prefetch(self):
+       """
+          adaptive prefetch : aim for prefetch_window seconds of work held locally.
+          fast consumers get a deep prefetch, slow ones do not hoard messages
+          that other instances could process.
+       """
+       self.last_adjust = time.time()
+       if self.avg_time == None : return
+
+       self.declare_depth()
+
+       desired = int(self.prefetch_window / max(self.avg_time,0.0001))
+
+       # no need to hold more than what is waiting in the queue
+
+       if self.queue_depth != None and self.queue_depth < desired :
+          desired = self.queue_depth
+
+       if desired < self.prefetch_min : desired = self.prefetch_min
+       if desired > self.prefetch_max : desired = self.prefetch_max
+
+       # avoid reissuing basic_qos for small variations
+
+       if abs(desired - self.prefetch) < max(1,self.prefetch/4) : return
+
+       self.logger.info("adaptive prefetch %d -> %d (avg %f sec/msg, queue depth %s)" % \
+                       (self.prefetch,desired,self.avg_time,self.queue_depth))
+
+       self.prefetch = desired
+       self.channel.basic_qos(0,self.prefetch,False)
+
+   def declare_depth(self):
+       # messages waiting in the queue (deliveries of basic_consume do not tell)
+
+       if self.queue_name == None : return
+
+       try :
+               if self.hc.use_pika :
+                  frame = self.channel.queue_declare(queue=self.queue_name, passive=True)
+                  self.queue_depth = frame.method.message_count
+               else :
+                  name, count, consumers = self.channel.queue_declare(self.queue_name, passive=True)
+                  self.queue_depth = count
+       except :
+               (stype, value, tb) = sys.exc_info()
+               self.logger.warning("sr_amqp/declare_depth Type: %s, Value: %s" % (stype, value))
+               self.queue_depth = None
+
+   def observe(self,elapse):
+       # moving average of the time spent on each message
+       if self.avg_time == None : self.avg_time = elapse
+       else                     : self.avg_time = 0.8 * self.avg_time + 0.2 * elapse
+
+       if time.time() - self.last_adjust >= self.prefetch_check : self.adjust_prefetch()
+
+   def add_push(self,push=True):
+       self.push = push
+
    def build(self):
        self.logger.debug("building consumer")
        self.channel = self.hc.new_channel()
@@ -275,19 +375,75 @@ class Consumer:
           prefetch_size = 0      # dont care
           a_global      = False  # only apply here
           self.channel.basic_qos(prefetch_size,self.prefetch,a_global)
+
+       # deliveries of a previous channel cannot be acked anymore
+       # the broker will redeliver them on the new channel
+
+       self.consumer_tag = None
+       self.deliveries.clear()
+       self.ack_pending  = 0
+       self.ack_last_tag = None
        
    def ack(self,msg):
-       self.logger.debug("--------------> ACK")
-       self.logger.debug("--------------> %s" % msg.delivery_tag )
-       self.channel.basic_ack(msg.delivery_tag)
+
+       if self.ack_batch <= 1 :
+          if self.before_ack and not self.before_ack() :
+             self.logger.error("sr_amqp/ack: message not acknowledged %s" % msg.delivery_tag )
+             return False
+          self.logger.debug("--------------> ACK")
+          self.logger.debug("--------------> %s" % msg.delivery_tag )
+          self.channel.basic_ack(msg.delivery_tag)
+          return True
+
+       # messages are acked in delivery order, so acking the last tag
+       # with multiple=True acknowledges all the pending ones
+
+       self.ack_last_tag = msg.delivery_tag
+       self.ack_pending += 1
+       if self.ack_pending == 1 : self.ack_first = time.time()
+
+       # never hold back a whole prefetch window : the broker would stop delivering
+
+       if self.ack_pending >= self.ack_batch                      or \
+          (self.prefetch > 0 and self.ack_pending >= self.prefetch) or \
+          time.time() - self.ack_first >= self.ack_interval :
+          return self.flush_acks()
+
+       return True
+
+   def flush_acks(self):
+
+       # whatever must be done before messages are acknowledged (ex.: confirm posted messages)
+       # if it fails, they stay pending : acknowledged when it succeeds, redelivered if we die
+
+       if self.before_ack and not self.before_ack() :
+          self.logger.error("sr_amqp/flush_acks: %d messages not acknowledged" % self.ack_pending )
+          return False
+
+       if self.ack_pending == 0 : return True
+
+       self.logger.debug("--------------> ACK multiple %d" % self.ack_pending )
+       self.logger.debug("--------------> %s" % self.ack_last_tag )
+
+       tag = self.ack_last_tag
+       self.ack_pending  = 0
+       self.ack_last_tag = None
+
+       self.channel.basic_ack(tag, True)
+
+       return True
 
    def consume(self,queuename):
 
        msg = None
 
+       self.queue_name = queuename
+
        if not self.hc.asleep :
               try :
-                      if self.hc.use_pika :
+                      if self.push :
+                           msg = self.pop_delivery(queuename)
+                      elif self.hc.use_pika :
                            #self.logger.debug("consume PIKA is used")
                            method_frame, properties, body = self.channel.basic_get(queuename)
                            if method_frame and properties and body :
@@ -307,10 +463,77 @@ class Consumer:
        else:
               time.sleep(5)
 
-       if msg != None : msg.isRetry = False
+       if msg != None : 
+          msg.isRetry = False
 
        return msg
 
+   # push mode : deliveries are received without a round trip per message
+
+   def on_amqplib_delivery(self,msg):
+       self.deliveries.append(msg)
+
+   def on_pika_delivery(self,channel,method_frame,properties,body):
+       self.deliveries.append( (method_frame,properties,body) )
+
+   def pop_delivery(self,queuename):
+
+       if self.consumer_tag == None : self.start_consume(queuename)
+
+       if len(self.deliveries) == 0 : self.wait(0)
+       if len(self.deliveries) == 0 : return None
+
+       delivery = self.deliveries.popleft()
+       if not self.hc.use_pika : return delivery
+
+       method_frame, properties, body = delivery
+       self.for_pika_msg.pika_to_amqplib(method_frame, properties, body )
+       return self.for_pika_msg
+
+   def start_consume(self,queuename):
+       self.logger.debug("starting push consume on queue %s" % queuename)
+       if self.hc.use_pika :
+          self.consumer_tag = self.channel.basic_consume(self.on_pika_delivery, queue=queuename, no_ack=False)
+       else:
+          self.consumer_tag = self.channel.basic_consume(queuename, no_ack=False, callback=self.on_amqplib_delivery)
+
+   def wait(self,timeout):
+       """
+          push mode : wait at most timeout seconds for deliveries to arrive.
+          returns as soon as there is something in the local buffer.
+       """
+
+       if len(self.deliveries) > 0 : return True
+
+       if not self.push or self.consumer_tag == None or self.hc.asleep :
+          time.sleep(timeout)
+          return False
+
+       try :
+               if self.hc.use_pika :
+                  self.hc.connection.process_data_events(timeout)
+               else :
+                  # frames already read by amqplib are not seen by select
+                  pending = len(self.channel.method_queue) > 0
+                  if not pending :
+                     sock = self.hc.connection.transport.sock
+                     pending = len(getattr(self.hc.connection.transport,'_read_buffer','')) > 0
+                     if not pending :
+                        readable,w,x = select.select([sock],[],[],timeout)
+                        pending = len(readable) > 0
+                  while pending :
+                     self.channel.wait()
+                     pending = len(self.channel.method_queue) > 0 or \
+                               len(getattr(self.hc.connection.transport,'_read_buffer','')) > 0
+       except :
+               (stype, value, tb) = sys.exc_info()
+               self.logger.error("sr_amqp/wait Type: %s, Value: %s" % (stype, value))
+               if self.hc.loop :
+                  self.hc.reconnect()
+                  self.logger.debug("wait resume ok")
+
+       return len(self.deliveries) > 0
+
 # ==========
 # Publisher
 # ==========
@@ -325,42 +548,175 @@ class Publisher:
        self.restore_exchange = None
        self.restore_queue    = None
 
+       # batch mode :
+       #
+       # pika    : the channel is in confirm mode (confirm_select). Messages are
+       #           published as they come, each with the next sequence number, and
+       #           kept in unconfirmed until the broker acks them (one ack may cover
+       #           all the messages up to its delivery tag : multiple). A nacked
+       #           message is published again. When batch messages are unconfirmed
+       #           (or after batch_interval), publish waits for their confirms.
+       # amqplib : AMQP 0-8 has no publisher confirms. messages are staged and
+       #           committed at once in a transaction (tx_select/tx_commit).
+       #
+       # messages not yet confirmed (or committed) are published again after a reconnect.
+
+       self.batch          = 1
+       self.batch_interval = 1.0
+       self.staged         = []
+       self.staged_first   = 0
+       self.unconfirmed    = collections.OrderedDict()
+       self.seq            = 0
+
+   def add_batch(self,count,interval=1.0):
+       self.batch          = count
+       self.batch_interval = interval
+
    def build(self):
        self.channel = self.hc.new_channel()
-       if self.hc.use_pika :  self.channel.confirm_delivery()
-       else:                  self.channel.tx_select()
+
+       if not self.hc.use_pika :
+          self.channel.tx_select()
+          return
+
+       if self.batch <= 1 :
+          self.channel.confirm_delivery()
+          return
+
+       # pika's blocking channel waits for the confirm of every message :
+       # asynchronous confirms are set on the channel it wraps.
+       # sequence numbers start again on a new channel.
+
+       self.staged = list(self.unconfirmed.values()) + self.staged
+       self.unconfirmed.clear()
+       self.seq = 0
+
+       self.channel._impl.confirm_delivery(self.on_confirm)
 
    def isAlive(self):
        if not hasattr(self,'channel') : return False
        alarm_set(self.iotime)
        try:
-               if self.hc.use_pika: self.channel.confirm_delivery()
-               else:                self.channel.tx_select()
+               if   not self.hc.use_pika : self.channel.tx_select()
+               elif self.batch <= 1      : self.channel.confirm_delivery()
+               else                      : self.hc.connection.process_data_events(0)
        except:
                alarm_cancel()
                return False
        alarm_cancel()
        return True
 
-   def publish(self,exchange_name,exchange_key,message,mheaders,mexp=0):
+   def basic_publish(self,exchange_name,exchange_key,message,mheaders,mexp=0):
+       if self.hc.use_pika :
+              #self.logger.debug("publish PIKA is used")
+              if mexp :
+                 expms = '%s' % mexp
+                 properties = pika.BasicProperties(content_type='text/plain', delivery_mode=1, headers=mheaders,expiration=expms)
+              else:
+                 properties = pika.BasicProperties(content_type='text/plain', delivery_mode=1, headers=mheaders)
+
+              # batch mode : not waiting for the confirm (see on_confirm)
+
+              channel = self.channel
+              if self.batch > 1 : channel = self.channel._impl
+              channel.basic_publish(exchange_name, exchange_key, message, properties, True )
+       else:
+              #self.logger.debug("publish AMQPLIB is used")
+              if mexp :
+                 expms = '%s' % mexp
+                 msg = amqp.Message(message, content_type= 'text/plain',application_headers=mheaders,expiration=expms)
+              else:
+                 msg = amqp.Message(message, content_type= 'text/plain',application_headers=mheaders)
+              self.channel.basic_publish(msg, exchange_name, exchange_key )
+
+   def flush(self,wait=True):
+       """
+          batch mode : publish the staged messages and, with wait, until they are
+          all confirmed (pika) or committed (amqplib). Messages are kept (and published
+          again after a reconnect) until then. Returns False if they could not be
+          published : the messages they come from must not be acknowledged.
+       """
+
+       if len(self.staged) + len(self.unconfirmed) == 0 : return True
+
        try :
-              if self.hc.use_pika :
-                     #self.logger.debug("publish PIKA is used")
-                     if mexp :
-                        expms = '%s' % mexp
-                        properties = pika.BasicProperties(content_type='text/plain', delivery_mode=1, headers=mheaders,expiration=expms)
-                     else:
-                        properties = pika.BasicProperties(content_type='text/plain', delivery_mode=1, headers=mheaders)
-                     self.channel.basic_publish(exchange_name, exchange_key, message, properties, True )
+              if self.hc.use_pika : self.flush_confirm(wait)
+              else                : self.flush_commit()
+              return True
+       except :
+              if self.hc.loop :
+                 (stype, value, tb) = sys.exc_info()
+                 self.logger.error("sr_amqp/flush: %s, Value: %s" % (stype, value))
+                 self.logger.error("Sleeping 5 seconds ... and reconnecting")
+                 time.sleep(5)
+                 self.hc.reconnect()
+                 if self.hc.asleep : return False
+                 return self.flush(wait)
               else:
-                     #self.logger.debug("publish AMQPLIB is used")
-                     if mexp :
-                        expms = '%s' % mexp
-                        msg = amqp.Message(message, content_type= 'text/plain',application_headers=mheaders,expiration=expms)
-                     else:
-                        msg = amqp.Message(message, content_type= 'text/plain',application_headers=mheaders)
-                     self.channel.basic_publish(msg, exchange_name, exchange_key )
-                     self.channel.tx_commit()
+                 (etype, evalue, tb) = sys.exc_info()
+                 self.logger.error("sr_amqp/flush 2 Type: %s, Value: %s" %  (etype, evalue))
+                 self.logger.error("could not publish batch of %d messages" % (len(self.staged)+len(self.unconfirmed)))
+                 return False
+
+   def flush_commit(self):
+       for exchange_name,exchange_key,message,mheaders,mexp in self.staged :
+           self.basic_publish(exchange_name,exchange_key,message,mheaders,mexp)
+       self.channel.tx_commit()
+       self.logger.debug("published batch of %d messages" % len(self.staged))
+       self.staged = []
+
+   def flush_confirm(self,wait):
+       deadline = time.time() + self.iotime
+
+       self.publish_staged()
+       self.hc.connection.process_data_events(0)
+
+       while wait and len(self.staged) + len(self.unconfirmed) > 0 :
+             if time.time() >= deadline :
+                raise Exception("%d messages not confirmed in %d seconds" % (len(self.unconfirmed),self.iotime))
+             self.hc.connection.process_data_events(min(1.0,deadline-time.time()))
+             self.publish_staged()
+
+   def on_confirm(self,frame):
+       """
+          broker ack or nack of the message with the delivery tag, or with multiple,
+          of all the messages up to it. The nacked ones are published again.
+       """
+
+       method = frame.method
+       tag    = method.delivery_tag
+       nack   = method.NAME == 'Basic.Nack'
+
+       if method.multiple :
+          seqs = []
+          for seq in self.unconfirmed :
+              if seq > tag : break
+              seqs.append(seq)
+       else :
+          seqs = [ tag ]
+
+       for seq in seqs :
+           entry = self.unconfirmed.pop(seq,None)
+           if entry == None or not nack : continue
+           self.logger.warning("sr_amqp/publish: nacked by broker, publishing again %s" % entry[2])
+           self.staged.append(entry)
+
+   def publish(self,exchange_name,exchange_key,message,mheaders,mexp=0):
+
+       # batch mode : stage a copy (headers are reused by the caller)
+       # pika sends it right away, flush waits when the confirm window is full
+
+       if self.batch > 1 :
+          if len(self.staged) + len(self.unconfirmed) == 0 : self.staged_first = time.time()
+          self.staged.append( (exchange_name,exchange_key,message,mheaders.copy(),mexp) )
+          full = len(self.staged) + len(self.unconfirmed) >= self.batch or \
+                 time.time() - self.staged_first >= self.batch_interval
+          if full or self.hc.use_pika : return self.flush(full)
+          return True
+
+       try :
+              self.basic_publish(exchange_name,exchange_key,message,mheaders,mexp)
+              if not self.hc.use_pika : self.channel.tx_commit()
               return True
        except :
               if self.hc.loop :
@@ -377,6 +733,39 @@ class Publisher:
                  self.logger.error("could not publish %s %s %s %s" % (exchange_name,exchange_key,message,mheaders))
                  return False
 
+   def publish_many(self,messages):
+       """
+          publish a list of (exchange_name,exchange_key,message,mheaders,mexp) in one burst.
+       """
+       for exchange_name,exchange_key,message,mheaders,mexp in messages :
+           if len(self.staged) + len(self.unconfirmed) == 0 : self.staged_first = time.time()
+           self.staged.append( (exchange_name,exchange_key,message,mheaders.copy(),mexp) )
+
+       # outside batch mode, the channel is in confirm mode (pika), so publish one by one
+
+       if self.batch <= 1 and self.hc.use_pika :
+          ok = True
+          staged = self.staged
+          self.staged = []
+          for exchange_name,exchange_key,message,mheaders,mexp in staged :
+              ok = self.publish(exchange_name,exchange_key,message,mheaders,mexp) and ok
+          return ok
+
+       return self.flush()
+
+   def publish_staged(self):
+       # pika batch mode : staged messages get their sequence numbers when published
+
+       sent = 0
+       try :
+              for entry in self.staged :
+                  self.basic_publish(*entry)
+                  self.seq += 1
+                  self.unconfirmed[self.seq] = entry
+                  sent += 1
+       finally :
+              self.staged = self.staged[sent:]
+
    def restore_clear(self):
        if self.restore_queue and self.restore_exchange :
           try   : self.channel.queue_unbind( self.restore_queue, self.restore_exchange, '#' )
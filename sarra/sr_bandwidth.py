@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+#
+# This file is part of sarracenia.
+# The sarracenia suite is Free and is proudly provided by the Government of Canada
+# Copyright (C) Her Majesty The Queen in Right of Canada, Environment Canada, 2008-2015
+#
+# Questions or bugs report: dps-client@ec.gc.ca
+# sarracenia repository: git://git.code.sf.net/p/metpx/git
+# Documentation: http://metpx.sourceforge.net/#SarraDocumentation
+#
+# sr_bandwidth.py : python3 bandwidth shared by the processes of a host
+#
+########################################################################
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307  USA
+#
+#
+#
+
+import fcntl,hashlib,mmap,os,struct,threading,time,urllib.parse
+
+#============================================================
+# sr_bandwidth : token buckets in a file mapped in memory by every
+#                process of the host (bandwidth_shared).
+#
+# bandwidth_file : default ~/.cache/sarra/bandwidth.shared
+#
+# buckets    : config   'program/config'  kbytes_ps      for all the instances
+#                                                        of the config together
+#              host     remote hostname   kbytes_ps_host for all the transfers
+#                                                        to/from that host, of
+#                                                        every config using it
+#
+# header     : magic, number of slots (header_size bytes)
+#
+# slots      : digest    16 bytes  blake2b of the bucket name
+#              tokens    8  bytes  bytes that can be transferred now
+#              last      8  bytes  time tokens were last added, 0.0 : free slot
+#              rate      8  bytes  bytes per second of the bucket
+#
+#              a bucket goes in the slot given by its digest, or the next ones.
+#              When the table is full, the least recently used bucket is reused.
+#
+# throttle   : tokens are added at rate since last (up to burst seconds of
+#              rate), the bytes of the chunk are taken out. Tokens may go
+#              under 0 : the process then sleeps until the bucket is back
+#              at 0, so the processes sharing a bucket never go over its
+#              rate together, and an idle process leaves its share to the
+#              busy ones.
+#
+# locking    : the whole table is locked (fcntl.lockf on byte 0) while a chunk
+#              is accounted for, and a thread lock for the download_threads
+#              of the process.
+#
+
+class sr_bandwidth():
+
+    magic            = b'SRBW0001'
+    header_size      = 4096
+    header_format    = '8sQ'
+    slot_format      = '16sddd'
+    slot_size        = struct.calcsize(slot_format)
+    slots            = 256
+    burst            = 1.0
+
+    def __init__(self, parent ):
+        parent.logger.debug("sr_bandwidth init")
+
+        self.parent         = parent
+        self.logger         = parent.logger
+
+        self.bytes_ps       = parent.kbytes_ps      * 1024
+        self.host_bytes_ps  = parent.kbytes_ps_host * 1024
+
+        self.config_bucket  = 'config %s/%s' % (parent.program_name, parent.config_name)
+        self.hosts          = {}
+
+        self.bandwidth_file = None
+        self.fp             = None
+        self.map            = None
+        self.tlock          = threading.Lock()
+
+        self.bytes          = 0
+        self.waited         = 0.0
+        self.started        = time.time()
+
+    def bucket(self, digest, now):
+        # offset of the slot of a bucket, the table is locked
+
+        first  = int.from_bytes(digest[:8],'little') % self.slots
+        oldest = self.header_size + first * self.slot_size
+        olast  = now
+
+        for i in range(self.slots) :
+            offset = self.header_size + ( (first + i) % self.slots ) * self.slot_size
+            d, tokens, last, rate = struct.unpack_from(self.slot_format, self.map, offset)
+
+            if d == digest or last == 0.0 : return offset
+            if last < olast : oldest, olast = offset, last
+
+        return oldest
+
+    def close(self):
+        self.logger.debug("sr_bandwidth close")
+
+        try   :
+                self.map.close()
+                self.fp.close()
+        except: pass
+        self.map = None
+        self.fp  = None
+
+    def host_bucket(self, destination):
+        # the bucket of the remote host of destination (an url string)
+
+        if not destination in self.hosts :
+           hostname = urllib.parse.urlparse(destination).hostname
+           self.hosts[destination] = None
+           if hostname : self.hosts[destination] = 'host %s' % hostname
+
+        return self.hosts[destination]
+
+    def load(self):
+        self.logger.debug("sr_bandwidth load")
+
+        if self.map != None : self.close()
+
+        self.fp = open(self.bandwidth_file,'a+b')
+
+        self.lock()
+        try :
+                self.fp.seek(0)
+                header = self.fp.read(struct.calcsize(self.header_format))
+
+                if len(header) == struct.calcsize(self.header_format) and header[:8] == self.magic :
+                   magic, self.slots = struct.unpack(self.header_format, header)
+                else :
+                   self.fp.truncate(0)
+                   self.fp.write(struct.pack(self.header_format, self.magic, self.slots))
+                   self.fp.truncate(self.header_size + self.slots * self.slot_size)
+                   self.fp.flush()
+
+                self.map = mmap.mmap(self.fp.fileno(), self.header_size + self.slots * self.slot_size)
+        finally :
+                self.unlock()
+
+    def lock(self):
+        fcntl.lockf(self.fp, fcntl.LOCK_EX, 1, 0)
+
+    def log_stats(self):
+
+        elapse = max(time.time() - self.started, 0.001)
+
+        self.logger.info("sr_bandwidth %d Kbytes transferred, %.1f Kbytes/s, %.1fs waiting for bandwidth" % \
+                        (self.bytes / 1024, self.bytes / 1024 / elapse, self.waited))
+
+    def open(self, bandwidth_file = None):
+
+        self.bandwidth_file = bandwidth_file
+
+        # user_cache_dir is ~/.cache/sarra/'pgm'/'cfg' : the file is for the whole host
+
+        if bandwidth_file == None :
+           cache_dir = os.path.dirname(os.path.dirname(self.parent.user_cache_dir))
+           os.makedirs(cache_dir, exist_ok=True)
+           self.bandwidth_file = cache_dir + os.sep + 'bandwidth.shared'
+
+        self.load()
+
+    def take(self, name, rate, nbytes, now):
+        # take nbytes out of the bucket name, returns the seconds to wait
+
+        digest = hashlib.blake2b( name.encode('utf-8'), digest_size=16 ).digest()
+        offset = self.bucket(digest, now)
+
+        d, tokens, last, r = struct.unpack_from(self.slot_format, self.map, offset)
+
+        if d != digest or last == 0.0 :
+           tokens = rate * self.burst
+        else :
+           tokens = min( rate * self.burst, tokens + rate * max(0.0, now - last) )
+
+        tokens -= nbytes
+
+        struct.pack_into(self.slot_format, self.map, offset, digest, tokens, now, rate)
+
+        if tokens >= 0 : return 0.0
+
+        return -tokens / rate
+
+    def throttle(self, destination, nbytes):
+
+        buckets = []
+
+        if self.bytes_ps > 0 :
+           buckets.append( (self.config_bucket, self.bytes_ps) )
+
+        if self.host_bytes_ps > 0 and destination :
+           name = self.host_bucket(destination)
+           if name : buckets.append( (name, self.host_bytes_ps) )
+
+        if not buckets : return
+
+        wait = 0.0
+
+        with self.tlock :
+             if self.map == None : self.open()
+
+             now = time.time()
+             self.lock()
+             try :
+                     for name,rate in buckets :
+                         wait = max( wait, self.take(name, rate, nbytes, now) )
+             finally :
+                     self.unlock()
+
+             self.bytes  += nbytes
+             self.waited += wait
+
+        if wait > 0 : time.sleep(wait)
+
+    def unlock(self):
+        fcntl.lockf(self.fp, fcntl.LOCK_UN, 1, 0)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+#
+# This file is part of sarracenia.
+# The sarracenia suite is Free and is proudly provided by the Government of Canada
+# Copyright (C) Her Majesty The Queen in Right of Canada, Environment Canada, 2008-2015
+#
+# Questions or bugs report: dps-client@ec.gc.ca
+# sarracenia repository: git://git.code.sf.net/p/metpx/git
+# Documentation: http://metpx.sourceforge.net/#SarraDocumentation
+#
+# sr_breaker.py : python3 per destination circuit breaker
+#
+########################################################################
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307  USA
+#
+#
+
+import threading,time,urllib.parse
+
+#============================================================
+# sr_breaker : one circuit breaker per remote host (scheme://netloc)
+#
+# closed     : transfers are attempted. after breaker_threshold failed
+#              attempts in a row, the breaker opens.
+# open       : no transfer attempted, messages go to retry.
+#              after breaker_timeout seconds, the breaker is half-open.
+# half-open  : one transfer is attempted (probe) : if it works the
+#              breaker closes, if not it opens again for breaker_timeout.
+#
+# hosts      : { key : [ state, failures, opened, skipped ] }
+#
+# downloads may run in threads (download_threads) : hosts is locked.
+#
+
+CLOSED    = 'closed'
+OPEN      = 'open'
+HALF_OPEN = 'half-open'
+
+class sr_breaker():
+
+    def __init__(self, parent ):
+        parent.logger.debug("sr_breaker init")
+
+        self.logger    = parent.logger
+
+        self.threshold = parent.breaker_threshold
+        self.timeout   = parent.breaker_timeout
+
+        self.hosts     = {}
+        self.lock      = threading.Lock()
+
+    def allow(self, key):
+        """
+           returns True if a transfer to key can be attempted
+        """
+
+        with self.lock :
+             if not key in self.hosts : return True
+
+             host = self.hosts[key]
+
+             if host[0] == CLOSED : return True
+
+             # open long enough : let one probe through
+
+             if host[0] == OPEN and time.time() - host[2] >= self.timeout :
+                self.logger.info("sr_breaker %s half-open, probing" % key)
+                host[0] = HALF_OPEN
+                return True
+
+             host[3] += 1
+
+             return False
+
+    def failure(self, key):
+
+        with self.lock :
+             if not key in self.hosts : self.hosts[key] = [ CLOSED, 0, 0.0, 0 ]
+
+             host     = self.hosts[key]
+             host[1] += 1
+
+             if host[0] == HALF_OPEN or ( host[0] == CLOSED and host[1] >= self.threshold ) :
+                self.logger.warning("sr_breaker %s open after %d failures, messages go to retry for %d sec" % \
+                                   (key, host[1], self.timeout))
+                host[0] = OPEN
+                host[2] = time.time()
+
+    def key(self, url):
+        # scheme://netloc of an url (string or parsed)
+
+        if type(url) == str : url = urllib.parse.urlparse(url)
+
+        return '%s://%s' % (url.scheme, url.netloc)
+
+    def log_state(self):
+
+        with self.lock : hosts = list(self.hosts.items())
+
+        for key,host in hosts :
+            if host[0] == CLOSED : continue
+            self.logger.info("sr_breaker %s %s since %d sec, %d failures, %d messages sent to retry" % \
+                            (key, host[0], time.time() - host[2], host[1], host[3]))
+
+    def success(self, key):
+
+        with self.lock :
+             if not key in self.hosts : return
+
+             if self.hosts[key][0] != CLOSED :
+                self.logger.info("sr_breaker %s closed" % key)
+
+             del self.hosts[key]
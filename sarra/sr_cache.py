@@ -31,18 +31,43 @@
 #
 #
 
-import os,sys,time
+import os,sys,threading,time
 
+from collections import OrderedDict
 
 #============================================================
 # sr_cache supports/uses :
 #
 # cache_file : default ~/.cache/sarra/'pgm'/'cfg'/recent_files_0001.cache
-#              each line in file is
+#              snapshot of the cache, each line in file is
 #              sum time path part
+#              written (atomically, in a thread) only when compacting
 #
-# cache_dict : {}  
-#              cache_dict[sum] = [ (time1,[path1,part1]),(time2,[path2,part2])...]
+# journal    : cache_file + '.journal'
+#              each check appends a line (same format), delete_path appends
+#              - time path -
+#              when the journal gets bigger than journal_ratio * snapshot
+#              (and than journal_min, so a small or empty snapshot is not
+#              rewritten at every heartbeat), it is renamed to cache_file + '.journal.old' and a new snapshot
+#              is written. Once done, the old journal is deleted.
+#              load : snapshot, old journal (if any), journal.
+#
+# expiry     : OrderedDict, oldest first, the only index of the cache
+#              expiry[(sum,path,part)] = time
+#              check looks up (sum,path,part) in it : one hash probe.
+#              an entry seen again is moved to the end, so expired entries
+#              are popped from the front without looking at the others.
+#              it is also the least recently seen order used to evict entries
+#              when the cache goes over max_entries or max_bytes.
+#              sum, path and part strings are interned : entries with the
+#              same path (or sum) share the same string objects.
+#
+# count      : number of entries, len(expiry)
+#
+# bytes      : approximate memory used by the cache : entry_size per entry
+#              (OrderedDict slot and link, key tuple, time, string objects and
+#              their interning : about 420 bytes measured with tracemalloc,
+#              see sr_cache_unit_test) plus the length of its strings.
 #
 
 class sr_cache():
@@ -55,45 +80,64 @@ class sr_cache():
 
         self.expire        = parent.caching
 
-        self.cache_dict    = {}
+        self.expiry        = OrderedDict()
         self.cache_file    = None
         self.fp            = None
 
+        self.journal_ratio = parent.cache_journal_ratio
+        self.journal_min   = 1024 * 1024
+        self.compaction    = None
+
+        self.max_entries   = parent.cache_max_entries
+        self.max_bytes     = parent.cache_max_bytes
+        self.entry_size    = 420
+        self.bytes         = 0
+
         self.last_expire   = time.time()
         self.count         = 0
 
+        self.hits          = 0
+        self.misses        = 0
+        self.evictions     = 0
+
+    def add(self, key, path, part, now):
+        # add a new entry in cache
+
+        self.expiry[(key,path,part)] = now
+        self.bytes += self.entry_size + len(key) + len(path) + len(part)
+
     def check(self, key, path, part):
         self.logger.debug("sr_cache check")
 
-        # set time and value
+        # set time and compact entry
         now   = time.time()
-        value = '%s*%s' % (path,part)
+        key   = sys.intern(key)
+        path  = sys.intern(path)
+        part  = sys.intern(str(part))
+
+        # key (sum) and value "path part" already there : update its time
+        # newest entries at the end of expiry
 
-        # new... add
-        if not key in self.cache_dict :
-           self.logger.debug("new")
-           kdict = {}
-           kdict[value] = now
-           self.cache_dict[key] = kdict
-           self.fp.write("%s %f %s %s\n"%(key,now,path,part))
-           self.count += 1
-           return True
+        entry   = (key,path,part)
+        present = entry in self.expiry
 
-        # key (sum) in cache ... 
-        # if value "path part" already there update its time
-        # if value "path part" not there add it 
-        # this ends up to be the same code
+        if present :
+           self.expiry.move_to_end(entry)
+           self.expiry[entry] = now
+           self.hits += 1
 
-        kdict   = self.cache_dict[key]
-        present = value in kdict
-        kdict[value] = now
+        # new or differ... add, making room if needed
 
-        if not present : self.logger.debug("differ")
+        else :
+           self.logger.debug("new or differ")
+           self.add(key,path,part,now)
+           self.misses += 1
+           self.evict()
 
-        # differ or newer, write to file
+        # write to file
 
         self.fp.write("%s %f %s %s\n"%(key,now,path,part))
-        self.count += 1
+        self.count = len(self.expiry)
         return not present
 
     def check_msg(self, msg):
@@ -108,107 +152,188 @@ class sr_cache():
 
         return self.check(sumstr,relpath,partstr)
 
-    def clean(self, fp = None, delpath = None):
+    def clean(self, delpath = None):
         self.logger.debug("sr_cache clean")
 
-        # create refreshed dict
-
-        now        = time.time()
-        new_dict   = {}
-        self.count = 0
-
-        # from  cache[sum] = [(time,[path,part]), ... ]
-        for key in self.cache_dict.keys() :
-            ndict = {}
-            kdict = self.cache_dict[key]
+        # pop expired entries from the old end of expiry
 
-            for value in kdict :
-                # expired or keep
-                t   = kdict[value]
-                ttl = now - t
-                if ttl > self.expire : continue
-
-                parts = value.split('*')
-                path  = parts[0]
-                part  = parts[1]
-
-                if path == delpath  : continue
+        now    = time.time()
+        expiry = self.expiry
 
-                ndict[value] = t
-                self.count  += 1
+        while len(expiry) > 0 :
+              entry, t = next(iter(expiry.items()))
+              if now - t <= self.expire : break
+              expiry.popitem(last=False)
+              self.remove(entry)
 
-                if fp : fp.write("%s %f %s %s\n"%(key,t,path,part))
+        # remove a path (not time ordered : visit every entry)
 
-            if len(ndict) > 0 : new_dict[key] = ndict
+        if delpath != None :
+           for entry in list(expiry.keys()) :
+               if entry[1] != delpath : continue
+               del expiry[entry]
+               self.remove(entry)
 
-        # set cleaned cache_dict
-        self.cache_dict = new_dict
+        self.count = len(expiry)
 
     def close(self, unlink=False):
         self.logger.debug("sr_cache close")
+
+        self.compacted()
+
         try   :
                 self.fp.flush()
                 self.fp.close()
         except: pass
         self.fp = None
 
-        if unlink : os.unlink(self.cache_file)
+        if unlink : 
+           os.unlink(self.cache_file)
+           for f in [ self.journal, self.journal_old ] :
+               try   : os.unlink(f)
+               except: pass
 
-        self.cache_dict = {}
+        self.expiry     = OrderedDict()
         self.count      = 0
+        self.bytes      = 0
+
+    def compact(self):
+        """
+           start writing a new snapshot from the entries in memory.
+           new entries go to a new journal meanwhile.
+        """
+        self.logger.debug("sr_cache compact")
+
+        self.fp.close()
+
+        # an old journal left by an interrupted compaction is kept (appended to)
+
+        if os.path.isfile(self.journal_old) :
+           with open(self.journal_old,'a') as old, open(self.journal,'r') as fp :
+                old.write(fp.read())
+           os.unlink(self.journal)
+        else :
+           os.rename(self.journal,self.journal_old)
+
+        self.fp = open(self.journal,'a')
+
+        entries = list(self.expiry.items())
+        self.compaction = threading.Thread(target=self.write_snapshot,args=(entries,))
+        self.compaction.start()
+
+    def compacted(self):
+        # wait for a running compaction to be done
+        if self.compaction == None : return
+        self.compaction.join()
+        self.compaction = None
 
     def delete_path(self, delpath):
         self.logger.debug("sr_cache delete_path")
 
-        # close,remove file, open new empty file
-        self.fp.close()
-        os.unlink(self.cache_file)
-        self.fp = open(self.cache_file,'w')
+        # clean cache removing delpath, and journal it
+
+        self.clean(delpath=delpath)
+        self.fp.write("- %f %s -\n"%(time.time(),delpath))
+
+    def evict(self):
+        # remove least recently seen entries until the cache is within its limits
+
+        expiry = self.expiry
 
-        # clean cache removing delpath
+        while len(expiry) > 1 :
+              if   self.max_entries > 0 and len(expiry)  > self.max_entries : pass
+              elif self.max_bytes   > 0 and self.bytes   > self.max_bytes   : pass
+              else : break
+              entry, t = expiry.popitem(last=False)
+              self.remove(entry)
+              self.evictions += 1
 
-        self.clean(self.fp, delpath)
+        self.count = len(expiry)
 
     def free(self):
         self.logger.debug("sr_cache free")
-        self.cache_dict = {}
+        self.compacted()
+        self.expiry     = OrderedDict()
         self.count      = 0
-        os.unlink(self.cache_file)
-        self.fp = open(self.cache_file,'w')
+        self.bytes      = 0
+        self.fp.close()
+        for f in [ self.journal, self.journal_old ] :
+            try   : os.unlink(f)
+            except: pass
+        open(self.cache_file,'w').close()
+        self.fp = open(self.journal,'a')
 
     def load(self):
         self.logger.debug("sr_cache load")
-        self.cache_dict = {}
+        self.expiry     = OrderedDict()
         self.count      = 0
+        self.bytes      = 0
+
+        self.journal     = self.cache_file + '.journal'
+        self.journal_old = self.cache_file + '.journal.old'
 
         # create file if not existing
         if not os.path.isfile(self.cache_file) :
            self.fp = open(self.cache_file,'w')
            self.fp.close()
 
-        # set time 
-        now = time.time()
+        # snapshot, then journals
+
+        now     = time.time()
+        deleted = {}
+        ordered = True
+        for f in [ self.cache_file, self.journal_old, self.journal ] :
+            if not os.path.isfile(f) : continue
+            ordered = self.load_file(f,now,deleted) and ordered
+
+        # paths deleted after they were cached
+
+        if len(deleted) > 0 :
+           for entry in list(self.expiry.keys()) :
+               path = entry[1]
+               if path in deleted and self.expiry[entry] <= deleted[path] :
+                  del self.expiry[entry]
+                  self.remove(entry)
+
+        # files written by older versions are not time ordered
+
+        if not ordered :
+           self.logger.debug("sr_cache load sorting %d entries" % len(self.expiry))
+           self.expiry = OrderedDict( sorted( self.expiry.items(), key=lambda item: item[1] ) )
 
-        # open file (read/append)... 
-        # read through
-        # keep open to append entries
+        # keep the most recent entries within the limits
 
-        self.fp = open(self.cache_file,'r+')
-        lineno=0
+        self.evict()
+        self.count = len(self.expiry)
+
+        # keep journal open to append entries
+
+        self.fp = open(self.journal,'a')
+
+    def load_file(self, fname, now, deleted):
+        """
+           add entries of a snapshot or a journal file in cache.
+           returns False if times were not in order.
+        """
+
+        last_time = 0
+        ordered   = True
+
+        fp     = open(fname,'r')
+        lineno = 0
         while True :
               # read line, parse words
-              line  = self.fp.readline()
+              line  = fp.readline()
               if not line : break
               lineno += 1
 
               # words  = [ sum, time, path, part ]
               try:
                   words    = line.split()
-                  key      = words[0]
+                  key      = sys.intern(words[0])
                   ctime    = float(words[1])
-                  path     = words[2]
-                  part     = words[3]
-                  value    = '%s*%s' % (path,part)
+                  path     = sys.intern(words[2])
+                  part     = sys.intern(words[3])
 
                   # skip expired entry
 
@@ -216,19 +341,34 @@ class sr_cache():
                   if ttl > self.expire : continue
 
               except: # skip corrupted line.
-                  self.logger.error("sr_cache load corrupted line %d in %s" % ( lineno, self.cache_file) )
+                  self.logger.error("sr_cache load corrupted line %d in %s" % ( lineno, fname) )
                   continue
 
+              # journaled delete_path
+
+              if key == '-' :
+                 deleted[path] = ctime
+                 continue
+
+              # keep expiry time ordered
+
+              if ctime < last_time : ordered = False
+              else                 : last_time = ctime
+
               #  add info in cache
 
-              if key in self.cache_dict : kdict = self.cache_dict[key]
-              else:                       kdict = {}
+              entry = (key,path,part)
 
-              if not value in kdict     : self.count += 1
+              if entry in self.expiry :
+                 self.expiry.move_to_end(entry)
+                 self.expiry[entry] = ctime
+                 continue
 
-              kdict[value]         = ctime
-              self.cache_dict[key] = kdict
+              self.add(key,path,part,ctime)
 
+        fp.close()
+
+        return ordered
 
     def open(self, cache_file = None):
 
@@ -240,17 +380,55 @@ class sr_cache():
 
         self.load()
 
+    def remove(self, entry):
+        # an entry was taken out of expiry : its memory is freed
+        key, path, part = entry
+        self.bytes -= self.entry_size + len(key) + len(path) + len(part)
+
     def save(self):
         self.logger.debug("sr_cache save")
 
-        # close,remove file, open new empty file
-        if self.fp : self.fp.close()
-        try   : os.unlink(self.cache_file)
-        except: pass
-        self.fp = open(self.cache_file,'w')
+        # remove expired entries from memory
+
+        self.clean()
+        self.fp.flush()
+
+        # compaction still running
+
+        if self.compaction != None :
+           if self.compaction.is_alive() : return
+           self.compacted()
+
+        # compact when the journal is big compared to the snapshot
+
+        journal_size  = self.fp.tell()
+        snapshot_size = os.path.getsize(self.cache_file)
+
+        if journal_size <= self.journal_min : return
+
+        if journal_size > self.journal_ratio * snapshot_size :
+           self.compact()
+
+    def write_snapshot(self, entries):
+        """
+           write entries to a temporary file, and rename it as the snapshot
+           so it is replaced atomically. the old journal is then useless.
+        """
+
+        try :
+                tmpfile = self.cache_file + '.tmp'
+                fp = open(tmpfile,'w')
+                for (key,path,part), t in entries :
+                    fp.write("%s %f %s %s\n"%(key,t,path,part))
+                fp.flush()
+                os.fsync(fp.fileno())
+                fp.close()
 
-        # write unexpired entries, create refreshed dict
-        self.clean(self.fp)
+                os.rename(tmpfile,self.cache_file)
+                os.unlink(self.journal_old)
+        except:
+                (stype, svalue, tb) = sys.exc_info()
+                self.logger.error("sr_cache write_snapshot Type: %s, Value: %s" % (stype, svalue))
 
     def check_expire(self):
         self.logger.debug("sr_cache check_expire")
@@ -21,6 +21,10 @@ The API of a checksum class (in calling sequence order):
    set_path      -- identify the checksumming algorithm to be used by update.
    update        -- given this chunk of the file, update the checksum for the part
 
+A checksum class may also set:
+   update_buffer -- True if update accepts any bytes-like chunk (memoryview of the
+                    transfer buffer), otherwise update is given a bytes copy of it.
+
 The API allows for checksums to be calculated while transfer is in progress 
 rather than after the fact as a second pass through the data.  
 
@@ -34,6 +38,8 @@ class sr_checksum(object):
       """
       The default algorithm is to do a checksum of the entire contents of the file, which is called 'd'.
       """
+      update_buffer = False
+
       def __init__(self):
           self.value = None
 
@@ -54,10 +54,12 @@ from   paramiko import *
 try :
          from sr_checksum          import *
          from sr_credentials       import *
+         from sr_matcher           import *
          from sr_util              import *
 except : 
          from sarra.sr_checksum    import *
          from sarra.sr_credentials import *
+         from sarra.sr_matcher     import *
          from sarra.sr_util        import *
 
 if sys.hexversion > 0x03030000 :
@@ -233,10 +235,25 @@ class sr_config:
     def log_settings(self):
 
         self.logger.info( "log settings start for %s (version: %s):" % (self.program_name, sarra.__version__) )
-        self.logger.info( "\tinflight=%s events=%s use_pika=%s" % ( self.inflight, self.events, self.use_pika, ) )
-        self.logger.info( "\tsuppress_duplicates=%s retry_mode=%s retry_ttl=%s" % ( self.caching, self.retry_mode, self.retry_ttl ) )
+        self.logger.info( "\tinflight=%s events=%s use_pika=%s use_basic_consume=%s" % \
+           ( self.inflight, self.events, self.use_pika, self.use_basic_consume ) )
+        self.logger.info( "\tsuppress_duplicates=%s retry_mode=%s retry_ttl=%s retry_backoff=%s retry_backoff_max=%s" % \
+           ( self.caching, self.retry_mode, self.retry_ttl, self.retry_backoff, self.retry_backoff_max ) )
+        if self.caching :
+           self.logger.info( "\tcache_max_entries=%s cache_max_bytes=%s cache_journal_ratio=%s cache_shared=%s" % \
+              ( self.cache_max_entries, self.cache_max_bytes, self.cache_journal_ratio, self.cache_shared ) )
         self.logger.info( "\texpire=%s reset=%s message_ttl=%s prefetch=%s accept_unmatch=%s delete=%s" % \
            ( self.expire, self.reset, self.message_ttl, self.prefetch, self.accept_unmatch, self.delete ) )
+        self.logger.info( "\tack_batch=%s ack_interval=%s" % ( self.ack_batch, self.ack_interval ) )
+        self.logger.info( "\tbreaker_threshold=%s breaker_timeout=%s" % ( self.breaker_threshold, self.breaker_timeout ) )
+        self.logger.info( "\thttp_keepalive=%s download_segments=%s download_segment_threshold=%s download_threads=%s" % \
+           ( self.http_keepalive, self.download_segments, self.download_segment_threshold, self.download_threads ) )
+        self.logger.info( "\tsftp_pipeline=%s" % self.sftp_pipeline )
+        self.logger.info( "\tkbytes_ps=%s kbytes_ps_host=%s bandwidth_shared=%s" % \
+           ( self.kbytes_ps, self.kbytes_ps_host, self.bandwidth_shared ) )
+        if self.prefetch_adaptive :
+           self.logger.info( "\tprefetch_adaptive=%s prefetch_min=%s prefetch_max=%s" % \
+              ( self.prefetch_adaptive, self.prefetch_min, self.prefetch_max ) )
         self.logger.info( "\theartbeat=%s default_mode=%03o default_mode_dir=%03o default_mode_log=%03o discard=%s durable=%s" % \
            ( self.heartbeat, self.chmod, self.chmod_dir, self.chmod_log, self.discard, self.durable ) )
         self.logger.info( "\tpreserve_mode=%s preserve_time=%s realpath=%s base_dir=%s follow_symlinks=%s" % \
@@ -247,6 +264,9 @@ class sr_config:
         if self.post_broker :
             self.logger.info( "\tpost_base_dir=%s post_base_url=%s sum=%s blocksize=%s " % \
                ( self.post_base_dir, self.post_base_url, self.sumflg, self.blocksize ) )
+            self.logger.info( "\tpost_batch=%s post_batch_interval=%s" % ( self.post_batch, self.post_batch_interval ) )
+            self.logger.info( "\tsum_processes=%s sum_ordered=%s sum_threshold=%s sum_memo=%s sum_memo_max_entries=%s" % \
+               ( self.sum_processes, self.sum_ordered, self.sum_threshold, self.sum_memo, self.sum_memo_max_entries ) )
 
         self.logger.info('\tPlugins configured:')
 
@@ -541,6 +561,11 @@ class sr_config:
         self.debug                = False
 
         self.retry_mode           = True
+        self.breaker_threshold    = 0
+        self.breaker_timeout      = 60
+        self.http_keepalive       = 30
+        self.retry_backoff        = 30
+        self.retry_backoff_max    = 3600
         self.retry_ttl            = None
 
         self.remote_config_url    = None
@@ -556,6 +581,8 @@ class sr_config:
         self.timeout              = self.duration_from_str('5m',setting_units='s')
 
         self.kbytes_ps            = 0
+        self.kbytes_ps_host       = 0
+        self.bandwidth_shared     = False
 
         self.add_sumalgo_list     = []
         self.sumalgos             = {}
@@ -582,11 +609,15 @@ class sr_config:
         self.reset                = False
         self.message_ttl          = None
         self.prefetch             = 25
+        self.prefetch_adaptive    = False
+        self.prefetch_min         = 1
+        self.prefetch_max         = 1000
         self.max_queue_size       = 25000
         self.set_passwords        = True
 
         self.accept_unmatch       = None     # default changes depending on program
         self.masks                = []       # All the masks (accept and reject)
+        self.matcher              = None     # masks compiled (see sr_matcher)
         self.currentPattern       = None     # defaults to all
         self.currentDir           = os.getcwd()   # mask directory (if needed)
         self.currentFileOption    = None     # should implement metpx like stuff
@@ -602,11 +633,22 @@ class sr_config:
         # use pika only if amqplib is not available
         self.use_pika              = not 'amqplib' in sys.modules
 
+        # basic_consume (push) instead of basic_get (poll) 
+        self.use_basic_consume     = False
+
+        # ack batching (1 means ack each message)
+        self.ack_batch             = 1
+        self.ack_interval          = 1.0
+
 
         # cache
         self.cache                = None
         self.caching              = False
         self.cache_stat           = False
+        self.cache_journal_ratio  = 1.0
+        self.cache_max_entries    = 0
+        self.cache_max_bytes      = 0
+        self.cache_shared         = False
 
         # save/restore
         self.save_fp              = None
@@ -638,6 +680,11 @@ class sr_config:
         self.to_clusters          = None
         self.parts                = None
         self.sumflg               = 'd'
+        self.sum_processes        = 1
+        self.sum_ordered          = True
+        self.sum_threshold        = self.chunksize_from_str('100M')
+        self.sum_memo             = False
+        self.sum_memo_max_entries = 100000
 
         self.rename               = None
 
@@ -656,6 +703,9 @@ class sr_config:
 
         self.destination          = None
         self.discard              = False
+        self.download_segments    = 1
+        self.download_segment_threshold = self.chunksize_from_str('100M')
+        self.download_threads     = 1
 
         self.events               = 'create|delete|link|modify'
         self.event                = 'create|delete|modify'
@@ -663,6 +713,8 @@ class sr_config:
         self.flatten              = '/'
         self.follow_symlinks      = False
         self.force_polling        = False
+        self.inotify              = False
+        self.walk_threads         = 1
 
         self.gateway_for          = []
         self.mirror               = False
@@ -674,6 +726,8 @@ class sr_config:
         self.post_exchange        = None
         self.post_exchange_suffix = None
         self.post_exchange_split  = 0
+        self.post_batch           = 1
+        self.post_batch_interval  = 1.0
         self.preserve_mode        = True
         self.preserve_time        = True
         self.pump_flag            = False
@@ -687,6 +741,7 @@ class sr_config:
 
         self.save                 = False
         self.save_file            = None
+        self.sftp_pipeline        = 0
         self.sleep                = 0
         self.strip                = 0
         self.pstrip               = None
@@ -956,18 +1011,31 @@ class sr_config:
  
     def isMatchingPattern(self, chaine, accept_unmatch = False): 
 
-        for mask in self.masks:
-            self.logger.debug(mask)
-            pattern, maskDir, maskFileOption, mask_regexp, accepting = mask
-            self.currentPattern    = pattern
-            self.currentDir        = maskDir
-            self.currentFileOption = maskFileOption
-            self.currentRegexp     = mask_regexp
-            if mask_regexp.match(chaine) :
-               if not accepting : return False
-               return True
+        if self.masks == [] : return accept_unmatch
+
+        # compile masks (again if some were added)
+
+        if self.matcher == None or self.matcher.masks is not self.masks or \
+           len(self.matcher.prefixes) != len(self.masks) :
+           self.matcher = sr_matcher(self.masks)
+
+        # first match wins... if none, current settings are from the last mask
+
+        i = self.matcher.match(chaine)
+        if i == None : mask = self.masks[-1]
+        else         : mask = self.masks[i]
 
-        return accept_unmatch
+        pattern, maskDir, maskFileOption, mask_regexp, accepting = mask
+        self.currentPattern    = pattern
+        self.currentDir        = maskDir
+        self.currentFileOption = maskFileOption
+        self.currentRegexp     = mask_regexp
+
+        if i == None : return accept_unmatch
+
+        self.logger.debug("matched mask %s" % pattern)
+
+        return accepting
 
     def isTrue(self,S):
         s = S.lower()
@@ -1327,6 +1395,16 @@ class sr_config:
                      self.logger.debug("Masks")
                      self.logger.debug("Masks %s"% self.masks)
 
+                elif words0 == 'ack_batch': # See: sr_subscribe.1
+                     self.ack_batch = int(words1)
+                     if self.ack_batch < 1 : self.ack_batch = 1
+                     n = 2
+
+                elif words0 == 'ack_interval': # See: sr_subscribe.1
+                     # ack_interval setting is in sec 
+                     self.ack_interval = self.duration_from_str(words1,'s')
+                     n = 2
+
                 elif words0 in ['accept_unmatched','accept_unmatch','au']: # See: sr_config.7
                      if (words1 is None) or words[0][0:1] == '-' : 
                         self.accept_unmatch = True
@@ -1368,6 +1446,14 @@ class sr_config:
                      # FIXME MG should we test if directory exists ? and warn if not 
                      n = 2
 
+                elif words0 == 'breaker_threshold' : # See: sr_subscribe.1
+                     self.breaker_threshold = int(words1)
+                     n = 2
+
+                elif words0 == 'breaker_timeout' : # See: sr_subscribe.1
+                     self.breaker_timeout = self.duration_from_str(words1,'s')
+                     n = 2
+
                 elif words0 in ['broker','b'] : # See: sr_consumer.7 ++   fixme: everywhere, perhaps reduce
                      urlstr      = words1
                      ok, url     = self.validate_urlstr(urlstr)
@@ -1385,6 +1471,14 @@ class sr_config:
                              
                      n = 2
 
+                elif words0 == 'bandwidth_shared' : # See: sr_subscribe.1
+                     if (words1 is None) or words[0][0:1] == '-' : 
+                        self.bandwidth_shared = True
+                        n = 1
+                     else :
+                        self.bandwidth_shared = self.isTrue(words[1])
+                        n = 2
+
                 elif words0 == 'bufsize' :   # See: sr_config.7
                      self.bufsize = int(words[1])
                      n = 2
@@ -1406,6 +1500,26 @@ class sr_config:
                         self.execfile("on_heartbeat",'hb_cache')
                         self.heartbeat_cache_installed = True
 
+                elif words0 == 'cache_journal_ratio' : # See: sr_subscribe.1
+                     self.cache_journal_ratio = float(words1)
+                     n = 2
+
+                elif words0 == 'cache_max_bytes' : # See: sr_subscribe.1
+                     self.cache_max_bytes = self.chunksize_from_str(words1)
+                     n = 2
+
+                elif words0 == 'cache_max_entries' : # See: sr_subscribe.1
+                     self.cache_max_entries = int(words1)
+                     n = 2
+
+                elif words0 == 'cache_shared' : # See: sr_subscribe.1
+                     if (words1 is None) or words[0][0:1] == '-' : 
+                        self.cache_shared = True
+                        n = 1
+                     else :
+                        self.cache_shared = self.isTrue(words[1])
+                        n = 2
+
                 elif words0 == 'cache_stat'   : # FIXME! what is this?
                      if (words1 is None) or words[0][0:1] == '-' : 
                         self.cache_stat = True
@@ -1505,6 +1619,18 @@ class sr_config:
                      ok = self.execfile("do_download",words1)
                      n = 2
 
+                elif words0 == 'download_segments' : # See: sr_subscribe.1
+                     self.download_segments = int(words1)
+                     n = 2
+
+                elif words0 == 'download_segment_threshold' : # See: sr_subscribe.1
+                     self.download_segment_threshold = self.chunksize_from_str(words1)
+                     n = 2
+
+                elif words0 == 'download_threads' : # See: sr_subscribe.1
+                     self.download_threads = int(words1)
+                     n = 2
+
                 elif words0 == 'do_task': # See: sr_config.1, others...
                      ok =self.execfile("do_task",words1)
                      if not ok:
@@ -1600,6 +1726,14 @@ class sr_config:
                         self.force_polling = self.isTrue(words[1])
                         n = 2
 
+                elif words0 == 'inotify': # See: sr_watch.1
+                     if (words1 is None) or words[0][0:1] == '-' : 
+                        self.inotify = True
+                        n = 1
+                     else :
+                        self.inotify = self.isTrue(words[1])
+                        n = 2
+
                 elif words0 in ['header']: # See: sr_config.7
                      kvlist = words1.split('=')
                      key    = kvlist[0]
@@ -1630,6 +1764,10 @@ class sr_config:
                      self.hostname = words[1] 
                      n = 2
 
+                elif words0 == 'http_keepalive' : # See: sr_subscribe.1
+                     self.http_keepalive = self.duration_from_str(words1,'s')
+                     n = 2
+
                 elif words0 in ['inplace','in','assemble']: # See: sr_sarra.8, sr_post.1, sr_watch.1
                      if (words1 is None) or words[0][0:1] == '-' : 
                         self.inplace = True
@@ -1651,6 +1789,10 @@ class sr_config:
                      self.kbytes_ps = int(words[1])
                      n = 2
 
+                elif words0 == 'kbytes_ps_host': # See: sr_subscribe.1
+                     self.kbytes_ps_host = int(words[1])
+                     n = 2
+
                 elif words0 in ['lock','inflight']: # See: sr_config.7, sr_subscribe.1
                      if words[1].lower() in [ 'none' ]: 
                          self.inflight=None
@@ -1904,6 +2046,16 @@ class sr_config:
                         needexit = True
                      n = 2
 
+                elif words0 == 'post_batch': # See: sr_subscribe.1
+                     self.post_batch = int(words1)
+                     if self.post_batch < 1 : self.post_batch = 1
+                     n = 2
+
+                elif words0 == 'post_batch_interval': # See: sr_subscribe.1
+                     # post_batch_interval setting is in sec 
+                     self.post_batch_interval = self.duration_from_str(words1,'s')
+                     n = 2
+
                 elif words0 in ['post_document_root','pdr']: # See: sr_sarra,sender,shovel,winnow
                      if sys.platform == 'win32':
                          self.post_document_root = words1.replace('\\','/')
@@ -1927,6 +2079,22 @@ class sr_config:
                      self.prefetch = int(words1)
                      n = 2
 
+                elif words0 == 'prefetch_adaptive': # See: sr_subscribe.1
+                     if (words1 is None) or words[0][0:1] == '-' :
+                        self.prefetch_adaptive = True
+                        n = 1
+                     else :
+                        self.prefetch_adaptive = self.isTrue(words[1])
+                        n = 2
+
+                elif words0 == 'prefetch_max': # See: sr_subscribe.1
+                     self.prefetch_max = int(words1)
+                     n = 2
+
+                elif words0 == 'prefetch_min': # See: sr_subscribe.1
+                     self.prefetch_min = int(words1)
+                     n = 2
+
                 elif words0 in ['preserve_mode','pm'] : # See: sr_config.7
                      if (words1 is None) or words[0][0:1] == '-' : 
                         self.preserve_mode = True
@@ -2027,6 +2195,14 @@ class sr_config:
                         self.retry_mode = self.isTrue(words[1])
                         n = 2
 
+                elif words0 == 'retry_backoff' :  # See: sr_subscribe.1
+                     self.retry_backoff = self.duration_from_str(words1,'s')
+                     n = 2
+
+                elif words0 == 'retry_backoff_max' :  # See: sr_subscribe.1
+                     self.retry_backoff_max = self.duration_from_str(words1,'s')
+                     n = 2
+
                 elif words0 in ['retry_ttl']:  # FIXME to be documented
                      self.retry_ttl = int(self.duration_from_str(words1,'s'))
                      n = 2
@@ -2068,6 +2244,10 @@ class sr_config:
                         self.set_passwords = self.isTrue(words[1])
                         n = 2
 
+                elif words0 == 'sftp_pipeline' : # See: sr_subscribe.1
+                     self.sftp_pipeline = int(words1)
+                     n = 2
+
                 elif words0 == 'sleep': # See: sr_audit.8 sr_poll.1
                      # sleep setting is in sec 
                      self.sleep = self.duration_from_str(words1,'s')
@@ -2121,6 +2301,37 @@ class sr_config:
                      if not ok : needexit = True
                      n = 2
 
+                elif words0 == 'sum_memo' : # See: sr_post.1
+                     if (words1 is None) or words[0][0:1] == '-' : 
+                        self.sum_memo = True
+                        n = 1
+                     else :
+                        self.sum_memo = self.isTrue(words[1])
+                        n = 2
+                     if self.sum_memo and not hasattr(self,'heartbeat_sum_memo_installed') :
+                        self.execfile("on_heartbeat",'hb_sum_memo')
+                        self.heartbeat_sum_memo_installed = True
+
+                elif words0 == 'sum_memo_max_entries' : # See: sr_post.1
+                     self.sum_memo_max_entries = int(words1)
+                     n = 2
+
+                elif words0 == 'sum_ordered' : # See: sr_post.1
+                     if (words1 is None) or words[0][0:1] == '-' : 
+                        self.sum_ordered = True
+                        n = 1
+                     else :
+                        self.sum_ordered = self.isTrue(words[1])
+                        n = 2
+
+                elif words0 == 'sum_processes' : # See: sr_post.1
+                     self.sum_processes = int(words1)
+                     n = 2
+
+                elif words0 == 'sum_threshold' : # See: sr_post.1
+                     self.sum_threshold = self.chunksize_from_str(words1)
+                     n = 2
+
                 elif words0 == 'timeout': # See: sr_sarra.8
                      # timeout setting is in sec 
                      self.timeout = int(self.duration_from_str(words1,'s'))
@@ -2148,6 +2359,14 @@ class sr_config:
                         self.use_pika = self.isTrue(words[1])
                         n = 2
 
+                elif words0 == 'use_basic_consume': # See: sr_subscribe.1
+                     if (words1 is None) or words[0][0:1] == '-' :
+                        self.use_basic_consume = True
+                        n = 1
+                     else :
+                        self.use_basic_consume = self.isTrue(words[1])
+                        n = 2
+
                 elif words0 == 'users':  # See: sr_audit.1
                      if (words1 is None) or words[0][0:1] == '-' : 
                         self.users_flag = True
@@ -2160,6 +2379,10 @@ class sr_config:
                      self.vip = words[1]
                      n = 2
 
+                elif words0 == 'walk_threads': # See: sr_post.1, sr_watch.1
+                     self.walk_threads = int(words[1])
+                     n = 2
+
                 else :
                      # if unknown option is supplied, create a list for the values 
                      # FIXME: if specifying values on command line, this breaks (including all options)
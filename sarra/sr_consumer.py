@@ -99,6 +99,20 @@ class sr_consumer:
         if self.parent.prefetch > 0 :
             self.consumer.add_prefetch(self.parent.prefetch)
 
+        # prefetch (basic_qos) only limits basic_consume deliveries
+
+        if self.parent.prefetch_adaptive :
+            if not self.parent.use_basic_consume :
+               self.logger.info("prefetch_adaptive : use_basic_consume enabled")
+               self.parent.use_basic_consume = True
+            self.consumer.add_prefetch_bounds(self.parent.prefetch_min,self.parent.prefetch_max)
+
+        if self.parent.use_basic_consume :
+            self.consumer.add_push(True)
+
+        if self.parent.ack_batch > 1 :
+            self.consumer.add_ack_batch(self.parent.ack_batch,self.parent.ack_interval)
+
         self.consumer.build()
 
         self.retry_msg = self.retry.message
@@ -125,17 +139,37 @@ class sr_consumer:
         self.msg_queue.build()
 
     def close(self):
+        # pending batched acks must reach the broker before the channel is closed
+        try   : self.consumer.flush_acks()
+        except: pass
         self.hc.close()
         self.retry.close()
 
     def consume(self):
 
+        # adaptive prefetch : time spent on the last message
+
+        if self.consumer.prefetch_max > 0 and self.raw_msg != None and not self.raw_msg.isRetry :
+           self.consumer.observe(time.time() - self.consume_time)
+
         # acknowledge last message... we are done with it since asking for a new one
-        if self.raw_msg != None and not self.raw_msg.isRetry : self.consumer.ack(self.raw_msg)
+        # with download threads, the pool acknowledges it once downloaded, in delivery order
+
+        pool = None
+        if hasattr(self.parent,'download_pool') : pool = self.parent.download_pool
+
+        if self.raw_msg != None and not self.raw_msg.isRetry :
+           if pool : pool.ack(self.raw_msg)
+           else    : self.consumer.ack(self.raw_msg)
 
         # consume a new one
         self.raw_msg = self.consumer.consume(self.queue_name)
 
+        # queue is idle, no reason to hold back batched acks
+
+        if self.raw_msg == None : self.consumer.flush_acks()
+        else                    : self.consume_time = time.time()
+
         # if no message from queue, perhaps we have message to retry
 
         if self.raw_msg == None : self.raw_msg = self.retry.get()
@@ -150,12 +184,26 @@ class sr_consumer:
         if   self.raw_msg == None                          : should_sleep = True
         elif self.raw_msg.isRetry and self.last_msg_failed : should_sleep = True
 
+        # in push mode, the sleep is a wait on the broker connection
+        # that ends as soon as a delivery arrives. With downloads in flight,
+        # it ends as soon as one of them is done.
+
         if should_sleep :
            #self.logger.debug("sleeping %f" % self.sleep_now)
-           time.sleep(self.sleep_now)
-           self.sleep_now = self.sleep_now * 2
-           if self.sleep_now > self.sleep_max : 
-                  self.sleep_now = self.sleep_max
+           if pool and pool.inflight > 0 :
+              delivered = pool.wait(self.sleep_now)
+           elif self.consumer.push :
+              delivered = self.consumer.wait(self.sleep_now)
+           else :
+              time.sleep(self.sleep_now)
+              delivered = False
+
+           if delivered :
+              self.sleep_now = self.sleep_min
+           else :
+              self.sleep_now = self.sleep_now * 2
+              if self.sleep_now > self.sleep_max : 
+                     self.sleep_now = self.sleep_max
 
         if self.raw_msg == None: return False, self.msg
 
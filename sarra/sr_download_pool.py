@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+#
+# This file is part of sarracenia.
+# The sarracenia suite is Free and is proudly provided by the Government of Canada
+# Copyright (C) Her Majesty The Queen in Right of Canada, Environment Canada, 2008-2015
+#
+# Questions or bugs report: dps-client@ec.gc.ca
+# sarracenia repository: git://git.code.sf.net/p/metpx/git
+# Documentation: http://metpx.sourceforge.net/#SarraDocumentation
+#
+# sr_download_pool.py : python3 downloads of one instance run in threads
+#
+########################################################################
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307  USA
+#
+#
+
+import collections,copy,os,queue,sys,threading,time
+
+try :
+         from sr_http            import *
+except :
+         from sarra.sr_http      import *
+
+#============================================================
+# sr_download_pool : the transfers of an instance run in download_threads
+#                    worker threads.
+#
+# main thread : consumes the messages and processes them up to the transfer
+#               (process_message, doit_download), submits the transfer
+#               and goes on with the next message. When a transfer is done,
+#               the main thread completes its message (download_done :
+#               checksum, on_part, on_file, discard, post, retry).
+#               Everything but the transfer stays in the main thread : plugins,
+#               the cache, the retry files and the broker channel.
+#
+# workers     : each one has its own copy of the parent (context) and so its
+#               own transports, kept connected from one transfer to the next
+#               (http connections come from the http_pool of the parent).
+#               reports published during the transfer are kept in the job,
+#               the main thread publishes them.
+#
+# in flight   : at most 2 * download_threads transfers, and only one per
+#               local file : submit waits for a transfer to complete.
+#
+# window      : messages to acknowledge, in delivery order [ raw_msg, job ]
+#               (job None : nothing in flight for that message).
+#               the head of the window is acknowledged once its transfer
+#               is completed : acks are issued in delivery order.
+#
+# snapshots   : the consumer reuses its message object (pika deliveries,
+#               sr_retry.get), so the jobs and the window keep their own
+#               copy of each message (delivery_tag, body, headers, retry_*).
+#               held is the job of the message being processed, paired
+#               with that message when sr_consumer acknowledges it.
+#
+
+# transports, kept by each worker
+
+links = [ 'ftp_link', 'http_link', 'sftp_link' ]
+
+class sr_download_job():
+
+    def __init__(self, msg, raw_msg, oldname, state):
+
+        self.msg       = msg
+        self.raw_msg   = raw_msg
+        self.oldname   = oldname
+        self.state     = state
+
+        self.path      = state['new_dir'] + os.sep + state['new_file']
+        self.reports   = []
+        self.ok        = False
+        self.elapse    = 0.0
+        self.completed = False
+
+    def report(self, code, message):
+        self.reports.append( (code,message) )
+
+class sr_download_pool():
+
+    def __init__(self, parent ):
+        parent.logger.debug("sr_download_pool init")
+
+        self.parent    = parent
+        self.logger    = parent.logger
+
+        self.threads   = parent.download_threads
+        self.maximum   = 2 * self.threads
+
+        # the broker must deliver enough messages to keep the workers busy
+
+        if parent.prefetch < self.maximum :
+           self.logger.info("sr_download_pool prefetch %d raised to %d" % (parent.prefetch,self.maximum))
+           parent.prefetch = self.maximum
+
+        self.jobs      = queue.Queue()
+        self.done      = queue.Queue()
+        self.finished  = threading.Event()
+        self.workers   = []
+
+        self.inflight  = 0
+        self.paths     = set()
+        self.held      = None
+        self.window    = collections.deque()
+
+        self.started   = time.time()
+        self.downloads = 0
+        self.failed    = 0
+        self.busy      = 0.0
+        self.waited    = 0.0
+
+    def accepts(self, msg):
+        # transfers a worker can do : not the local copies and registered do_download
+
+        scheme = msg.url.scheme
+
+        if scheme in self.parent.do_downloads : return False
+
+        return scheme in [ 'ftp', 'ftps', 'http', 'https', 'sftp' ]
+
+    def ack(self, raw_msg):
+        # sr_consumer is done with raw_msg : acknowledged when its transfer is completed
+
+        job       = self.held
+        self.held = None
+
+        if job == None : self.window.append( [self.snapshot(raw_msg), None] )
+        else           : self.window.append( [job.raw_msg, job] )
+        self.flush()
+
+    def close(self):
+        self.logger.debug("sr_download_pool close")
+
+        # transfers in flight are completed before the workers stop
+
+        while self.inflight > 0 : self.collect(True)
+        self.flush()
+
+        for worker in self.workers : self.jobs.put(None)
+        for worker in self.workers : worker.join(self.parent.timeout or None)
+
+        self.workers = []
+
+    def collect(self, block=False):
+        # complete the messages of the transfers done
+
+        self.finished.clear()
+
+        while self.inflight > 0 :
+              try    : job = self.done.get(block, 1)
+              except queue.Empty :
+                       if block : continue
+                       break
+              block = False
+              self.inflight -= 1
+              self.complete(job)
+
+        self.flush()
+
+    def complete(self, job):
+
+        parent   = self.parent
+        consumer = parent.consumer
+
+        # the parent is set back as it was when the job was submitted
+
+        saved = ( parent.msg, consumer.raw_msg, parent.new_dir, parent.new_file, parent.new_relpath, parent.new_baseurl )
+
+        parent.msg         = job.msg
+        consumer.raw_msg   = job.raw_msg
+        parent.new_dir     = job.state['new_dir']
+        parent.new_file    = job.state['new_file']
+        parent.new_relpath = job.state['new_relpath']
+        parent.new_baseurl = job.state['new_baseurl']
+
+        try :
+                del job.msg.report_publish
+                for code,message in job.reports : job.msg.report_publish(code,message)
+
+                os.chdir(parent.new_dir)
+                parent.download_done(job.ok,job.oldname)
+        except :
+                (stype, svalue, tb) = sys.exc_info()
+                self.logger.error("sr_download_pool could not complete %s Type: %s, Value: %s" % (job.path, stype, svalue))
+
+        ( parent.msg, consumer.raw_msg, parent.new_dir, parent.new_file, parent.new_relpath, parent.new_baseurl ) = saved
+
+        self.paths.discard(job.path)
+        job.completed = True
+
+        self.busy      += job.elapse
+        self.downloads += 1
+        if not job.ok : self.failed += 1
+
+    def flush(self):
+        # acknowledge the head of the window, up to the first transfer in flight
+
+        while self.window :
+              raw_msg, job = self.window[0]
+              if job and not job.completed : break
+              self.window.popleft()
+              self.parent.consumer.consumer.ack(raw_msg)
+
+    def log_stats(self):
+
+        elapse = max(time.time() - self.started, 0.001)
+
+        self.logger.info("sr_download_pool %d downloads (%d failed) by %d threads, %.1f%% busy, %.1fs waiting for a thread, %d in flight" % \
+                        (self.downloads, self.failed, self.threads, 100.0 * self.busy / elapse / self.threads, self.waited, self.inflight))
+
+    def snapshot(self, raw_msg):
+        # copy of a message the consumer may overwrite with the next one
+
+        msg               = copy.copy(raw_msg)
+        msg.delivery_info = raw_msg.delivery_info.copy()
+        msg.properties    = raw_msg.properties.copy()
+
+        return msg
+
+    def start(self):
+        self.logger.debug("sr_download_pool start")
+
+        parent = self.parent
+
+        # http connections are shared by the workers
+
+        if not hasattr(parent,'http_pool') or parent.http_pool == None :
+           parent.http_pool = sr_http_pool(parent)
+
+        # contexts are copied in the main thread : the parent is not modified meanwhile
+
+        for i in range(self.threads) :
+            context = copy.copy(parent)
+            for name in links :
+                if name in context.__dict__ : del context.__dict__[name]
+            worker  = threading.Thread(target=self.work, args=(context,), name='download_%d' % i, daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, oldname):
+
+        parent = self.parent
+
+        if not self.workers : self.start()
+
+        path  = parent.new_dir + os.sep + parent.new_file
+        start = time.time()
+
+        while self.inflight >= self.maximum or path in self.paths :
+              self.collect(True)
+
+        self.waited += time.time() - start
+
+        # the job has its own message : the parent one is used for the next message
+
+        msg         = copy.copy(parent.msg)
+        msg.headers = parent.msg.headers.copy()
+        if msg.sumalgo : msg.sumalgo = copy.copy(msg.sumalgo)
+
+        state        = parent.__dict__.copy()
+        state['msg'] = msg
+
+        raw_msg = parent.consumer.raw_msg
+        if raw_msg != None : raw_msg = self.snapshot(raw_msg)
+
+        job = sr_download_job(msg, raw_msg, oldname, state)
+        msg.report_publish = job.report
+
+        # retried messages are not acknowledged
+
+        if raw_msg != None and not raw_msg.isRetry : self.held = job
+
+        self.paths.add(job.path)
+        self.inflight += 1
+        self.jobs.put(job)
+
+    def wait(self, timeout):
+        # sleep until a transfer is done, returns True if one is
+
+        return self.finished.wait(timeout)
+
+    def work(self, context):
+
+        kept = {}
+
+        while True :
+              job = self.jobs.get()
+              if job == None : break
+
+              # the context of the message, with the transports of this worker
+
+              context.__dict__.update(job.state)
+              for name in links :
+                  if   name in kept               : context.__dict__[name] = kept[name]
+                  elif name in context.__dict__   : del context.__dict__[name]
+
+              start = time.time()
+              try :
+                      job.ok = context.download_attempts()
+              except :
+                      (stype, svalue, tb) = sys.exc_info()
+                      self.logger.error("sr_download_pool download %s Type: %s, Value: %s" % (job.path, stype, svalue))
+                      job.ok = False
+
+              job.elapse = time.time() - start
+
+              for name in links :
+                  if name in context.__dict__ : kept[name] = context.__dict__[name]
+
+              self.done.put(job)
+              self.finished.set()
+
+        for link in kept.values() :
+            try    : link.close()
+            except : pass
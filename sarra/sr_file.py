@@ -33,7 +33,7 @@
 #
 #
 
-import os, stat, sys, time
+import errno, os, stat, sys, time
 
 try:
     from sr_util import *
@@ -133,6 +133,74 @@ class sr_file():
 
 
 
+# file_copy
+# copy length bytes from src to dst (binary files) at their current positions
+#
+# the copy is done in the kernel when possible :
+#      copy_file_range : server side copy on nfs, reflink on xfs/btrfs
+#      sendfile        : when copy_file_range is not there or not supported
+# and through python (bufsize chunks) for what is left.
+# when a checksum is needed, it is computed from a mmap of the bytes written.
+#
+# returns the number of bytes copied (less than length if src is shorter)
+
+def file_copy(src, dst, length, bufsize, chk=None):
+
+    src_offset = src.tell()
+    dst_offset = dst.tell()
+    dst.flush()
+
+    copied = file_copy_kernel(src.fileno(), dst.fileno(), src_offset, dst_offset, length)
+
+    if chk and copied > 0 : file_checksum(dst, dst_offset, copied, chk, bufsize)
+
+    src.seek(src_offset + copied,0)
+    dst.seek(dst_offset + copied,0)
+
+    while copied < length :
+          chunk = src.read(min(bufsize,length-copied))
+          if not chunk : break
+          dst.write(chunk)
+          if chk : chk.update(chunk)
+          copied += len(chunk)
+
+    return copied
+
+# file_copy_kernel
+# copy up to length bytes between file descriptors, with explicit offsets.
+# stops at the end of src, or at the first error (python does the rest)
+
+def file_copy_kernel(src_fd, dst_fd, src_offset, dst_offset, length):
+
+    copied   = 0
+    use_cfr  = hasattr(os,'copy_file_range')
+    use_send = hasattr(os,'sendfile')
+
+    while copied < length :
+          try :
+                  if use_cfr :
+                     n = os.copy_file_range(src_fd, dst_fd, length - copied, \
+                                            src_offset + copied, dst_offset + copied)
+                  elif use_send :
+                     os.lseek(dst_fd, dst_offset + copied, os.SEEK_SET)
+                     n = os.sendfile(dst_fd, src_fd, src_offset + copied, length - copied)
+                  else :
+                     break
+
+          except OSError as err :
+                  # not supported for these files : next method
+                  if err.errno not in [ errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP ] :
+                     break
+                  if use_cfr : use_cfr  = False
+                  else       : use_send = False
+                  continue
+
+          if n == 0 : break
+          copied += n
+
+    return copied
+
+
 # file_insert
 # called by file_process (general file:// processing)
 
@@ -194,13 +262,7 @@ def file_insert_part(parent,msg,part_file):
 
              if chk : chk.set_path(os.path.basename(msg.target_file))
 
-             i  = 0
-             while i<msg.length :
-                   buf = fp.read(bufsize)
-                   if not buf: break
-                   ft.write(buf)
-                   if chk : chk.update(buf)
-                   i  += len(buf)
+             i  = file_copy(fp, ft, msg.length, bufsize, chk)
 
              if ft.tell() >= msg.filesize:
                  ft.truncate()
@@ -428,22 +490,7 @@ def file_write_length(req,msg,bufsize,filesize,parent):
     fp = open(msg.new_file,'r+b')
     if msg.local_offset != 0 : fp.seek(msg.local_offset,0)
 
-    nc = int(msg.length/bufsize)
-    r  =     msg.length%bufsize
-
-    # read/write bufsize "nc" times
-    i  = 0
-    while i < nc :
-          chunk = req.read(bufsize)
-          fp.write(chunk)
-          if chk : chk.update(chunk)
-          i = i + 1
-
-    # remaining
-    if r > 0 :
-       chunk = req.read(r)
-       fp.write(chunk)
-       if chk : chk.update(chunk)
+    file_copy(req, fp, msg.length, bufsize, chk)
 
     if fp.tell() >= msg.filesize:
        fp.truncate()
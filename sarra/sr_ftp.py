@@ -261,6 +261,24 @@ class sr_ftp(sr_proto):
         # initialize sumalgo
         if self.sumalgo : self.sumalgo.set_path(remote_file)
 
+        # download a range (segmented download) : REST to remote_offset, stop after length
+
+        if self.binary and length != 0 and \
+           ( remote_offset != 0 or ( filesize != None and length < filesize ) ) :
+           rest = None
+           if remote_offset != 0 : rest = remote_offset
+           self.ftp.voidcmd('TYPE I')
+           conn = self.ftp.transfercmd('RETR ' + remote_file, rest)
+           src  = conn.makefile('rb')
+           rw_length = self.read_write(src, dst, length)
+           src.close()
+           conn.close()
+           # 226 if the range ends the file, 426 or 451 when cut short
+           try    : self.ftp.voidresp()
+           except ftplib.error_temp : pass
+           self.local_write_close(dst)
+           return
+
         # download
         self.write_chunk_init(dst)
         if self.binary : self.ftp.retrbinary('RETR ' + remote_file, self.write_chunk, self.bufsize )
@@ -403,11 +421,10 @@ class ftp_transport(sr_transport):
         urlstr      = msg.baseurl + '/' + msg.relpath
         new_lock    = ''
 
-        try:    curdir = os.getcwd()
-        except: curdir = None
+        # local paths do not depend on the working directory :
+        # downloads may run in threads (download_threads)
 
-        if curdir != parent.new_dir:
-           os.chdir(parent.new_dir)
+        new_file    = parent.new_dir + os.sep + parent.new_file
 
         try :
                 parent.destination = msg.baseurl
@@ -450,23 +467,23 @@ class ftp_transport(sr_transport):
                 ftp.set_sumalgo(msg.sumalgo)
 
                 if parent.inflight == None or msg.partflg == 'i' :
-                   ftp.get(remote_file,parent.new_file,remote_offset,msg.local_offset,msg.length,msg.filesize)
+                   self.get(ftp,cdir,remote_file,new_file,remote_offset,msg.local_offset,msg.length,msg.filesize)
 
                 elif parent.inflight == '.' :
-                   new_lock = '.' + parent.new_file
-                   ftp.get(remote_file,new_lock,remote_offset,msg.local_offset,msg.length,msg.filesize)
-                   if os.path.isfile(parent.new_file) : os.remove(parent.new_file)
-                   os.rename(new_lock, parent.new_file)
+                   new_lock = parent.new_dir + os.sep + '.' + parent.new_file
+                   self.get(ftp,cdir,remote_file,new_lock,remote_offset,msg.local_offset,msg.length,msg.filesize)
+                   if os.path.isfile(new_file) : os.remove(new_file)
+                   os.rename(new_lock, new_file)
                       
                 elif parent.inflight[0] == '.' :
-                   new_lock  = parent.new_file + parent.inflight
-                   ftp.get(remote_file,new_lock,remote_offset,msg.local_offset,msg.length,msg.filesize)
-                   if os.path.isfile(parent.new_file) : os.remove(parent.new_file)
-                   os.rename(new_lock, parent.new_file)
+                   new_lock  = new_file + parent.inflight
+                   self.get(ftp,cdir,remote_file,new_lock,remote_offset,msg.local_offset,msg.length,msg.filesize)
+                   if os.path.isfile(new_file) : os.remove(new_file)
+                   os.rename(new_lock, new_file)
 
                 # fix permission 
 
-                self.set_local_file_attributes(parent.new_file,msg)
+                self.set_local_file_attributes(new_file,msg)
 
                 # fix message if no partflg (means file size unknown until now)
 
@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+#
+# This file is part of sarracenia.
+# The sarracenia suite is Free and is proudly provided by the Government of Canada
+# Copyright (C) Her Majesty The Queen in Right of Canada, Environment Canada, 2008-2015
+#
+# Questions or bugs report: dps-client@ec.gc.ca
+# sarracenia repository: git://git.code.sf.net/p/metpx/git
+# Documentation: http://metpx.sourceforge.net/#SarraDocumentation
+#
+# sr_inotify.py : python3 native linux inotify observer for sr_watch
+#
+########################################################################
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307  USA
+#
+#
+
+import ctypes,ctypes.util,errno,os,struct,sys
+
+#============================================================
+# sr_inotify : the inotify observer of sr_watch (option inotify), instead
+#              of the watchdog Observer thread.
+#
+# read       : called by sr_post.wakeup, in the main thread (no thread, no
+#              copy of events lists to race with). the inotify descriptor is
+#              non blocking, it is read in batches (bufsize) until empty and
+#              every batch is parsed in one pass.
+#
+# coalescing : the events go in the events OrderedDict of sr_post keyed by
+#              '%s %s' % (src,dst) (as on_add) : a file created, written
+#              (IN_MODIFY many times), closed (IN_CLOSE_WRITE) during a
+#              sleep is one 'create' event.  A 'delete' replaces it.
+#              events of directories (create, modify) are dropped, their
+#              content is watched.
+#
+# moves      : IN_MOVED_FROM/IN_MOVED_TO with the same cookie are a 'move',
+#              an IN_MOVED_FROM not paired in the same read is a 'delete'
+#              (moved out of the tree), an IN_MOVED_TO not paired a 'create'.
+#
+# watches    : wds[wd] = path, dirs[path] = wd.  A new subdirectory (created,
+#              moved in) gets its watch when its event is read and is scanned
+#              (files written before its watch was added), the rest of the tree
+#              is not primed again.  A directory moved within the tree keeps
+#              its watches, their paths are renamed.
+#
+# overflow   : IN_Q_OVERFLOW (more than max_queued_events not read) : every
+#              watched directory is scanned, its files are 'create' events.
+#
+# The api is the one of the watchdog observer used by sr_post :
+#              schedule, unschedule, start, stop, join.
+#
+
+IN_MODIFY      = 0x00000002
+IN_ATTRIB      = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF   = 0x00000800
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ONLYDIR     = 0x01000000
+IN_ISDIR       = 0x40000000
+IN_NONBLOCK    = 0o4000
+IN_CLOEXEC     = 0o2000000
+
+IN_WRITTEN     = IN_CREATE | IN_MODIFY | IN_CLOSE_WRITE | IN_ATTRIB
+IN_WATCHED     = IN_WRITTEN | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE_SELF | IN_ONLYDIR
+
+event_header   = struct.Struct('iIII')
+
+libc           = None
+try :
+         libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+         libc.inotify_init1
+         libc.inotify_add_watch.argtypes = [ ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32 ]
+except : libc = None
+
+class sr_inotify():
+
+    bufsize = 256 * 1024
+
+    def __init__(self, parent ):
+        parent.logger.debug("sr_inotify init")
+
+        self.parent     = parent
+        self.logger     = parent.logger
+
+        self.wds        = {}
+        self.dirs       = {}
+        self.fd         = None
+
+        self.reads      = 0
+        self.nevents    = 0
+        self.coalesced  = 0
+        self.overflows  = 0
+
+        fd = libc.inotify_init1(IN_NONBLOCK|IN_CLOEXEC)
+        if fd < 0 :
+           err = ctypes.get_errno()
+           raise OSError(err, "inotify_init1: %s" % os.strerror(err))
+
+        self.fd = fd
+
+    @staticmethod
+    def available():
+        return libc != None and sys.platform.startswith('linux')
+
+    def add_watch(self, path):
+
+        wd = libc.inotify_add_watch(self.fd, os.fsencode(path), IN_WATCHED)
+        if wd < 0 :
+           err = ctypes.get_errno()
+           if err == errno.ENOSPC :
+              self.logger.error("sr_inotify %s not watched, fs.inotify.max_user_watches reached" % path)
+           elif err != errno.ENOENT :
+              self.logger.warning("sr_inotify %s not watched: %s" % (path,os.strerror(err)))
+           return None
+
+        # a directory moved (same wd) or watched again
+
+        old = self.wds.get(wd)
+        if old != None and self.dirs.get(old) == wd : del self.dirs[old]
+
+        self.wds[wd]    = path
+        self.dirs[path] = wd
+
+        return wd
+
+    def add_tree(self, path, events=None):
+        # watch path and its subdirectories, its files are 'create' events when events is given
+
+        stack = [ path ]
+
+        while len(stack) > 0 :
+              d = stack.pop()
+              if self.add_watch(d) == None : continue
+
+              try :
+                       entries = list(os.scandir(d))
+              except : continue
+
+              for entry in entries :
+                  try :
+                           isdir = entry.is_dir(follow_symlinks=False)
+                  except : continue
+
+                  if isdir :
+                     stack.append(entry.path)
+                  elif events != None :
+                     self.event(events, 'create', entry.path, None)
+
+    def event(self, events, event, src, dst):
+
+        key = '%s %s' % (src,dst)
+
+        if event != 'delete' and key in events and events[key][0] != 'delete' :
+           self.coalesced += 1
+           return
+
+        if key in events : self.coalesced += 1
+        events[key] = ( event, src, dst )
+
+    def forget(self, path):
+        # drop the watches of path and of its subdirectories (moved out of the tree)
+
+        prefix = path + os.sep
+
+        for p in [ p for p in self.dirs if p == path or p.startswith(prefix) ] :
+            wd = self.dirs.pop(p)
+            del self.wds[wd]
+            libc.inotify_rm_watch(self.fd, wd)
+
+    def join(self, timeout=None):
+        pass
+
+    def log_stats(self):
+
+        self.logger.info("sr_inotify %d directories watched, %d events in %d reads, %d coalesced, %d overflows" % \
+                        (len(self.dirs), self.nevents, self.reads, self.coalesced, self.overflows))
+
+    def read(self, events):
+        # read all the pending events, coalesced in events
+
+        if self.fd == None : return
+
+        moved = {}
+
+        while True :
+              try :
+                       buf = os.read(self.fd, self.bufsize)
+              except BlockingIOError :
+                       break
+
+              self.reads += 1
+              self.parse(buf, events, moved)
+
+              if len(buf) < self.bufsize // 2 : break
+
+        # moves not paired : moved out of the tree
+        # (with the events read meanwhile from its subdirectories)
+
+        for cookie in moved :
+            src, isdir = moved[cookie]
+            if isdir :
+               self.forget(src)
+               prefix = src + os.sep
+               for key in [ k for k in events if events[k][1].startswith(prefix) ] : del events[key]
+            self.event(events, 'delete', src, None)
+
+    def parse(self, buf, events, moved):
+
+        offset = 0
+        size   = len(buf)
+
+        while offset < size :
+              wd, mask, cookie, length = event_header.unpack_from(buf, offset)
+              offset += event_header.size
+              name    = buf[offset:offset+length].rstrip(b'\0')
+              offset += length
+
+              self.nevents += 1
+
+              if mask & IN_Q_OVERFLOW :
+                 self.overflows += 1
+                 self.logger.warning("sr_inotify events queue overflow, watched directories scanned")
+                 for path in list(self.dirs.keys()) : self.add_tree(path, events)
+                 continue
+
+              directory = self.wds.get(wd)
+              if directory == None : continue
+
+              if mask & IN_IGNORED :
+                 if self.dirs.get(directory) == wd : del self.dirs[directory]
+                 del self.wds[wd]
+                 continue
+
+              if not name : continue
+
+              path  = directory + os.sep + os.fsdecode(name)
+              isdir = mask & IN_ISDIR
+
+              if   mask & IN_MOVED_FROM :
+                   moved[cookie] = ( path, isdir )
+
+              elif mask & IN_MOVED_TO :
+                   if cookie in moved :
+                      src, srcdir = moved.pop(cookie)
+                      if isdir : self.rename(src, path)
+                      self.event(events, 'move', src, path)
+                   elif isdir :
+                      self.add_tree(path, events)
+                   else :
+                      self.event(events, 'create', path, None)
+
+              elif mask & IN_DELETE :
+                   self.event(events, 'delete', path, None)
+
+              elif isdir :
+                   if mask & IN_CREATE : self.add_tree(path, events)
+
+              elif mask & IN_CREATE :
+                   self.event(events, 'create', path, None)
+
+              elif mask & IN_WRITTEN :
+                   self.event(events, 'modify', path, None)
+
+    def rename(self, src, dst):
+        # a directory moved within the tree : its watches are the same, their paths change
+
+        prefix = src + os.sep
+
+        for p in [ p for p in self.dirs if p == src or p.startswith(prefix) ] :
+            wd = self.dirs.pop(p)
+            self.wds[wd] = dst + p[len(src):]
+            self.dirs[self.wds[wd]] = wd
+
+    def schedule(self, handler, path, recursive=True):
+        # events are not given to handler, they are read in sr_post.wakeup
+
+        self.add_tree(path)
+        self.logger.info("sr_inotify %s watched (%d directories)" % (path,len(self.dirs)))
+
+        return path
+
+    def start(self):
+        pass
+
+    def stop(self):
+        self.logger.debug("sr_inotify stop")
+
+        if self.fd == None : return
+
+        self.log_stats()
+
+        os.close(self.fd)
+        self.fd   = None
+        self.wds  = {}
+        self.dirs = {}
+
+    def unschedule(self, watch):
+        if self.fd != None : self.forget(watch)
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+#
+# This file is part of sarracenia.
+# The sarracenia suite is Free and is proudly provided by the Government of Canada
+# Copyright (C) Her Majesty The Queen in Right of Canada, Environment Canada, 2008-2015
+#
+# Questions or bugs report: dps-client@ec.gc.ca
+# sarracenia repository: git://git.code.sf.net/p/metpx/git
+# Documentation: http://metpx.sourceforge.net/#SarraDocumentation
+#
+# sr_matcher.py : python3 compiled accept/reject mask matching
+#
+########################################################################
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307  USA
+#
+#
+
+import re
+
+from collections import OrderedDict
+
+#============================================================
+# sr_matcher : accept/reject masks, first match wins.
+#
+# masks      : list of (pattern, maskDir, maskFileOption, mask_regexp, accepting)
+#              as built by sr_config.option
+#
+# prefixes   : the literal prefix of each mask (what is before the first
+#              regexp special character). A mask can only match a string
+#              starting with its prefix, so for the directory part of a string,
+#              only a few masks are candidates.
+#
+# runs       : consecutive candidates with the same action (accept or reject).
+#              it does not matter which mask of a run matches first for
+#              the decision, so each run is folded in one alternation
+#              (?P<m0>pattern0)|(?P<m1>pattern1)|... and the name of the
+#              group matched gives back the first matching mask.
+#
+# lru        : the runs of recent directories, bounded to lru_size entries.
+#
+
+class sr_matcher():
+
+    def __init__(self, masks, lru_size=1024 ):
+
+        self.masks     = masks
+        self.lru_size  = lru_size
+        self.lru       = OrderedDict()
+        self.folds     = OrderedDict()
+
+        self.hits      = 0
+        self.misses    = 0
+
+        self.prefixes  = [ self.literal_prefix(mask[0]) for mask in self.masks ]
+
+    def fold(self,run):
+        """
+           combine the masks of a run in one regexp, or None if they cannot be
+           (back references to group numbers, duplicated group names, inline flags...)
+           then the masks of the run are matched one by one.
+        """
+        if len(run) < 2 : return None
+
+        if run in self.folds :
+           self.folds.move_to_end(run)
+           return self.folds[run]
+
+        alternatives = []
+        regexp       = None
+        for i in run:
+            pattern = self.masks[i][0]
+            if re.search(r'\\[1-9]|\(\?P=',pattern) : break
+            alternatives.append( '(?P<m%d>%s)' % (i,pattern) )
+        else:
+            try   : regexp = re.compile('|'.join(alternatives))
+            except: regexp = None
+
+        self.folds[run] = regexp
+        if len(self.folds) > self.lru_size : self.folds.popitem(last=False)
+
+        return regexp
+
+    def literal_prefix(self,pattern):
+
+        # an alternation may match anything
+        if '|' in pattern : return ''
+
+        prefix = ''
+        for c in pattern:
+            if c in '.^$*+?{}[]\\|()' :
+               # an optional last character is not part of the prefix
+               if c in '*?{' and prefix != '' : prefix = prefix[:-1]
+               break
+            prefix += c
+
+        return prefix
+
+    def runs(self,dirname):
+        """
+           the runs of candidate masks for a string in dirname : 
+           [ (mask indexes, folded regexp or None), ... ]
+        """
+
+        if dirname in self.lru :
+           self.hits += 1
+           self.lru.move_to_end(dirname)
+           return self.lru[dirname]
+
+        self.misses += 1
+
+        runs = []
+        run  = []
+        for i,p in enumerate(self.prefixes):
+            if not dirname.startswith(p) and not p.startswith(dirname) : continue
+            if run and self.masks[run[-1]][4] != self.masks[i][4] :
+               runs.append( (tuple(run), self.fold(tuple(run))) )
+               run = []
+            run.append(i)
+        if run : runs.append( (tuple(run), self.fold(tuple(run))) )
+
+        self.lru[dirname] = runs
+        if len(self.lru) > self.lru_size : self.lru.popitem(last=False)
+
+        return runs
+
+    def match(self,chaine):
+        """
+           returns the index of the first mask matching chaine, or None.
+        """
+
+        dirname = chaine[:chaine.rfind('/')+1]
+
+        for run,regexp in self.runs(dirname):
+
+            if regexp :
+               m = regexp.match(chaine)
+               if m : return int(m.lastgroup[1:])
+               continue
+
+            for i in run:
+                if self.masks[i][3].match(chaine) : return i
+
+        return None
@@ -393,6 +393,11 @@ class sr_message():
 
         return ok
 
+    def publish_flush(self):
+        # in batch mode, publish staged messages now
+        if self.publisher == None : return True
+        return self.publisher.flush()
+
     def set_exchange(self,name):
         self.exchange = name
 
@@ -690,6 +690,9 @@ class sr_poll(sr_post):
                       #  do poll stuff
                       ok = self.__do_poll__()
 
+                      #  batch mode : dont keep posts staged while sleeping
+                      self.msg.publish_flush()
+
               except:
                       (stype, svalue, tb) = sys.exc_info()
                       self.logger.error("sr_poll/run Type: %s, Value: %s,  ..." % (stype, svalue))
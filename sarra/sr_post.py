@@ -38,7 +38,7 @@
 #
 #============================================================
 
-import json,os,random,sys,time
+import heapq,json,os,random,sys,time
 
 from collections import *
 
@@ -49,17 +49,25 @@ from watchdog.events            import PatternMatchingEventHandler
 try :    
          from sr_amqp            import *
          from sr_cache           import *
+         from sr_inotify         import *
          from sr_instances       import *
          from sr_message         import *
          from sr_rabbit          import *
+         from sr_sum_memo        import *
+         from sr_sum_pool        import *
          from sr_util            import *
+         from sr_walk            import *
 except : 
          from sarra.sr_amqp      import *
          from sarra.sr_cache     import *
+         from sarra.sr_inotify   import *
          from sarra.sr_instances import *
          from sarra.sr_message   import *
          from sarra.sr_rabbit    import *
+         from sarra.sr_sum_memo  import *
+         from sarra.sr_sum_pool  import *
          from sarra.sr_util      import *
+         from sarra.sr_walk      import *
 
 #============================================================
 
@@ -143,6 +151,7 @@ class sr_post(sr_instances):
            if not plugin(self): break
 
         if self.post_hc :
+           self.publisher.flush()
            self.post_hc.close()
            self.post_hc = None
 
@@ -150,10 +159,20 @@ class sr_post(sr_instances):
            self.cache.save()
            self.cache.close()
 
+        if hasattr(self,'sum_pool') and self.sum_pool :
+           self.sum_pool.log_stats()
+           self.sum_pool.close()
+
+        if hasattr(self,'memo') and self.memo :
+           self.memo.close()
+
+        self.walker = None
+
         if self.sleep > 0 and len(self.obs_watched):
            for ow in self.obs_watched:
                self.observer.unschedule(ow)
            self.observer.stop()
+           self.observer = None
 
         if self.restore_queue != None :
            self.publisher.restore_clear()
@@ -171,6 +190,22 @@ class sr_post(sr_instances):
 
         self.msg = sr_message(self)
 
+        # =============
+        # checksums of large files in processes
+        # =============
+
+        self.sum_pool = None
+        if self.sum_processes > 1 : self.sum_pool = sr_sum_pool(self)
+
+        # =============
+        # sums of the files posted, kept while they do not change
+        # =============
+
+        self.memo = None
+        if self.sum_memo :
+           self.memo = sr_sum_memo(self)
+           self.memo.open()
+
         # =============
         # posting 
         # =============
@@ -185,6 +220,8 @@ class sr_post(sr_instances):
         self.post_hc.connect()
 
         self.publisher = Publisher(self.post_hc)
+        if self.post_batch > 1 :
+           self.publisher.add_batch(self.post_batch,self.post_batch_interval)
         self.publisher.build()
 
         self.logger.info("Output AMQP broker(%s) user(%s) vhost(%s)" % \
@@ -333,13 +370,19 @@ class sr_post(sr_instances):
 
         self.post_hc       = None
 
+        self.observer      = None
         self.obs_watched   = []
         self.watch_handler = None
 
-        self.inl           = []
+        self.inl           = {}
+        self.walker        = None
         self.new_events    = OrderedDict()
         self.left_events   = OrderedDict()
 
+        self.inflight_events = {}
+        self.inflight_heap   = []
+        self.inflight_due    = 0
+
         self.blocksize     = 200 * 1024 * 1024
 
     # =============
@@ -360,6 +403,7 @@ class sr_post(sr_instances):
         age = time.time() - lstat[stat.ST_MTIME]
         if age < self.inflight :
            self.logger.debug("%d vs (inflight setting) %d seconds. Too New!" % (age,self.inflight) )
+           self.inflight_due = lstat[stat.ST_MTIME] + self.inflight
            return True
 
         return False
@@ -425,6 +469,10 @@ class sr_post(sr_instances):
 
         if self.path_rejected (path): return False
 
+        # a file removed (not moved) is forgotten by the memo
+
+        if key == None and self.memo : self.memo.invalidate(path)
+
         # post_init (message)
         self.post_init(path,None)
 
@@ -510,10 +558,22 @@ class sr_post(sr_instances):
            self.set_sumalgo(sumflg)
            sumalgo = self.sumalgo
            sumalgo.set_path(path)
+           sumstr  = None
 
-           # compute checksum
+           # checksum of a file that did not change since it was computed
 
-           if sumflg in ['d','s'] :
+           if sumflg in ['d','s'] and self.memo :
+              sums = self.memo.get(path,lstat,sumflg,0)
+              if sums : sumstr = sums[0]
+
+           # compute checksum, from a mmap of the file if it is large
+
+           if sumstr : pass
+
+           elif sumflg in ['d','s'] and self.sum_pool and self.sum_pool.accepts(sumflg,fsiz) :
+              sumstr = self.sum_pool.file_sum(path,sumflg,fsiz)
+
+           elif sumflg in ['d','s'] :
 
               fp = open(path,'rb')
               i  = 0
@@ -526,8 +586,11 @@ class sr_post(sr_instances):
 
            # setting sumstr
 
-           checksum = sumalgo.get_value()
-           sumstr   = '%s,%s' % (sumflg,checksum)
+           if not sumstr :
+              checksum = sumalgo.get_value()
+              sumstr   = '%s,%s' % (sumflg,checksum)
+
+           if sumflg in ['d','s'] and self.memo : self.memo.put(path,lstat,sumflg,0,[sumstr])
 
         # caching
 
@@ -577,14 +640,67 @@ class sr_post(sr_instances):
         remainder   =     fsiz%chunksize
         if remainder > 0 : block_count = block_count + 1
 
-        # default sumstr
+        # block checksums : from the memo if the file did not change,
+        # by the processes of the sum_pool for large files
 
-        sumstr = self.sumflg
+        sumflg = self.sumflg
+        if not self.sumflg[0] in ['0','d','n','s','z' ]: sumflg = 'd'
+
+        memo = sumflg in ['d','s'] and self.memo
+        sums = None
+
+        if memo : 
+           memo_sums = self.memo.get(path,lstat,sumflg,chunksize)
+           if memo_sums : sums = enumerate(memo_sums)
+
+        if sums == None :
+           if self.sum_pool and self.sum_pool.accepts(sumflg,fsiz) :
+              sums = self.sum_pool.block_sums(path,sumflg,chunksize,block_count,remainder)
+           else :
+              sums = self.block_sums(path,chunksize,block_count,remainder)
+           if memo : sums = self.memo.collect(path,lstat,sumflg,chunksize,block_count,sums)
 
         # loop on chunks
 
-        i = 0
         #self.logger.debug("block_count = %d" % block_count)
+        for current_block,sumstr in sums :
+
+              # set partstr
+
+              partstr = 'i,%d,%d,%d,%d' %\
+                        (chunksize,block_count,remainder,current_block)
+
+              # caching
+
+              if self.caching :
+                 new_post = self.cache.check(str(sumstr),self.post_relpath,partstr)
+                 if new_post : self.logger.info("caching %s (%s)"% (path,partstr) )
+                 else        :
+                               self.logger.debug("already posted %s (%s)"%(path,partstr) )
+                               continue
+
+              # complete  message
+
+              self.msg.headers['parts'] = partstr
+              self.msg.headers['sum']   = sumstr
+
+              # post message
+
+              ok = self.__on_post__()
+
+        return True
+
+    # =============
+    # block_sums : generator of the sumstr of each block, one after the other
+    # =============
+
+    def block_sums(self, path, chunksize, block_count, remainder):
+
+        # default sumstr
+
+        sumstr = self.sumflg
+
+        i = 0
         while i < block_count :
 
               # setting sumalgo for that part
@@ -612,11 +728,6 @@ class sr_post(sr_instances):
               if last and remainder > 0 :
                  length = remainder
 
-              # set partstr
-
-              partstr = 'i,%d,%d,%d,%d' %\
-                        (chunksize,block_count,remainder,current_block)
-
               # compute checksum if needed
 
               if not self.sumflg in ['0','n','z'] :
@@ -636,30 +747,12 @@ class sr_post(sr_instances):
                  checksum = sumalgo.get_value()
                  sumstr   = '%s,%s' % (sumflg,checksum)
 
-              # caching
-
-              if self.caching :
-                 new_post = self.cache.check(str(sumstr),self.post_relpath,partstr)
-                 if new_post : self.logger.info("caching %s (%s)"% (path,partstr) )
-                 else        :
-                               self.logger.debug("already posted %s (%s)"%(path,partstr) )
-                               continue
-
-              # complete  message
-
-              self.msg.headers['parts'] = partstr
-              self.msg.headers['sum']   = sumstr
-
-              # post message
-
-              ok = self.__on_post__()
+              yield current_block, sumstr
 
               # increment count
 
               i = i + 1
 
-        return True
-
     # =============
     # post_file_part
     # =============
@@ -932,33 +1025,34 @@ class sr_post(sr_instances):
               ok = self.post1move(src,dst)
            return done
 
-        # create or modify
+        # create or modify : one lstat tells what src is
+        # file : must exists
+        #       (may have been deleted since event caught)
+
+        try    : lstat = os.lstat(src)
+        except : return done
 
         # directory : skipped, its content is watched
 
-        if os.path.isdir(src): return done
+        if stat.S_ISDIR(lstat.st_mode) : return done
 
         # link ( os.path.exists = false, lstat = None )
+        # (a link to a directory is skipped as the directory)
 
-        if os.path.islink(src) :
+        if stat.S_ISLNK(lstat.st_mode) :
+           if os.path.isdir(src) : return done
            if 'link' in self.events :
               ok = self.post1file(src,None)
            return done
 
-        # file : must exists
-        #       (may have been deleted since event caught)
-
-        if not os.path.exists(src) : return done
-
         # file : must be old enough
 
-        lstat = os.stat(src)
         if self.path_inflight(src,lstat): return later
 
-        # post it
+        # post it (not a link : lstat is its stat, no need for post1file checks)
 
-        if self.create_modify :
-           ok = self.post1file(src,lstat)
+        if self.create_modify and stat.S_ISREG(lstat.st_mode) :
+           ok = self.post_file(src.replace(os.sep + '.' + os.sep, os.sep), lstat)
 
         return done
 
@@ -1038,6 +1132,9 @@ class sr_post(sr_instances):
         #     these lists might need to be replaced with watchdog event queues.
         #     left for later work. PS-20170105
         #     more details: https://github.com/gorakhargosh/watchdog/issues/392
+        #     (not with option inotify : the events are read here, in this thread)
+
+        if isinstance(self.observer,sr_inotify) : self.observer.read(self.new_events)
 
         # on_watch 
 
@@ -1045,10 +1142,25 @@ class sr_post(sr_instances):
         if not ok : return
 
         # pile up left events to process
+        # (a new event for a file waiting to be old enough replaces its wait)
+
+        for key in self.new_events :
+            if key in self.inflight_events : del self.inflight_events[key]
 
         self.left_events.update(self.new_events)
         self.new_events = OrderedDict()
 
+        # files that became old enough (inflight) are processed again
+
+        now  = time.time()
+        heap = self.inflight_heap
+        while len(heap) > 0 and heap[0][0] <= now :
+              due, key = heapq.heappop(heap)
+              entry    = self.inflight_events.get(key)
+              if entry == None or entry[0] != due : continue
+              del self.inflight_events[key]
+              self.left_events[key] = entry[1]
+
         # work with a copy events and keep done events (to delete them)
 
         self.done_events = []
@@ -1064,7 +1176,16 @@ class sr_post(sr_instances):
         for key in self.cur_events:
             event, src, dst = self.cur_events[key]
             done = self.process_event( event, src, dst )
-            if done : self.left_events.pop(key) 
+            self.left_events.pop(key) 
+            if done : continue
+
+            # too new : not looked at again before it is old enough
+
+            self.inflight_events[key] = ( self.inflight_due, self.cur_events[key] )
+            heapq.heappush(self.inflight_heap, (self.inflight_due, key))
+
+        # batch mode : dont keep posts staged while sleeping
+        self.msg.publish_flush()
 
         # heartbeat
         self.heartbeat_check()
@@ -1083,18 +1204,30 @@ class sr_post(sr_instances):
         if os.path.islink(src) and self.realpath :
            src = os.path.realpath(src)
 
-        # walk src directory, this walk is depth first... there could be a lot of time
-        # between *listdir* run, and when a file is visited, if there are subdirectories before you get there.
-        # hence the existence check after listdir (crashed in flow_tests of > 20,000)
-        for x in os.listdir(src):
-            path = src + os.sep + x
-            if os.path.isdir(path):
-               self.walk(path)
-               continue
+        # walk src directory (sr_walk : scandir, no recursion, walk_threads listing)
+        # there could be a lot of time between a directory listing and when a file
+        # is posted, files that vanished meanwhile are skipped
+        # (crashed in flow_tests of > 20,000)
 
-            # add path created
-            if os.path.exists(path):
-                self.post1file(path,os.stat(path))
+        if self.walker == None : self.walker = sr_walk(self)
+
+        files = self.walker.walk(src)
+
+        try :
+                for path, lstat, isfile in files :
+
+                    # regular file : lstat from the listing, no more stat
+                    if isfile :
+                       try   : self.post_file(path.replace(os.sep + '.' + os.sep, os.sep), lstat)
+                       except FileNotFoundError : self.logger.debug("walk %s vanished" % path)
+                       continue
+
+                    # link
+                    self.post1file(path,lstat)
+
+        # posting raised : the walk (and its listing threads) is stopped
+        finally :
+                files.close()
 
     # =============
     # original walk_priming
@@ -1153,7 +1286,12 @@ class sr_post(sr_instances):
         if self.force_polling :
            self.logger.info("sr_watch polling observer overriding default (slower but more reliable.)")
            self.observer = PollingObserver()
+        elif self.inotify and sr_inotify.available() :
+           if not isinstance(self.observer,sr_inotify) :
+              self.logger.info("sr_watch native inotify observer selected (events read in batches, coalesced.)")
+              self.observer = sr_inotify(self)
         else:
+           if self.inotify : self.logger.warning("sr_watch inotify not available on this platform")
            self.logger.info("sr_watch optimal observer for platform selected (best when it works).")
            self.observer = Observer()
 
@@ -1305,8 +1443,8 @@ class sr_post(sr_instances):
     def run(self):
         self.logger.info("%s run partflg=%s, sum=%s, caching=%s " % \
               ( self.program_name, self.partflg, self.sumflg, self.caching ))
-        self.logger.info("%s realpath=%s follow_links=%s force_polling=%s"  % \
-              ( self.program_name, self.realpath, self.follow_symlinks, self.force_polling ) )
+        self.logger.info("%s realpath=%s follow_links=%s force_polling=%s inotify=%s walk_threads=%d"  % \
+              ( self.program_name, self.realpath, self.follow_symlinks, self.force_polling, self.inotify, self.walk_threads ) )
 
         self.connect()
 
@@ -1314,6 +1452,9 @@ class sr_post(sr_instances):
            self.cache.close(unlink=True)
            self.cache.open()
 
+        if self.reset and self.memo :
+           self.memo.clear()
+
         pbd = self.post_base_dir
 
         for plugin in self.on_start_list:
@@ -30,7 +30,7 @@
 #  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307  USA
 #
 
-import os,json,sys,time
+import heapq,os,json,sys,time
 
 try :
          from sr_config          import *
@@ -39,74 +39,229 @@ except :
          from sarra.sr_config    import *
          from sarra.sr_util      import *
 
-# class sr_retry
+#============================================================
+# sr_retry : messages that failed, to be retried later.
+#
+# segments   : retry_path.000001, retry_path.000002 ... append only files,
+#              one json line per record
+#              [ topic, headers, notice, { "id":id, "attempts":n, "next":time } ]
+#              a message that fails again is appended again with the same id,
+#              more attempts and a later next time : the last line of an id wins.
+#              a message done (or expired) appends a tombstone
+#              [ topic, { "_retry_tag_":"done" }, notice, { "id":id } ]
+#              every line is flushed when written, a partial line left by a
+#              crash is removed when loading.
+#              lines are appended to the last segment, a new one is started
+#              at every heartbeat, or after segment_lines lines.
+#
+# live       : { segment : number of records in it that are the last line of their id }
+# newest     : { segment : time of the newest notice in it }
+#
+#              at heartbeat, a segment where all notices are older than retry_ttl,
+#              or without live records and older than all the others, is deleted :
+#              the records themselves are never read or written again.
+#
+# heap       : [ (next, id, segment, offset), ... ] index of the records waiting,
+#              ordered by next attempt time, offset is where the record is
+#              in its segment. get() only pops records that are due.
+#              it is rebuilt from the segments when starting.
+#
+# inflight   : { id : (segment,offset) } records returned by get, not yet done or failed.
+#              a record still inflight at two heartbeats in a row was dropped
+#              by the caller (rejected by accept/reject...) : it is done.
+#
+# backoff    : the delay before the next attempt doubles at every attempt
+#              from retry_backoff up to retry_backoff_max.
+#
+# older versions used retry_path (a single file, or read while .new
+# and .state were appended). retry_path is taken as the first segment,
+# the lines without id are taken as new records when loading.
+#
 
 class sr_retry:
     def __init__(self, parent ):
         parent.logger.debug("sr_retry __init__")
 
-        self.logger     = parent.logger
-        self.parent     = parent
+        self.logger        = parent.logger
+        self.parent        = parent
 
-        self.retry_ttl  = self.parent.retry_ttl
+        self.retry_ttl     = self.parent.retry_ttl
 
-        self.activity   = True
+        self.backoff_min   = self.parent.retry_backoff
+        self.backoff_max   = self.parent.retry_backoff_max
+
+        self.activity      = True
 
         # message to work with
 
-        self.message    = raw_message(self.logger)
-        self.last_body  = None
+        self.message       = raw_message(self.logger)
+
+        # index
+
+        self.heap          = []
+        self.inflight      = {}
+        self.inflight_seen = set()
+        self.next_id       = 1
+
+        # segments
+
+        self.segment_lines = 100000
+        self.segments      = []
+        self.live          = {}
+        self.newest        = {}
+        self.lines         = 0
+
+        self.log_fp        = None
+        self.read_fp       = None
+        self.read_seg      = None
 
         # initialize all retry path if retry_path is provided
 
         if hasattr(self.parent,'retry_path') : self.init()
 
+    def add_msg_to_new_file(self,message):
+        #self.logger.debug("DEBUG add new retry %s" % message.body)
+
+        id = self.next_id
+        self.next_id += 1
+
+        self.schedule(message,id,1)
+
     def add_msg_to_state_file(self,message,done=False):
-        #self.logger.debug("DEBUG add to state file %s %s %s" % (os.path.basename(self.state_path),message.body,done))
-        self.state_fp = self.msg_append_to_file(self.state_fp,self.state_path,message,done)
-        # performance issue... only do before close
-        #os.fsync(self.state_fp)
+        #self.logger.debug("DEBUG add retry state %s %s" % (message.body,done))
 
-    def add_msg_to_new_file(self,message):
-        #self.logger.debug("DEBUG add to new file %s %s" % (os.path.basename(self.new_path),message.body))
-        self.new_fp = self.msg_append_to_file(self.new_fp,self.new_path,message)
-        # performance issue... only do before close
-        #os.fsync(self.new_fp)
+        id = getattr(message,'retry_id',None)
+
+        # not from the retry list... a new one
+        if id == None or not id in self.inflight :
+           if not done : self.add_msg_to_new_file(message)
+           return
+
+        # the record in its segment is replaced by the new line
+
+        seg, offset = self.inflight.pop(id)
+        if seg in self.live : self.live[seg] -= 1
+
+        if done : self.tombstone(message,id)
+        else    : self.schedule(message,id,message.retry_attempts+1)
+
+    def append(self,line):
+        # append a line to the last segment, return its segment and offset
+
+        if self.log_fp == None or self.lines >= self.segment_lines :
+           self.new_segment()
+
+        seg    = self.segments[-1]
+        offset = self.log_fp.tell()
+        self.log_fp.write(line.encode('utf-8'))
+        self.log_fp.flush()
+
+        self.lines   += 1
+        self.activity = True
+
+        return seg, offset
+
+    def backoff(self,attempts):
+        return min( self.backoff_max, self.backoff_min * ( 2 ** min(attempts-1,32) ) )
 
     def close(self):
-        self.last_body = None
-        try   : self.heart_fp.close()
-        except: pass
         try   :
-                os.fsync(self.new_fp)
-                self.new_fp.close()
-        except: pass
-        try   : self.retry_fp.close()
+                os.fsync(self.log_fp)
+                self.log_fp.close()
         except: pass
-        try   : 
-                os.fsync(self.state_fp)
-                self.state_fp.close()
+        try   : self.read_fp.close()
         except: pass
-        self.heart_fp = None
-        self.new_fp   = None
-        self.retry_fp = None
-        self.state_fp = None
+        self.log_fp   = None
+        self.read_fp  = None
+        self.read_seg = None
+
+    def decode(self, line, message=None ):
+        if message == None : message = self.message
 
-    def decode(self, line ):
         try:
-            topic, headers, notice = json.loads(line)
+            record = json.loads(line)
+            topic, headers, notice = record[:3]
         except:
             self.logger.error("corrupted line in retry file: %s " % line)
             return None
 
-        self.message.delivery_info['exchange']         = self.parent.exchange
-        self.message.delivery_info['routing_key']      = topic
-        self.message.properties['application_headers'] = headers
-        self.message.body                              = notice
+        message.delivery_info['exchange']         = self.parent.exchange
+        message.delivery_info['routing_key']      = topic
+        message.properties['application_headers'] = headers
+        message.body                              = notice
+
+        # retry schedule (none in lines of older versions)
+
+        meta = {}
+        if len(record) > 3 : meta = record[3]
+
+        message.retry_id       = meta.get('id',None)
+        message.retry_attempts = meta.get('attempts',1)
+        message.retry_next     = meta.get('next',0.0)
+
+        return message
+
+    def drop_abandoned(self):
+        """
+           records returned by get already inflight at the previous heartbeat
+           were dropped by the caller without msg_worked or msg_to_retry
+           (rejected by accept/reject...) : they are done, so their segment
+           can be deleted.
+        """
+
+        abandoned = [ id for id in self.inflight if id in self.inflight_seen ]
+
+        for id in abandoned :
+            seg, offset = self.inflight.pop(id)
+            if not seg in self.live : continue
+
+            self.live[seg] -= 1
+
+            # read in a message of its own : the one returned by get may still be in use
+
+            message = self.read(seg,offset,raw_message(self.logger))
+            if message != None : self.tombstone(message,id)
+
+        if abandoned :
+           self.logger.info("sr_retry %d messages never done nor failed, dropped" % len(abandoned))
 
-        return self.message
+        self.inflight_seen = set(self.inflight)
 
-    def encode(self, message, done=False ):
+    def drop_segments(self):
+        """
+           delete the segments with all notices expired, and the first 
+           segments without live records. A segment without live records
+           after one still there is kept : its tombstones are needed when loading.
+           records of deleted segments left in the heap are skipped by get.
+        """
+
+        now = time.time()
+
+        for seg in list(self.segments) :
+            if self.log_fp != None and seg == self.segments[-1] : continue
+
+            expired = self.retry_ttl != None and self.retry_ttl > 0 and \
+                      now - self.newest.get(seg,0.0) > self.retry_ttl
+
+            consumed = self.live.get(seg,0) == 0 and seg == self.segments[0]
+
+            if not consumed and not expired : continue
+
+            #self.logger.debug("DEBUG drop segment %d live %d" % (seg,self.live.get(seg,0)))
+
+            if seg == self.read_seg :
+               self.read_fp.close()
+               self.read_fp  = None
+               self.read_seg = None
+
+            try   : os.unlink(self.segment_path(seg))
+            except: pass
+
+            self.segments.remove(seg)
+            self.live.pop(seg,None)
+            self.newest.pop(seg,None)
+
+    def encode(self, message, done=False, meta=None ):
         topic   = message.delivery_info['routing_key']
         headers = message.properties['application_headers']
         notice  = message.body
@@ -117,73 +272,54 @@ class sr_retry:
            headers = {}
            headers['_retry_tag_'] = 'done'
 
-        json_line = json.dumps( [ topic, headers, notice ], sort_keys=True ) + '\n' 
+        record = [ topic, headers, notice ]
+        if meta != None : record.append(meta)
+
+        json_line = json.dumps( record, sort_keys=True ) + '\n' 
 
         return json_line
 
     def get(self):
-        ok = False
 
-        while not ok :
-              ok, message = self.get_retry()
+        # the records that are due, in next attempt order
 
-        self.activity = True
+        now = time.time()
 
-        return message
+        while len(self.heap) > 0 and self.heap[0][0] <= now :
+              next, id, seg, offset = heapq.heappop(self.heap)
 
-    def get_retry(self):
-        self.retry_fp, message = self.msg_get_from_file(self.retry_fp, self.retry_path)
+              # segment dropped (expired)
+              if not seg in self.live : continue
 
-        # FIXME MG as discussed with Peter
-        # no heartbeat in get ...
-        # if no message (and new or state file there)
-        # we wait for heartbeat to present retry messages
-        self.last_message = message
+              message = self.read(seg,offset)
+              if message == None : continue
 
-        if not message :
-           try   : os.unlink(self.retry_path)
-           except: pass
-           self.retry_fp = None
-           #self.logger.debug("MG DEBUG retry get return None")
-           return True,None
+              self.inflight[id] = (seg,offset)
 
-        self.last_message = message.body
+              # validation
 
-        # validation
-
-        if not self.is_valid(message):
-           #self.logger.error("MG invalid %s" % message.body)
-           return False,None
+              if not self.is_valid(message):
+                 self.add_msg_to_state_file(message,done=True)
+                 continue
 
-        #self.logger.error("MG return %s" % message.body)
-        message.isRetry = True
+              message.isRetry = True
+              self.activity   = True
+              return message
 
-        return True,message
+        return None
 
     def init(self):
 
-        # retry messages
+        # retry segments
 
         self.retry_path = self.parent.retry_path
-        self.retry_work = self.retry_path        + '.work'
-        self.retry_fp   = None
 
-        # newer retries
+        # files of older versions
 
         self.new_path   = self.parent.retry_path + '.new'
-        self.new_work   = self.new_path          + '.work'
-        self.new_fp     = None
-
-        # state retry messages
-
         self.state_path = self.parent.retry_path + '.state'
-        self.state_work = self.state_path        + '.work'
-        self.state_fp   = None
 
-        # working file at heartbeat
-
-        self.heart_path = self.parent.retry_path + '.heart'
-        self.heart_fp   = None
+        self.load()
 
     def is_done(self,message):
         headers = message.properties['application_headers']
@@ -225,6 +361,115 @@ class sr_retry:
 
         return True
 
+    def load(self):
+        """
+           build the index from the segments : the last line of an id wins,
+           tombstones remove it. lines without id (older versions) are
+           appended back as new records.
+        """
+        self.logger.debug("sr_retry load")
+
+        self.close()
+
+        # retry_path of older versions is the first segment
+
+        dirname, basename = os.path.split(self.retry_path)
+
+        if os.path.isfile(self.retry_path) :
+           os.rename(self.retry_path,self.segment_path(0))
+
+        self.segments = []
+        for f in os.listdir(dirname) :
+            suffix = f[len(basename)+1:]
+            if f.startswith(basename + '.') and len(suffix) == 6 and suffix.isdigit() :
+               self.segments.append(int(suffix))
+        self.segments.sort()
+
+        records = {}
+        older   = []
+
+        self.live   = {}
+        self.newest = {}
+
+        for seg in self.segments :
+            self.live[seg]   = 0
+            self.newest[seg] = 0.0
+
+            fp     = open(self.segment_path(seg),'rb')
+            offset = 0
+            while True :
+                  line = fp.readline()
+                  if not line : break
+
+                  pos     = offset
+                  offset += len(line)
+
+                  # partial line written when crashing : removed
+
+                  if not line.endswith(b'\n') :
+                     self.logger.warning("sr_retry partial line removed from %s" % self.segment_path(seg))
+                     fp.close()
+                     fp = open(self.segment_path(seg),'r+b')
+                     fp.truncate(pos)
+                     break
+
+                  message = self.decode(line.decode('utf-8','replace'))
+                  if message == None : continue
+
+                  id = message.retry_id
+                  if id == None :
+                     older.append(line.decode('utf-8'))
+                     continue
+
+                  if id >= self.next_id : self.next_id = id + 1
+
+                  # the previous line of this id is no more live
+
+                  if id in records : self.live[records[id][2]] -= 1
+
+                  self.newest[seg] = max( self.newest[seg], self.notice_time(message) )
+
+                  if self.is_done(message) :
+                     records.pop(id,None)
+                     continue
+
+                  records[id] = (message.retry_next,id,seg,pos)
+                  self.live[seg] += 1
+            fp.close()
+
+        self.heap          = list(records.values())
+        self.inflight      = {}
+        self.inflight_seen = set()
+        heapq.heapify(self.heap)
+
+        # lines of older versions : retry, new and state files
+
+        for path in [ self.new_path, self.state_path ] :
+            fp = None
+            while os.path.isfile(path) :
+                  fp, message = self.msg_get_from_file(fp, path)
+                  if not message : break
+                  older.append(self.encode(message,self.is_done(message)))
+            if os.path.isfile(path) : os.unlink(path)
+
+        # a done line (in state) was for the same notice in retry
+
+        if older :
+           done = set()
+           for line in older :
+               message = self.decode(line)
+               if message != None and self.is_done(message) : done.add(message.body)
+
+           self.logger.info("sr_retry %d lines from an older version" % len(older))
+           for line in older :
+               message = self.decode(line)
+               if message == None or message.body in done : continue
+               self.add_msg_to_new_file(message)
+
+        self.drop_segments()
+
+        self.logger.debug("sr_retry loaded %d messages" % len(self.heap))
+
     def msg_append_to_file(self,fp,path,message,done=False):
         if fp == None :
            present = os.path.isfile(path)
@@ -263,168 +508,101 @@ class sr_retry:
 
         return fp,msg
 
+    def new_segment(self):
+        # following lines go to a new segment
+
+        if self.log_fp != None :
+           os.fsync(self.log_fp)
+           self.log_fp.close()
+
+        seg = 1
+        if self.segments : seg = self.segments[-1] + 1
+
+        self.segments.append(seg)
+        self.live[seg]   = 0
+        self.newest[seg] = 0.0
+
+        self.log_fp = open(self.segment_path(seg),'ab')
+        self.lines  = 0
+
+    def notice_time(self,message):
+        try   : return timestr2flt(message.body.split()[0])
+        except: return time.time()
+
     def on_heartbeat(self,parent):
         self.logger.info("sr_retry on_heartbeat")
 
+        self.drop_abandoned()
+
         if not self.activity : return
 
-        now          = time.time()
-        marker_body  = self.last_body
-        marker_valid = marker_body != None
-        #self.logger.debug("marker_body1 = %s" % marker_body)
+        now = time.time()
 
         # put this in try/except in case ctrl-c breaks something
 
         try:
-             self.close()
-             try   : os.unlink(self.heart_path)
-             except: pass
-             fp = open(self.heart_path,'w')
-             fp.close()
-
-             # rename to working file to avoid corruption
-
-             if not os.path.isfile(self.retry_work) :
-                fp = open(self.retry_work,'w')
-                fp.close()
-                if os.path.isfile(self.retry_path) : os.rename(self.retry_path,self.retry_work)
-
-             if not os.path.isfile(self.state_work):
-                fp = open(self.state_work,'w')
-                fp.close()
-                if os.path.isfile(self.state_path) : os.rename(self.state_path,self.state_work)
-
-             if not os.path.isfile(self.new_work):
-                fp = open(self.new_work,'w')
-                fp.close()
-                if os.path.isfile(self.new_path) : os.rename(self.new_path,self.new_work)
-
-             # state to heart
-
-             #self.logger.debug("MG DEBUG has state %s" % os.path.isfile(self.state_path))
-     
-             i    = 0
-             N    = 0
-             last = None
-
-             fp   = None
-             while True:
-                   fp, message = self.msg_get_from_file(fp, self.state_work)
-                   if not message : break
-                   i = i + 1
-                   last  = message.body
-                   valid = self.is_valid(message)
-                   if not valid: continue
-                   #self.logger.debug("DEBUG flush retry to state %s" % message.body)
-                   self.heart_fp = self.msg_append_to_file(self.heart_fp,self.heart_path,message)
-                   N = N + 1
-             try   : fp.close()
-             except: pass
-
-             if not marker_body and last :
-                marker_body  = last
-                marker_valid = valid
-             #self.logger.debug("marker_body2 = %s" % marker_body)
-
-             #self.logger.debug("MG DEBUG took %d out of the %d state" % (N,i))
-
-             # remaining of retry to heart
-     
-             #self.logger.debug("MG DEBUG has retry %s" % os.path.isfile(self.retry_path))
-     
-             i   = 0
-             j   = N
-
-             fp   = None
-             while True:
-                   fp, message = self.msg_get_from_file(fp, self.retry_work)
-                   if not message : break
-                   i = i + 1
-                   if marker_body :
-                      if marker_body != message.body : continue
-                      marker_body = None
-                      continue
-                   if not self.is_valid(message): continue
-                   #self.logger.debug("MG DEBUG flush retry to state %s" % message.body)
-                   self.heart_fp = self.msg_append_to_file(self.heart_fp,self.heart_path,message)
-                   N = N + 1
-             try   : fp.close()
-             except: pass
-
-             #self.logger.debug("MG DEBUG took %d out of the %d retry" % (N-j,i))
-     
-             # new to heart
-     
-             #self.logger.debug("MG DEBUG has new %s" % os.path.isfile(self.new_path))
-     
-             i   = 0
-             j   = N
-
-             fp   = None
-             while True:
-                   fp, message = self.msg_get_from_file(fp, self.new_work)
-                   if not message : break
-                   i = i + 1
-                   if not self.is_valid(message): continue
-                   #self.logger.debug("MG DEBUG flush retry to state %s" % message.body)
-                   self.heart_fp = self.msg_append_to_file(self.heart_fp,self.heart_path,message)
-                   N = N + 1
-             try   : fp.close()
-             except: pass
-     
-             #self.logger.debug("MG DEBUG took %d out of the %d new" % (N-j,i))
-     
-             # close heart
-     
-             try   : close(self.heart_fp)
-             except: pass
+             # lines now go to a new segment, so the last one can be dropped too
+
+             if self.log_fp != None :
+                os.fsync(self.log_fp)
+                self.log_fp.close()
+                self.log_fp = None
+
+             self.drop_segments()
 
         except:
                 self.logger.error("on_heartbeat something went wrong")
                 (stype, svalue, tb) = sys.exc_info()
                 self.logger.error("Type: %s, Value: %s,  ..." % (stype, svalue))
 
+        count = sum(self.live.values())
+
         # no more retry
 
-        if N == 0 :
+        if count == 0 :
            self.logger.info("No retry in list")
-           try   : os.unlink(self.heart_path)
-           except: pass
-
-
-        # heartbeat file becomes new retry
 
         else:
-           self.logger.info("Number of messages in retry list %d" % N)
-           try   : os.rename(self.heart_path,self.retry_path)
-           except: 
-                   self.logger.error("Something went wrong with rename")
-
-        # cleanup
-        try   : os.unlink(self.state_work)
-        except: pass
-        try   : os.unlink(self.retry_work)
-        except: pass
-        try   : os.unlink(self.new_work)
-        except: pass
+           self.logger.info("Number of messages in retry list %d (%d segments)" % (count,len(self.segments)))
 
-        self.last_body = None
         self.activity  = False
         elapse         = time.time()-now
         self.logger.info("sr_retry on_heartbeat elapse %f" % elapse)
 
     def on_start(self,parent):
         self.logger.info("sr_retry on_start")
-        
-        if not os.path.isfile(self.retry_path): return
 
-        retry_age = os.stat(self.retry_path)[stat.ST_MTIME]
+    def read(self,seg,offset,message=None):
+        # decode the record at offset in segment
+
+        if self.read_seg != seg :
+           if self.read_fp != None : self.read_fp.close()
+           self.read_fp  = open(self.segment_path(seg),'rb')
+           self.read_seg = seg
+
+        self.read_fp.seek(offset)
+        line = self.read_fp.readline()
+
+        return self.decode(line.decode('utf-8','replace'),message)
+
+    def schedule(self,message,id,attempts):
+        # append a record, due after its backoff
+
+        next        = time.time() + self.backoff(attempts)
+        meta        = { 'id':id, 'attempts':attempts, 'next':next }
+        seg, offset = self.append( self.encode(message,meta=meta) )
+
+        self.live[seg]  += 1
+        self.newest[seg] = max( self.newest[seg], self.notice_time(message) )
+
+        heapq.heappush(self.heap, (next,id,seg,offset) )
 
-        if os.path.isfile(self.state_path):
-           state_age = os.stat(self.state_path)[stat.ST_MTIME]
-           if retry_age > state_age : os.unlink(self.state_path)
+        self.logger.debug("sr_retry attempt %d in %d sec %s" % (attempts,next-time.time(),message.body))
 
-        if os.path.isfile(self.new_path):
-           new_age = os.stat(self.new_path)[stat.ST_MTIME]
-           if retry_age > new_age : os.unlink(self.new_path)
+    def segment_path(self,seg):
+        return self.retry_path + '.%.6d' % seg
 
+    def tombstone(self,message,id):
+        # the segment is kept while the notice of its tombstones is not expired
+        seg, offset = self.append( self.encode(message,done=True,meta={ 'id':id }) )
+        self.newest[seg] = max( self.newest[seg], self.notice_time(message) )
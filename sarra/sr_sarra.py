@@ -172,6 +172,29 @@ class sr_sarra(sr_subscribe):
         if self.retry_mode :
            self.execfile("plugin",'hb_retry')
 
+        # circuit breaker per remote host
+
+        self.breaker = None
+        if self.breaker_threshold > 0 :
+           self.breaker = sr_breaker(self)
+           self.execfile("on_heartbeat",'hb_breaker')
+
+        # bandwidth shared by the instances of the config, and by the processes of the host
+
+        if hasattr(self,'bandwidth') and self.bandwidth : self.bandwidth.close()
+        self.bandwidth = None
+        if self.bandwidth_shared and ( self.kbytes_ps > 0 or self.kbytes_ps_host > 0 ) :
+           self.bandwidth = sr_bandwidth(self)
+           self.execfile("on_heartbeat",'hb_bandwidth')
+
+        # downloads in worker threads
+
+        if hasattr(self,'download_pool') and self.download_pool : self.download_pool.close()
+        self.download_pool = None
+        if self.download_threads > 1 :
+           self.download_pool = sr_download_pool(self)
+           self.execfile("on_heartbeat",'hb_download')
+
 
         # default reportback if unset
 
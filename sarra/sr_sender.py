@@ -132,7 +132,8 @@ class sr_sender(sr_subscribe):
         # caching
 
         if self.caching :
-           self.cache      = sr_cache(self)
+           if self.cache_shared : self.cache = sr_shared_cache(self)
+           else                 : self.cache = sr_cache(self)
            self.cache_stat = True
            self.cache.open()
 
@@ -177,6 +178,21 @@ class sr_sender(sr_subscribe):
         if self.retry_mode :
            self.execfile("plugin",'hb_retry')
 
+        # circuit breaker per remote host
+
+        self.breaker = None
+        if self.breaker_threshold > 0 :
+           self.breaker = sr_breaker(self)
+           self.execfile("on_heartbeat",'hb_breaker')
+
+        # bandwidth shared by the instances of the config, and by the processes of the host
+
+        if hasattr(self,'bandwidth') and self.bandwidth : self.bandwidth.close()
+        self.bandwidth = None
+        if self.bandwidth_shared and ( self.kbytes_ps > 0 or self.kbytes_ps_host > 0 ) :
+           self.bandwidth = sr_bandwidth(self)
+           self.execfile("on_heartbeat",'hb_bandwidth')
+
         # always sends ...
 
         if self.notify_only :
@@ -335,11 +351,19 @@ class sr_sender(sr_subscribe):
         # proceed to send :  has to work
         #=================================
 
-        # N attempts to send
+        # N attempts to send, none if the remote host is known to be down
+
+        key = None
+        if self.breaker : key = self.breaker.key(self.details.url)
 
+        ok = False
         i  = 0
         while i < self.attempts :
+              if key and not self.breaker.allow(key) : break
               ok = self.__do_send__()
+              if key :
+                 if ok : self.breaker.success(key)
+                 else  : self.breaker.failure(key)
               if ok : break
               # dont force on retry 
               if self.msg.isRetry : break
@@ -32,7 +32,7 @@
 #
 #
 
-import logging, paramiko, os,sys,time
+import inspect, logging, paramiko, os,sys,time
 from   paramiko import *
 
 try :
@@ -40,6 +40,11 @@ try :
 except :
          from sarra.sr_util      import *
 
+# prefetch with a cap on the requests outstanding : paramiko >= 3.3
+
+try    : prefetch_capped = 'max_concurrent_requests' in inspect.signature(paramiko.SFTPFile.prefetch).parameters
+except : prefetch_capped = False
+
 #============================================================
 # sftp protocol in sarracenia supports/uses :
 #
@@ -60,6 +65,16 @@ except :
 #
 # SFTP : supports remote file seek... so 'I' part possible
 #
+# pipelining : get and put do not wait for the reply to each read/write
+#              request before sending the next one. get prefetches, with up
+#              to sftp_pipeline read requests outstanding. put sends its
+#              writes pipelined, their replies are checked as they arrive
+#              and when the file is closed. sftp_pipeline 0 (default) : one
+#              request at a time.
+#              paramiko buffers the prefetched data without limit : get does
+#              not prefetch when throttled (kbytes_ps, bandwidth_shared), the
+#              data would wait in memory, and not with paramiko < 3.3 (no cap
+#              on the requests outstanding).
 #
 # require   parent.logger
 #           parent.credentials
@@ -69,6 +84,7 @@ except :
 #           parent.chmod_dir
 #     opt   parent.kbytes_ps
 #     opt   parent.bufsize
+#     opt   parent.sftp_pipeline
 
 class sr_sftp(sr_proto):
     def __init__(self, parent) :
@@ -308,6 +324,13 @@ class sr_sftp(sr_proto):
         rfp = self.sftp.file(remote_file,'rb',self.bufsize)
         if remote_offset != 0 : rfp.seek(remote_offset,0)
         rfp.settimeout(1.0*self.iotime)
+
+        # pipelined : read requests sent ahead, up to the end of what is read
+
+        if self.pipeline > 0 and prefetch_capped and not self.throttled :
+           end = None
+           if length != 0 : end = remote_offset + length
+           rfp.prefetch(end,self.pipeline)
         alarm_cancel()
 
         # read from rfp and write to local_file
@@ -338,6 +361,9 @@ class sr_sftp(sr_proto):
 
         self.batch       = 0
 
+        self.pipeline    = 0
+        if hasattr(self.parent,'sftp_pipeline') : self.pipeline = self.parent.sftp_pipeline
+
     # ls
     def ls(self):
         self.logger.debug("sr_sftp ls")
@@ -403,6 +429,10 @@ class sr_sftp(sr_proto):
         rfp = self.sftp.file(remote_file,'r+b',self.bufsize)
         rfp.settimeout(1.0*self.iotime)
         if remote_offset != 0 : rfp.seek(remote_offset,0)
+
+        # pipelined : writes sent without waiting for their replies
+
+        if self.pipeline > 0 : rfp.set_pipelined(True)
         alarm_cancel()
 
         # read from local_file and write to rfp
@@ -475,11 +505,10 @@ class sftp_transport(sr_transport):
         urlstr      = msg.baseurl + '/' + msg.relpath
         new_lock    = ''
 
-        try:    curdir = os.getcwd()
-        except: curdir = None
+        # local paths do not depend on the working directory :
+        # downloads may run in threads (download_threads)
 
-        if curdir != parent.new_dir:
-            os.chdir(parent.new_dir)
+        new_file    = parent.new_dir + os.sep + parent.new_file
 
         try :
                 parent.destination = msg.baseurl
@@ -522,23 +551,23 @@ class sftp_transport(sr_transport):
                 sftp.set_sumalgo(msg.sumalgo)
 
                 if parent.inflight == None or msg.partflg == 'i' :
-                   sftp.get(remote_file,parent.new_file,remote_offset,msg.local_offset,msg.length)
+                   self.get(sftp,cdir,remote_file,new_file,remote_offset,msg.local_offset,msg.length)
 
                 elif parent.inflight == '.' :
-                   new_lock = '.' + parent.new_file
-                   sftp.get(remote_file,new_lock,remote_offset,msg.local_offset,msg.length)
-                   if os.path.isfile(parent.new_file) : os.remove(parent.new_file)
-                   os.rename(new_lock, parent.new_file)
+                   new_lock = parent.new_dir + os.sep + '.' + parent.new_file
+                   self.get(sftp,cdir,remote_file,new_lock,remote_offset,msg.local_offset,msg.length)
+                   if os.path.isfile(new_file) : os.remove(new_file)
+                   os.rename(new_lock, new_file)
                       
                 elif parent.inflight[0] == '.' :
-                   new_lock  = parent.new_file + parent.inflight
-                   sftp.get(remote_file,new_lock,remote_offset,msg.local_offset,msg.length)
-                   if os.path.isfile(parent.new_file) : os.remove(parent.new_file)
-                   os.rename(new_lock, parent.new_file)
+                   new_lock  = new_file + parent.inflight
+                   self.get(sftp,cdir,remote_file,new_lock,remote_offset,msg.local_offset,msg.length)
+                   if os.path.isfile(new_file) : os.remove(new_file)
+                   os.rename(new_lock, new_file)
 
                 # fix permission 
 
-                self.set_local_file_attributes(parent.new_file,msg)
+                self.set_local_file_attributes(new_file,msg)
 
                 # fix message if no partflg (means file size unknown until now)
 
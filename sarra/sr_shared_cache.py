@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+#
+# This file is part of sarracenia.
+# The sarracenia suite is Free and is proudly provided by the Government of Canada
+# Copyright (C) Her Majesty The Queen in Right of Canada, Environment Canada, 2008-2015
+#
+# Questions or bugs report: dps-client@ec.gc.ca
+# sarracenia repository: git://git.code.sf.net/p/metpx/git
+# Documentation: http://metpx.sourceforge.net/#SarraDocumentation
+#
+# sr_shared_cache.py : python3 duplicate suppression cache shared by the
+#                      instances of a configuration on one host
+#
+########################################################################
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307  USA
+#
+#
+
+import fcntl,hashlib,mmap,os,struct,sys,time
+
+#============================================================
+# sr_shared_cache : same interface as sr_cache, but the cache is a hash
+#                   table in a file mapped in memory by every instance.
+#
+# cache_file : default ~/.cache/sarra/'pgm'/'cfg'/recent_files.shared_cache
+#
+# header     : magic, number of buckets, slots per bucket (header_size bytes)
+#
+# buckets    : each bucket has slots_per_bucket slots of 32 bytes
+#              digest    16 bytes  blake2b of "sum path part"
+#              path      8  bytes  blake2b of path (for delete_path)
+#              time      8  bytes  last time seen, 0.0 : free slot
+#
+#              an entry goes in the bucket given by its digest. When the
+#              bucket is full, its oldest entry is evicted.
+#
+# locking    : check is an atomic insert-if-absent : the bucket is locked
+#              (fcntl.lockf on one byte, the first of the bucket) while it
+#              is searched and updated, so when several instances check the
+#              same entry only one of them sees it as new.
+#              byte 0 (in the header) is locked while the file is created.
+#              free locks the whole table at once (one lockf from the first
+#              bucket to the end) : it waits for the checks in progress in
+#              other instances, and their next checks wait until it is cleared.
+#
+
+class sr_shared_cache():
+
+    magic            = b'SRSHC001'
+    header_size      = 4096
+    header_format    = '8sQQ'
+    slot_format      = '16s8sd'
+    slot_size        = struct.calcsize(slot_format)
+    slots_per_bucket = 8
+    default_entries  = 1024 * 1024
+
+    def __init__(self, parent ):
+        parent.logger.debug("sr_shared_cache init")
+
+        self.parent        = parent
+        self.logger        = parent.logger
+
+        self.expire        = parent.caching
+
+        self.cache_file    = None
+        self.fp            = None
+        self.map           = None
+
+        # table geometry from the cache limits
+
+        entries = self.default_entries
+        if   parent.cache_max_entries > 0 : entries = parent.cache_max_entries
+        elif parent.cache_max_bytes   > 0 : entries = parent.cache_max_bytes // self.slot_size
+
+        self.nbuckets      = max(1, (entries + self.slots_per_bucket - 1) // self.slots_per_bucket)
+        self.bucket_size   = self.slots_per_bucket * self.slot_size
+
+        self.last_expire   = time.time()
+        self.count         = 0
+        self.bytes         = 0
+
+        self.hits          = 0
+        self.misses        = 0
+        self.evictions     = 0
+
+    def bucket(self, digest):
+        # offset of the bucket of an entry
+        return self.header_size + ( int.from_bytes(digest[:8],'little') % self.nbuckets ) * self.bucket_size
+
+    def check(self, key, path, part):
+        self.logger.debug("sr_shared_cache check")
+
+        now    = time.time()
+        digest = hashlib.blake2b( ('%s %s %s' % (key,path,part)).encode('utf-8'), digest_size=16 ).digest()
+        phash  = hashlib.blake2b( path.encode('utf-8'), digest_size=8 ).digest()
+        offset = self.bucket(digest)
+
+        self.lock(offset)
+        try :
+                free   = None
+                oldest = None
+                otime  = now
+
+                for slot in range(offset, offset + self.bucket_size, self.slot_size) :
+                    d, p, t = struct.unpack_from(self.slot_format, self.map, slot)
+
+                    # present and not expired : update its time
+
+                    if t > 0.0 and now - t <= self.expire :
+                       if d == digest :
+                          struct.pack_into('d', self.map, slot+24, now)
+                          self.hits += 1
+                          return False
+                       if t < otime : oldest, otime = slot, t
+                       continue
+
+                    if free == None : free = slot
+
+                # new... add, evicting the oldest entry if the bucket is full
+
+                if free == None :
+                   free = oldest
+                   self.evictions += 1
+
+                struct.pack_into(self.slot_format, self.map, free, digest, phash, now)
+                self.misses += 1
+                self.count  += 1
+                return True
+
+        finally :
+                self.unlock(offset)
+
+    def check_msg(self, msg):
+        self.logger.debug("sr_shared_cache check_msg")
+
+        relpath = msg.relpath
+        sumstr  = msg.headers['sum']
+        partstr = relpath
+
+        if sumstr[0] not in ['R','L'] :
+           partstr = msg.headers['parts']
+
+        return self.check(sumstr,relpath,partstr)
+
+    def check_expire(self):
+        self.logger.debug("sr_shared_cache check_expire")
+        now    = time.time()
+        elapse = now - self.last_expire
+        if elapse > self.expire :
+           self.last_expire = now
+           self.clean()
+
+    def clean(self, delpath = None):
+        self.logger.debug("sr_shared_cache clean")
+
+        # expired slots are reused by check, they only need to be counted
+
+        if delpath != None : self.delete_path(delpath)
+
+        now   = time.time()
+        count = 0
+        table = memoryview(self.map)[self.header_size:]
+        for d, p, t in struct.iter_unpack(self.slot_format, table) :
+            if t > 0.0 and now - t <= self.expire : count += 1
+        table.release()
+
+        self.count = count
+
+    def close(self, unlink=False):
+        self.logger.debug("sr_shared_cache close")
+
+        try   :
+                self.map.flush()
+                self.map.close()
+                self.fp.close()
+        except: pass
+        self.map = None
+        self.fp  = None
+
+        if unlink :
+           try   : os.unlink(self.cache_file)
+           except: pass
+
+        self.count = 0
+
+    def delete_path(self, delpath):
+        self.logger.debug("sr_shared_cache delete_path")
+
+        # path hashes are searched over the whole table at C speed,
+        # only the ones at the path position of a slot are real matches.
+
+        phash = hashlib.blake2b( delpath.encode('utf-8'), digest_size=8 ).digest()
+        pos   = self.map.find(phash, self.header_size)
+
+        while pos >= 0 :
+              slot = pos - 16
+              if slot >= self.header_size and ( slot - self.header_size ) % self.slot_size == 0 :
+                 offset = self.header_size + ( (slot - self.header_size) // self.bucket_size ) * self.bucket_size
+                 self.lock(offset)
+                 try :
+                         d, p, t = struct.unpack_from(self.slot_format, self.map, slot)
+                         if p == phash : struct.pack_into('d', self.map, slot+24, 0.0)
+                 finally :
+                         self.unlock(offset)
+              pos = self.map.find(phash, pos + 1)
+
+    def free(self):
+        self.logger.debug("sr_shared_cache free")
+
+        size = self.nbuckets * self.bucket_size
+
+        self.lock(self.header_size, size)
+        try :
+                self.map[self.header_size:self.header_size+size] = bytes(size)
+        finally :
+                self.unlock(self.header_size, size)
+
+        self.count = 0
+
+    def load(self):
+        self.logger.debug("sr_shared_cache load")
+
+        if self.map != None : self.close()
+
+        # create the file, or use the geometry of an existing one
+
+        self.fp = open(self.cache_file,'a+b')
+
+        self.lock(0)
+        try :
+                self.fp.seek(0)
+                header = self.fp.read(struct.calcsize(self.header_format))
+
+                if len(header) == struct.calcsize(self.header_format) and header[:8] == self.magic :
+                   magic, nbuckets, slots = struct.unpack(self.header_format, header)
+                   if nbuckets != self.nbuckets or slots != self.slots_per_bucket :
+                      self.logger.warning("sr_shared_cache %s has %d entries, not resized" % \
+                                         (self.cache_file, nbuckets * slots))
+                   self.nbuckets         = nbuckets
+                   self.slots_per_bucket = slots
+                   self.bucket_size      = slots * self.slot_size
+                else :
+                   self.fp.truncate(0)
+                   self.fp.write(struct.pack(self.header_format, self.magic, self.nbuckets, self.slots_per_bucket))
+                   self.fp.truncate(self.header_size + self.nbuckets * self.bucket_size)
+                   self.fp.flush()
+
+                self.map = mmap.mmap(self.fp.fileno(), self.header_size + self.nbuckets * self.bucket_size)
+        finally :
+                self.unlock(0)
+
+        self.bytes = self.nbuckets * self.bucket_size
+        self.clean()
+
+    def lock(self, offset, length=1):
+        fcntl.lockf(self.fp, fcntl.LOCK_EX, length, offset)
+
+    def open(self, cache_file = None):
+
+        self.cache_file = cache_file
+
+        if cache_file == None :
+           self.cache_file  = self.parent.user_cache_dir + os.sep
+           self.cache_file += 'recent_files.shared_cache'
+
+        self.load()
+
+    def save(self):
+        self.logger.debug("sr_shared_cache save")
+
+        # count entries still relevant and write the table to disk
+
+        self.clean()
+        self.map.flush()
+
+    def unlock(self, offset, length=1):
+        fcntl.lockf(self.fp, fcntl.LOCK_UN, length, offset)
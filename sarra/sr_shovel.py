@@ -93,7 +93,8 @@ class sr_shovel(sr_subscribe):
 
         # caching 
         if self.caching :
-           self.cache      = sr_cache(self)
+           if self.cache_shared : self.cache = sr_shared_cache(self)
+           else                 : self.cache = sr_cache(self)
            self.cache_stat = True
            self.cache.open()
 
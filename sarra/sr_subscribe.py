@@ -45,22 +45,30 @@
 import json,os,sys,time
 
 try :    
+         from sr_bandwidth       import *
+         from sr_breaker         import *
          from sr_cache           import *
          from sr_consumer        import *
+         from sr_download_pool   import *
          from sr_file            import *
          from sr_ftp             import *
          from sr_http            import *
          from sr_instances       import *
          from sr_message         import *
+         from sr_shared_cache    import *
          from sr_util            import *
 except : 
+         from sarra.sr_bandwidth import *
+         from sarra.sr_breaker   import *
          from sarra.sr_cache     import *
          from sarra.sr_consumer  import *
+         from sarra.sr_download_pool import *
          from sarra.sr_file      import *
          from sarra.sr_ftp       import *
          from sarra.sr_http      import *
          from sarra.sr_instances import *
          from sarra.sr_message   import *
+         from sarra.sr_shared_cache import *
          from sarra.sr_util      import *
 
 class sr_subscribe(sr_instances):
@@ -110,7 +118,8 @@ class sr_subscribe(sr_instances):
         # caching
 
         if self.caching :
-           self.cache      = sr_cache(self)
+           if self.cache_shared : self.cache = sr_shared_cache(self)
+           else                 : self.cache = sr_cache(self)
            self.cache_stat = True
 
         # retry
@@ -123,6 +132,35 @@ class sr_subscribe(sr_instances):
         if self.retry_mode :
            self.execfile("plugin",'hb_retry')
 
+        # circuit breaker per remote host
+
+        self.breaker = None
+        if self.breaker_threshold > 0 :
+           self.breaker = sr_breaker(self)
+           self.execfile("on_heartbeat",'hb_breaker')
+
+        # bandwidth shared by the instances of the config, and by the processes of the host
+
+        if hasattr(self,'bandwidth') and self.bandwidth : self.bandwidth.close()
+        self.bandwidth = None
+        if self.bandwidth_shared and ( self.kbytes_ps > 0 or self.kbytes_ps_host > 0 ) :
+           self.bandwidth = sr_bandwidth(self)
+           self.execfile("on_heartbeat",'hb_bandwidth')
+
+        # http connections kept alive between downloads (created by sr_http)
+
+        if hasattr(self,'http_pool') and self.http_pool : self.http_pool.close()
+        self.http_pool = None
+        self.execfile("on_heartbeat",'hb_http')
+
+        # downloads in worker threads
+
+        if hasattr(self,'download_pool') and self.download_pool : self.download_pool.close()
+        self.download_pool = None
+        if self.download_threads > 1 :
+           self.download_pool = sr_download_pool(self)
+           self.execfile("on_heartbeat",'hb_download')
+
         # do_task should have doit_download for now... make it a plugin later
         # and the download is the first thing that should be done
 
@@ -135,6 +173,10 @@ class sr_subscribe(sr_instances):
         for plugin in self.on_stop_list:
            if not plugin(self): break
 
+        if hasattr(self,'download_pool') and self.download_pool : self.download_pool.close()
+
+        if hasattr(self,'publisher') : self.publisher.flush()
+
         self.consumer.close()
 
         if self.post_broker :
@@ -152,6 +194,8 @@ class sr_subscribe(sr_instances):
 
         if hasattr(self,'retry') : self.retry.close()
 
+        if hasattr(self,'bandwidth') and self.bandwidth : self.bandwidth.close()
+
     def connect(self):
 
         # =============
@@ -227,8 +271,18 @@ class sr_subscribe(sr_instances):
            # publisher
 
            self.publisher = Publisher(self.post_hc)
+           if self.post_batch > 1 :
+              self.publisher.add_batch(self.post_batch,self.post_batch_interval)
            self.publisher.build()
            self.msg.publisher = self.publisher
+
+           # in batch mode, messages consumed are acknowledged only
+           # when the messages they produced are committed
+
+           if self.post_batch > 1 :
+              ack_batch = max(self.ack_batch,self.post_batch)
+              self.consumer.consumer.add_ack_batch(ack_batch,min(self.ack_interval,self.post_batch_interval))
+              self.consumer.consumer.add_before_ack(self.publisher.flush)
            if self.post_exchange :
               self.msg.pub_exchange = self.post_exchange
            self.msg.post_exchange_split = self.post_exchange_split
@@ -1199,6 +1253,8 @@ class sr_subscribe(sr_instances):
         # attempt downloads
         #=================================
 
+        ok = True
+
         if need_download :
 
            self.msg.onfly_checksum = None
@@ -1207,15 +1263,50 @@ class sr_subscribe(sr_instances):
 
            if self.msg.sumflg[0] == '0' : self.msg.sumalgo = None
 
-           # N attempts to download
+           # with download threads, the message is completed by download_done
+           # in the main thread, when its download is done
+
+           if self.download_pool and self.download_pool.accepts(self.msg) :
+              self.download_pool.submit(oldname)
+              return True
+
+           ok = self.download_attempts()
 
-           i  = 1
-           while i <= self.attempts :
-                 ok = self.__do_download__()
-                 if ok : break
-                 # dont force on retry 
-                 if self.msg.isRetry : break
-                 i = i + 1
+        return self.download_done(ok,oldname,need_download)
+
+    # =============
+    # download_attempts
+    # =============
+
+    def download_attempts(self):
+
+        # N attempts to download, none if the remote host is known to be down
+
+        key = None
+        if self.breaker : key = self.breaker.key(self.msg.baseurl)
+
+        ok = False
+        i  = 1
+        while i <= self.attempts :
+              if key and not self.breaker.allow(key) : break
+              ok = self.__do_download__()
+              if key :
+                 if ok : self.breaker.success(key)
+                 else  : self.breaker.failure(key)
+              if ok : break
+              # dont force on retry 
+              if self.msg.isRetry : break
+              i = i + 1
+
+        return ok
+
+    # =============
+    # download_done
+    # =============
+
+    def download_done(self,ok,oldname,need_download=True):
+
+        if need_download :
 
            # could not download ...
 
@@ -1495,6 +1586,10 @@ class sr_subscribe(sr_instances):
                             last  = has_vip
                             self.logger.debug("%s is active on vip=%s" % (self.program_name,self.vip))
 
+                      #  messages of the downloads done by the download threads
+
+                      if hasattr(self,'download_pool') and self.download_pool : self.download_pool.collect()
+
                       #  consume message
                       ok, self.msg = self.consumer.consume()
                       if not ok : continue
@@ -1800,7 +1895,8 @@ class sr_subscribe(sr_instances):
            self.declare_exchanges()
 
         if self.caching :
-           self.cache = sr_cache(self)
+           if self.cache_shared : self.cache = sr_shared_cache(self)
+           else                 : self.cache = sr_cache(self)
            self.cache.open()
 
         self.close()
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+#
+# This file is part of sarracenia.
+# The sarracenia suite is Free and is proudly provided by the Government of Canada
+# Copyright (C) Her Majesty The Queen in Right of Canada, Environment Canada, 2008-2015
+#
+# Questions or bugs report: dps-client@ec.gc.ca
+# sarracenia repository: git://git.code.sf.net/p/metpx/git
+# Documentation: http://metpx.sourceforge.net/#SarraDocumentation
+#
+# sr_sum_memo.py : python3 checksums of files kept while they do not change
+#
+########################################################################
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307  USA
+#
+#
+
+import os,sys
+
+from collections import OrderedDict
+
+#============================================================
+# sr_sum_memo : the sums of the files posted (sum_memo), so that a file
+#               posted again (sr_post walk, sr_watch restart) is not read
+#               again if it did not change.
+#
+# memo       : OrderedDict, least recently used first
+#              memo[(dev,ino)] = [ size, mtime_ns, ctime_ns, sumflg, chunksize, sums, path ]
+#              sums : the sumstr of each part ( [ sumstr ] for a whole file,
+#              chunksize 0 )
+#              a file is unchanged if its size, mtime and ctime are the same
+#              (a rename changes the ctime : a renamed file is read again,
+#              its entry then has the new path).
+#
+# paths      : { path : (dev,ino) } for invalidate
+#
+# max_entries: when over, the least recently used entries are evicted.
+#
+# memo_file  : default ~/.cache/sarra/'pgm'/'cfg'/sum_memo
+#              one line per entry :
+#              dev ino size mtime_ns ctime_ns sumflg chunksize nsums sum... path
+#              written (to a temporary file renamed) at save, when changed.
+#
+# sweep      : keys of the entries still to be checked (lstat of their path) :
+#              entries of files that vanished (or whose path is now another
+#              inode) are dropped. each save (heartbeat) checks sweep_entries
+#              of them, so the whole memo is checked over several heartbeats
+#              without a burst of syscalls. close checks them all.
+#
+
+class sr_sum_memo():
+
+    def __init__(self, parent ):
+        parent.logger.debug("sr_sum_memo init")
+
+        self.parent      = parent
+        self.logger      = parent.logger
+
+        self.max_entries = parent.sum_memo_max_entries
+
+        self.memo        = OrderedDict()
+        self.paths       = {}
+        self.memo_file   = None
+        self.changed     = False
+
+        self.sweep         = []
+        self.sweep_entries = 10000
+
+        self.hits        = 0
+        self.misses      = 0
+        self.evictions   = 0
+
+    def add(self, key, entry):
+
+        if key in self.memo : self.remove(key)
+
+        self.memo[key]        = entry
+        self.paths[entry[6]]  = key
+        self.changed          = True
+
+        while self.max_entries > 0 and len(self.memo) > self.max_entries :
+              self.remove( next(iter(self.memo)) )
+              self.evictions += 1
+
+    def clean(self, count=0):
+        self.logger.debug("sr_sum_memo clean")
+
+        # drop the entries of vanished files : count of them checked
+        # where the last clean stopped (0 : all of them)
+
+        if count == 0 or len(self.sweep) == 0 : self.sweep = list(self.memo.keys())
+        if count == 0 : count = len(self.sweep)
+
+        while count > 0 and len(self.sweep) > 0 :
+              key   = self.sweep.pop()
+              entry = self.memo.get(key)
+              if entry == None : continue
+              count -= 1
+              try    :
+                       lstat = os.lstat(entry[6])
+                       if (lstat.st_dev,lstat.st_ino) == key : continue
+              except : pass
+              self.remove(key)
+              self.changed = True
+
+    def clear(self):
+        self.logger.debug("sr_sum_memo clear")
+
+        self.memo    = OrderedDict()
+        self.paths   = {}
+        self.sweep   = []
+        self.changed = True
+
+    def close(self):
+        self.logger.debug("sr_sum_memo close")
+
+        if self.memo_file != None :
+           self.clean()
+           self.write()
+
+        self.memo  = OrderedDict()
+        self.paths = {}
+        self.sweep = []
+
+    def collect(self, path, lstat, sumflg, chunksize, block_count, sums):
+        # generator passing (block,sumstr) through, the memo gets them when all computed
+
+        blocks = [ None ] * block_count
+
+        for block, sumstr in sums :
+            blocks[block] = sumstr
+            yield block, sumstr
+
+        if not None in blocks : self.put(path, lstat, sumflg, chunksize, blocks)
+
+    def get(self, path, lstat, sumflg, chunksize):
+        # the sums of path if it did not change since they were computed, or None
+
+        key   = (lstat.st_dev, lstat.st_ino)
+        entry = self.memo.get(key)
+
+        if entry == None or entry[:5] != [ lstat.st_size, lstat.st_mtime_ns, lstat.st_ctime_ns, sumflg, chunksize ] :
+           self.misses += 1
+           return None
+
+        self.memo.move_to_end(key)
+        self.hits += 1
+
+        # renamed
+
+        if entry[6] != path :
+           if self.paths.get(entry[6]) == key : del self.paths[entry[6]]
+           entry[6]         = path
+           self.paths[path] = key
+           self.changed     = True
+
+        return entry[5]
+
+    def invalidate(self, path):
+        # forget the sums of path (it changed without a change of size, mtime or ctime)
+
+        key = self.paths.get(path)
+        if key == None : return
+
+        self.remove(key)
+        self.changed = True
+
+    def load(self):
+        self.logger.debug("sr_sum_memo load")
+
+        self.memo  = OrderedDict()
+        self.paths = {}
+        self.sweep = []
+
+        if not os.path.isfile(self.memo_file) : return
+
+        try :
+                fp = open(self.memo_file,'r')
+                for line in fp :
+                    words = line.rstrip('\n').split(' ')
+                    try :
+                            nsums = int(words[7])
+                            key   = ( int(words[0]), int(words[1]) )
+                            entry = [ int(words[2]), int(words[3]), int(words[4]), words[5], int(words[6]), \
+                                      words[8:8+nsums], ' '.join(words[8+nsums:]) ]
+                            if len(entry[5]) != nsums or not entry[6] : continue
+                    except : continue
+                    self.add(key, entry)
+                fp.close()
+        except :
+                (stype, svalue, tb) = sys.exc_info()
+                self.logger.error("sr_sum_memo load %s Type: %s, Value: %s" % (self.memo_file, stype, svalue))
+
+        self.changed = False
+
+    def open(self, memo_file = None):
+
+        self.memo_file = memo_file
+
+        if memo_file == None :
+           self.memo_file  = self.parent.user_cache_dir + os.sep
+           self.memo_file += 'sum_memo'
+
+        self.load()
+
+    def put(self, path, lstat, sumflg, chunksize, sums):
+
+        key   = (lstat.st_dev, lstat.st_ino)
+        entry = [ lstat.st_size, lstat.st_mtime_ns, lstat.st_ctime_ns, sumflg, chunksize, list(sums), path ]
+
+        if self.memo.get(key) == entry :
+           self.memo.move_to_end(key)
+           return
+
+        self.add(key, entry)
+
+    def remove(self, key):
+        entry = self.memo.pop(key)
+        if self.paths.get(entry[6]) == key : del self.paths[entry[6]]
+
+    def save(self):
+        self.logger.debug("sr_sum_memo save")
+
+        if self.memo_file == None : return
+
+        self.clean(self.sweep_entries)
+        self.write()
+
+    def write(self):
+        # the memo file rewritten, if changed
+
+        if not self.changed : return
+
+        try :
+                tmpfile = self.memo_file + '.tmp'
+                fp = open(tmpfile,'w')
+                for key, entry in self.memo.items() :
+                    size, mtime, ctime, sumflg, chunksize, sums, path = entry
+                    fp.write("%d %d %d %d %d %s %d %d %s %s\n" % \
+                            (key[0], key[1], size, mtime, ctime, sumflg, chunksize, len(sums), ' '.join(sums), path))
+                fp.close()
+                os.rename(tmpfile, self.memo_file)
+                self.changed = False
+        except :
+                (stype, svalue, tb) = sys.exc_info()
+                self.logger.error("sr_sum_memo save %s Type: %s, Value: %s" % (self.memo_file, stype, svalue))
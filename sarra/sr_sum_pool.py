@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+#
+# This file is part of sarracenia.
+# The sarracenia suite is Free and is proudly provided by the Government of Canada
+# Copyright (C) Her Majesty The Queen in Right of Canada, Environment Canada, 2008-2015
+#
+# Questions or bugs report: dps-client@ec.gc.ca
+# sarracenia repository: git://git.code.sf.net/p/metpx/git
+# Documentation: http://metpx.sourceforge.net/#SarraDocumentation
+#
+# sr_sum_pool.py : python3 checksums of large files computed in processes
+#
+########################################################################
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307  USA
+#
+#
+
+import hashlib,mmap,multiprocessing,os,time
+
+#============================================================
+# sr_sum_pool : checksums of the files of at least sum_threshold bytes
+#
+# block_sums : the blocks of a file posted in parts are checksummed by
+#              sum_processes processes, each one mapping the file in
+#              memory (mmap) and hashing its block without copying it.
+#              the sums are given back in block order (sum_ordered) or
+#              as soon as they are computed.
+#
+# file_sum   : the sum of a whole file cannot be split between processes
+#              (md5, sha512 are sequential) : it is computed from a mmap
+#              of the file, in one update, instead of a loop of reads.
+#
+# sumflgs    : only the checksums done with hashlib are computed here,
+#              the others (plugins) by sr_post, one block after the other.
+#
+
+algorithms = { 'd' : hashlib.md5, 's' : hashlib.sha512 }
+
+def block_sum(path, sumflg, offset, length):
+    # sum of length bytes at offset of path (in a process of the pool)
+
+    h = algorithms[sumflg]()
+    if length == 0 : return h.hexdigest()
+
+    with open(path,'rb') as fp :
+         m = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+         try :
+                 view = memoryview(m)
+                 h.update(view[offset:offset+length])
+                 view.release()
+         finally :
+                 m.close()
+
+    return h.hexdigest()
+
+def block_job(job):
+    block, path, sumflg, offset, length = job
+    return block, block_sum(path, sumflg, offset, length)
+
+class sr_sum_pool():
+
+    sumflgs = list(algorithms.keys())
+
+    def __init__(self, parent ):
+        parent.logger.debug("sr_sum_pool init")
+
+        self.parent    = parent
+        self.logger    = parent.logger
+
+        self.processes = parent.sum_processes
+        self.ordered   = parent.sum_ordered
+        self.threshold = parent.sum_threshold
+
+        self.pool      = None
+
+        self.files     = 0
+        self.blocks    = 0
+        self.bytes     = 0
+        self.elapse    = 0.0
+
+    def accepts(self, sumflg, fsiz):
+        return sumflg in self.sumflgs and fsiz >= self.threshold
+
+    def block_sums(self, path, sumflg, chunksize, block_count, remainder):
+        # generator of (block, sumstr) for the blocks of path
+
+        if self.pool == None :
+           self.pool = multiprocessing.Pool(self.processes)
+
+        jobs = []
+        for block in range(block_count) :
+            length = chunksize
+            if block == block_count-1 and remainder > 0 : length = remainder
+            jobs.append( (block, path, sumflg, block*chunksize, length) )
+
+        if self.ordered : results = self.pool.imap(block_job, jobs)
+        else            : results = self.pool.imap_unordered(block_job, jobs)
+
+        start = time.time()
+
+        for block, checksum in results :
+            self.blocks += 1
+            yield block, '%s,%s' % (sumflg,checksum)
+
+        self.files  += 1
+        self.bytes  += (block_count-1) * chunksize + ( remainder or chunksize )
+        self.elapse += time.time() - start
+
+    def close(self):
+        self.logger.debug("sr_sum_pool close")
+
+        if self.pool == None : return
+
+        self.pool.close()
+        self.pool.join()
+        self.pool = None
+
+    def file_sum(self, path, sumflg, fsiz):
+
+        start    = time.time()
+        checksum = block_sum(path, sumflg, 0, fsiz)
+
+        self.files  += 1
+        self.bytes  += fsiz
+        self.elapse += time.time() - start
+
+        return '%s,%s' % (sumflg,checksum)
+
+    def log_stats(self):
+
+        self.logger.info("sr_sum_pool %d files, %d blocks by %d processes, %.1f MB/s" % \
+                        (self.files, self.blocks, self.processes, self.bytes / 1024 / 1024 / max(self.elapse,0.001)))
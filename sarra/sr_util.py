@@ -36,7 +36,7 @@ from hashlib import md5
 from hashlib import sha512
 
 import calendar,datetime
-import os,random,signal,stat,sys,time
+import mmap,os,random,signal,stat,sys,threading,time
 import urllib
 import urllib.parse
 
@@ -48,8 +48,12 @@ class TimeoutException(Exception):
     """timeout exception"""
     pass
 
+# signals are only for the main thread : in other threads (segmented
+# downloads) alarms do nothing, the socket timeouts apply.
+
 # alarm_cancel
 def alarm_cancel():
+    if threading.current_thread() is not threading.main_thread() : return
     signal.alarm(0)
 
 # alarm_raise
@@ -58,9 +62,58 @@ def alarm_raise(n, f):
 
 # alarm_set
 def alarm_set(time):
+    if threading.current_thread() is not threading.main_thread() : return
     signal.signal(signal.SIGALRM, alarm_raise)
     signal.alarm(time)
 
+# file_checksum
+# update chk with length bytes of fp from offset, read through a mmap
+
+def file_checksum(fp, offset, length, chk, bufsize):
+
+    # mmap offset must be a multiple of the allocation granularity
+
+    start = offset - offset % mmap.ALLOCATIONGRANULARITY
+    m     = mmap.mmap(fp.fileno(), offset - start + length, access=mmap.ACCESS_READ, offset=start)
+    view  = memoryview(m)
+
+    # checksums not known to accept a memoryview get bytes
+
+    buffers = getattr(chk,'update_buffer',False)
+
+    i   = offset - start
+    end = i + length
+    while i < end :
+          if buffers : chk.update(view[i:min(i+bufsize,end)])
+          else       : chk.update(view[i:min(i+bufsize,end)].tobytes())
+          i += bufsize
+
+    view.release()
+    m.close()
+
+# =========================================
+# sr_pwrite : file like writer at an offset of a file descriptor,
+#             several of them (threads) writing in the same file
+# =========================================
+
+class sr_pwrite():
+
+    def __init__(self, fd, offset) :
+        self.fd     = fd
+        self.offset = offset
+
+    def write(self, buf):
+        n = os.pwrite(self.fd, buf, self.offset)
+
+        # partial write : write the rest
+
+        while n < len(buf) :
+              n += os.pwrite(self.fd, memoryview(buf)[n:], self.offset + n)
+
+        self.offset += n
+
+        return n
+
 # =========================================
 # raw_message to mimic raw amqplib
 # use for retry and to convert from pika
@@ -113,10 +166,19 @@ class sr_proto():
         self.kbytes_ps = self.parent.kbytes_ps
         self.bytes_ps  = self.kbytes_ps * 1024
         self.tbytes    = 0
+
+        # bandwidth_shared : throttled by the buckets shared by the processes of the host
+
+        self.bandwidth = None
+        if hasattr(self.parent,'bandwidth') : self.bandwidth = self.parent.bandwidth
+        self.throttled = self.kbytes_ps or self.bandwidth
         self.tbegin    = time.time()
         self.timeout   = self.parent.timeout
 
         self.iotime    = 30
+        self.iolast    = time.time()
+
+        self.segment_fd = None
 
         if self.timeout > self.iotime: self.iotime = int(self.timeout)
 
@@ -152,6 +214,13 @@ class sr_proto():
     # local_write_close
     def local_write_close(self, dst):
 
+        # segment written in a shared file : nothing to close
+
+        if isinstance(dst,sr_pwrite) :
+           self.fpos = dst.offset
+           if self.sumalgo : self.checksum = self.sumalgo.get_value()
+           return
+
         # flush sync (make sure all io done)
 
         dst.flush()
@@ -176,6 +245,10 @@ class sr_proto():
         self.checksum = None
         self.fpos     = 0
 
+        # segmented download : write at local_offset of the shared file
+
+        if self.segment_fd != None : return sr_pwrite(self.segment_fd, local_offset)
+
         # local_file has to exists
 
         if not os.path.isfile(local_file) :
@@ -199,52 +272,61 @@ class sr_proto():
         self.tbytes   = 0.0
         self.tbegin   = time.time()
 
+        # source without readinto : one new chunk per read
+
+        if not hasattr(src,'readinto') : return self.read_write_chunks(src, dst, length)
+
+        # one buffer for the whole transfer : readinto fills it, and the
+        # memoryview slice of what was read goes to write, checksum, throttle.
+        # checksums not known to accept a memoryview (update_buffer) get bytes.
         # length = 0, transfer entire remote file to local file
 
-        if length == 0 :
-           while True :
-                 if self.iotime: alarm_set(self.iotime)
-                 chunk = src.read(self.bufsize)
-                 if chunk :
-                    dst.write(chunk)
-                    rw_length += len(chunk)
-                 alarm_cancel()
-                 if not chunk : break
-                 if self.sumalgo  : self.sumalgo.update(chunk)
-                 if self.kbytes_ps: self.throttle(chunk)
-           return rw_length
-
-        # exact length to be transfered
-
-        nc = int(length/self.bufsize)
-        r  = length%self.bufsize
-
-        # read/write bufsize "nc" times
-
-        i  = 0
-        while i < nc :
-              if self.iotime : alarm_set(self.iotime)
-              chunk = src.read(self.bufsize)
-              if chunk :
-                 rw_length += len(chunk)
-                 dst.write(chunk)
-              alarm_cancel()
-              if not chunk : break
-              if self.sumalgo  : self.sumalgo.update(chunk)
-              if self.kbytes_ps: self.throttle(chunk)
-              i = i + 1
-
-        # remaining
-
-        if r > 0 :
-           if self.iotime : alarm_set(self.iotime)
-           chunk = src.read(r)
-           if chunk :
-              rw_length += len(chunk)
-              dst.write(chunk)
-           alarm_cancel()
-           if self.sumalgo  : self.sumalgo.update(chunk)
-           if self.kbytes_ps: self.throttle(chunk)
+        buf     = bytearray(self.bufsize)
+        view    = memoryview(buf)
+        buffers = getattr(self.sumalgo,'update_buffer',False)
+
+        if self.iotime : self.watchdog_set()
+        try :
+                while length == 0 or rw_length < length :
+                      if length == 0 or length - rw_length >= self.bufsize :
+                         n = src.readinto(view)
+                      else :
+                         n = src.readinto(view[:length - rw_length])
+                      if not n : break
+                      chunk = view[:n]
+                      dst.write(chunk)
+                      rw_length += n
+                      if self.sumalgo  :
+                         if buffers : self.sumalgo.update(chunk)
+                         else       : self.sumalgo.update(bytes(chunk))
+                      if self.throttled: self.throttle(chunk)
+                      self.iolast = time.time()
+        finally :
+                self.watchdog_cancel()
+                view.release()
+
+        return rw_length
+
+    # read_write_chunks : read_write for sources without readinto
+    def read_write_chunks(self, src, dst, length=0):
+        #self.logger.debug("sr_proto read_write_chunks")
+
+        rw_length = 0
+
+        if self.iotime : self.watchdog_set()
+        try :
+                while length == 0 or rw_length < length :
+                      size = self.bufsize
+                      if length != 0 and length - rw_length < size : size = length - rw_length
+                      chunk = src.read(size)
+                      if not chunk : break
+                      dst.write(chunk)
+                      rw_length += len(chunk)
+                      if self.sumalgo  : self.sumalgo.update(chunk)
+                      if self.throttled: self.throttle(chunk)
+                      self.iolast = time.time()
+        finally :
+                self.watchdog_cancel()
 
         return rw_length
 
@@ -309,6 +391,9 @@ class sr_proto():
     # throttle
     def throttle(self,buf) :
         self.logger.debug("sr_proto throttle")
+        if self.bandwidth :
+           self.bandwidth.throttle(getattr(self,'destination',None), len(buf))
+           return
         self.tbytes = self.tbytes + len(buf)
         span  = self.tbytes / self.bytes_ps
         rspan = time.time() - self.tbegin
@@ -320,14 +405,13 @@ class sr_proto():
     def write_chunk(self,chunk):
         if self.chunk_iow : self.chunk_iow.write(chunk)
         self.rw_length += len(chunk)
-        alarm_cancel()
         if self.sumalgo  : self.sumalgo.update(chunk)
-        if self.kbytes_ps: self.throttle(chunk)
-        if self.iotime   : alarm_set(self.iotime)
+        if self.throttled: self.throttle(chunk)
+        self.iolast = time.time()
 
     # write_chunk_end
     def write_chunk_end(self):
-        alarm_cancel()
+        self.watchdog_cancel()
         self.chunk_iow = None
         return self.rw_length
 
@@ -337,7 +421,32 @@ class sr_proto():
         self.tbytes    = 0.0
         self.tbegin    = time.time()
         self.rw_length = 0
-        if self.iotime : alarm_set(self.iotime)
+        if self.iotime : self.watchdog_set()
+
+    # watchdog : one alarm for a whole transfer instead of one per chunk.
+    #            the transfer loops only note the time of their last io
+    #            (self.iolast). when the alarm goes off, it is rearmed if
+    #            there was io during the last iotime seconds, otherwise
+    #            the transfer is stalled and TimeoutException is raised.
+
+    # watchdog_cancel
+    def watchdog_cancel(self):
+        alarm_cancel()
+
+    # watchdog_raise
+    def watchdog_raise(self, n, f):
+        idle = time.time() - self.iolast
+        if idle < self.iotime :
+           signal.alarm( int(self.iotime - idle) + 1 )
+           return
+        raise TimeoutException("signal alarm timed out")
+
+    # watchdog_set
+    def watchdog_set(self):
+        self.iolast = time.time()
+        if threading.current_thread() is not threading.main_thread() : return
+        signal.signal(signal.SIGALRM, self.watchdog_raise)
+        signal.alarm(self.iotime)
 
 # =========================================
 # sr_transport : one place for upload/download common stuff
@@ -348,6 +457,109 @@ class sr_transport():
     def __init__(self) :
         pass
 
+    # get : proto.get, segmented for large files when download_segments > 1
+    def get(self, proto, cdir, remote_file, local_file, remote_offset, local_offset, length, *args) :
+
+        parent = self.parent
+        msg    = parent.msg
+
+        if parent.download_segments > 1 and msg.partflg == '1' and \
+           length >= max(parent.download_segment_threshold, parent.download_segments) :
+           return self.get_segments(proto, cdir, remote_file, local_file, length, *args)
+
+        return proto.get(remote_file, local_file, remote_offset, local_offset, length, *args)
+
+    # get_segment : one segment of a segmented download (thread)
+    def get_segment(self, proto, fd, remote_file, local_file, offset, length, args, errors) :
+
+        try :
+                proto.set_sumalgo(None)
+                proto.segment_fd = fd
+                proto.get(remote_file, local_file, offset, offset, length, *args)
+
+                if proto.fpos != offset + length :
+                   raise Exception("segment %d-%d of %s : got %d bytes" % \
+                                  (offset, offset+length-1, remote_file, proto.fpos-offset))
+        except :
+                (stype, svalue, tb) = sys.exc_info()
+                errors.append(svalue)
+                try    : proto.close()
+                except : pass
+
+        proto.segment_fd = None
+
+    # get_segments : download remote_file as download_segments byte ranges
+    #                fetched in parallel, each on its own connection (segment 0
+    #                on proto, in the main thread). The ranges are written in place
+    #                (pwrite) in local_file, sized to length beforehand.
+    #                The checksum cannot be combined from the ranges (md5, sha512)
+    #                so it is computed after, from a mmap of local_file.
+    def get_segments(self, proto, cdir, remote_file, local_file, length, *args) :
+
+        parent  = self.parent
+        nseg    = parent.download_segments
+        sumalgo = proto.sumalgo
+
+        self.logger.debug("sr_transport get_segments %s %d bytes in %d segments" % (remote_file,length,nseg))
+
+        # connections for the other segments, kept for the next large files
+
+        if not hasattr(self,'segment_protos') : self.segment_protos = []
+
+        protos = [ proto ]
+        for i in range(1,nseg) :
+            if i > len(self.segment_protos) : self.segment_protos.append(None)
+            p = self.segment_protos[i-1]
+            if p == None or not p.check_is_connected() :
+               p = proto.__class__(parent)
+               self.segment_protos[i-1] = p
+               if not p.connect() :
+                  self.segment_protos[i-1] = None
+                  raise Exception("sr_transport get_segments unable to connect %s" % parent.destination)
+            p.cd(cdir)
+            protos.append(p)
+
+        # target file, sized
+
+        fd = os.open(local_file, os.O_RDWR | os.O_CREAT, 0o666)
+        try :
+                os.ftruncate(fd, length)
+
+                size    = (length + nseg - 1) // nseg
+                errors  = []
+                threads = []
+
+                for i in range(1,nseg) :
+                    offset = i * size
+                    if offset >= length : break
+                    t = threading.Thread(target=self.get_segment, \
+                            args=(protos[i], fd, remote_file, local_file, offset, min(size,length-offset), args, errors))
+                    t.start()
+                    threads.append(t)
+
+                self.get_segment(proto, fd, remote_file, local_file, 0, min(size,length), args, errors)
+
+                for t in threads : t.join()
+
+                if errors : raise errors[0]
+
+                os.fsync(fd)
+        finally :
+                os.close(fd)
+                proto.set_sumalgo(sumalgo)
+
+        # checksum
+
+        proto.checksum = None
+        proto.fpos     = length
+
+        if sumalgo :
+           sumalgo.set_path(remote_file)
+           fp = open(local_file,'rb')
+           file_checksum(fp, 0, length, sumalgo, parent.bufsize)
+           fp.close()
+           proto.checksum = sumalgo.get_value()
+
     # set_local_file_attributes
     def set_local_file_attributes(self,local_file, msg) :
         #self.logger.debug("sr_transport set_local_file_attributes %s" % local_file)
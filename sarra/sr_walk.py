@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+#
+# This file is part of sarracenia.
+# The sarracenia suite is Free and is proudly provided by the Government of Canada
+# Copyright (C) Her Majesty The Queen in Right of Canada, Environment Canada, 2008-2015
+#
+# Questions or bugs report: dps-client@ec.gc.ca
+# sarracenia repository: git://git.code.sf.net/p/metpx/git
+# Documentation: http://metpx.sourceforge.net/#SarraDocumentation
+#
+# sr_walk.py : python3 walk of the trees posted by sr_post, primed by sr_watch
+#
+########################################################################
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307  USA
+#
+#
+
+import os,queue,sys,threading,time
+
+#============================================================
+# sr_walk : the files of a tree, as (path, lstat, isfile), for sr_post.walk
+#
+# scan       : a directory is listed with os.scandir, the type of each entry
+#              comes with the listing : a regular file costs one stat (kept
+#              by its DirEntry), a directory one stat (loops of symbolic
+#              links to directories are not walked twice).
+#              isfile True : lstat is the stat of a regular file, ready for
+#              post_file ; False : a symbolic link, lstat the stat of its
+#              target, for post1file.  Links to nothing are skipped.
+#
+# walk       : no recursion.  With walk_threads 1, the directories to list
+#              are a stack, listed by the caller.  With walk_threads > 1,
+#              the directories are listed (and their files stat'ed) by
+#              walk_threads threads (trees on NFS, Lustre... where every
+#              listing and stat is a round trip), the files go to the caller
+#              through a bounded queue (queue_size) : the threads wait when
+#              posting is slower than listing.
+#              A walk abandoned by the caller (posting raised, generator
+#              closed) stops the threads : the queues are drained until they
+#              are all joined.
+#
+# report     : files/s logged every report_interval seconds of a walk, and
+#              at its end.
+#
+
+class sr_walk():
+
+    queue_size      = 10000
+    report_interval = 10
+
+    def __init__(self, parent ):
+        parent.logger.debug("sr_walk init")
+
+        self.parent     = parent
+        self.logger     = parent.logger
+
+        self.threads    = parent.walk_threads
+
+        self.lock       = threading.Lock()
+
+        self.files      = 0
+        self.dirs       = 0
+        self.elapse     = 0.0
+
+    def report(self, src, start, end=False):
+
+        elapse = max(time.time() - start, 0.001)
+        state  = 'done' if end else 'walking'
+
+        self.logger.info("sr_walk %s %s : %d files, %d directories in %.1fs, %.1f files/s" % \
+                        (state, src, self.files, self.dirs, elapse, self.files / elapse))
+
+    def scan(self, d, visited):
+        # subdirectories and files of directory d
+
+        subdirs = []
+        files   = []
+
+        try :
+                 entries = list(os.scandir(d))
+        except :
+                 (stype, svalue, tb) = sys.exc_info()
+                 self.logger.warning("sr_walk could not list %s Type: %s, Value: %s" % (d, stype, svalue))
+                 return subdirs, files
+
+        for entry in entries :
+            try :
+                     if entry.is_dir() :
+                        lstat = entry.stat()
+                        with self.lock :
+                             key = (lstat.st_dev, lstat.st_ino)
+                             if key in visited : continue
+                             visited.add(key)
+                        subdirs.append(entry.path)
+
+                     elif entry.is_file(follow_symlinks=False) :
+                        files.append( (entry.path, entry.stat(follow_symlinks=False), True) )
+
+                     elif entry.is_symlink() :
+                        files.append( (entry.path, entry.stat(), False) )
+
+            # vanished since listed, link to nothing
+
+            except : continue
+
+        with self.lock : self.dirs += 1
+
+        return subdirs, files
+
+    def walk(self, src):
+        # generator of (path, lstat, isfile) of the files under src
+
+        self.files  = 0
+        self.dirs   = 0
+        start       = time.time()
+        last        = start
+
+        visited     = set()
+        try :
+                 lstat = os.stat(src)
+                 visited.add( (lstat.st_dev, lstat.st_ino) )
+        except : pass
+
+        if self.threads > 1 : files = self.walk_threaded(src, visited)
+        else                : files = self.walk_stack(src, visited)
+
+        try :
+                for item in files :
+                    self.files += 1
+                    yield item
+
+                    if self.files % 1000 == 0 and time.time() - last >= self.report_interval :
+                       last = time.time()
+                       self.report(src, start)
+        finally :
+                files.close()
+
+        self.elapse += time.time() - start
+        self.report(src, start, True)
+
+    def walk_stack(self, src, visited):
+
+        stack = [ src ]
+
+        while len(stack) > 0 :
+              subdirs, files = self.scan(stack.pop(), visited)
+              for item in files : yield item
+              subdirs.reverse()
+              stack.extend(subdirs)
+
+    def walk_threaded(self, src, visited):
+
+        dirs    = queue.Queue()
+        files   = queue.Queue(self.queue_size)
+        pending = [ 1 ]
+        stop    = threading.Event()
+
+        def worker():
+            while not stop.is_set() :
+                  d = dirs.get()
+                  if d == None : return
+
+                  subdirs, found = self.scan(d, visited)
+
+                  with self.lock : pending[0] += len(subdirs)
+                  for subdir in subdirs : dirs.put(subdir)
+                  for item   in found   :
+                      if stop.is_set() : break
+                      files.put(item)
+
+                  # last directory listed : the walk is over
+
+                  with self.lock :
+                       pending[0] -= 1
+                       over = pending[0] == 0
+
+                  if over :
+                     files.put(None)
+                     for i in range(self.threads) : dirs.put(None)
+
+        workers = []
+        for i in range(self.threads) :
+            t = threading.Thread(target=worker, name='sr_walk-%d' % i, daemon=True)
+            t.start()
+            workers.append(t)
+
+        dirs.put(src)
+
+        try :
+                while True :
+                      item = files.get()
+                      if item == None : break
+                      yield item
+
+        # over, or abandoned : threads waiting on a queue are released
+
+        finally :
+                stop.set()
+                for t in workers : dirs.put(None)
+                for t in workers :
+                    while t.is_alive() :
+                          try    : files.get_nowait()
+                          except queue.Empty : pass
+                          t.join(0.01)
@@ -70,12 +70,12 @@ class sr_winnow(sr_subscribe):
            self.queue_name  = 'q_' + self.broker.username + '.'
            self.queue_name += self.program_name + '.' + self.config_name 
 
-        # we cannot have more than one instance since we 
-        # need to work with a single cache.
+        # instances must work with a single cache : 
+        # with more than one, it is shared by the instances.
 
-        if self.nbr_instances != 1 :
-           self.logger.error("Only one instance allowed... set to 1")
-           os._exit(1)
+        if self.nbr_instances != 1 and not self.cache_shared :
+           self.logger.info("%d instances... cache_shared turned on" % self.nbr_instances)
+           self.cache_shared = True
 
         # exchange must be provided 
 
@@ -138,7 +138,8 @@ class sr_winnow(sr_subscribe):
            self.logger.error("caching turned off... exiting")
            sys.exit(1)
 
-        self.cache = sr_cache(self)
+        if self.cache_shared : self.cache = sr_shared_cache(self)
+        else                 : self.cache = sr_cache(self)
         self.cache.open()
 
         # MG FIXME : I dont think I forgot anything but if some options need
@@ -15,6 +15,7 @@ class checksum_0(sr_checksum):
       """
       Trivial minimalist checksumming algorithm, returns 0 for any file.
       """
+      update_buffer = True
 
       def get_value(self):
           return '%.4d' % random.randint(0,9999)
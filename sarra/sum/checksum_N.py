@@ -17,6 +17,7 @@ class checksum_N(sr_checksum):
       Did this just as a quick shot... not convinced it is ok
       Still put a test below... Use with care
       """
+      update_buffer = True
 
       def registered_as(self):
           return 'N'
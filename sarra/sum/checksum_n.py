@@ -18,6 +18,7 @@ class checksum_n(sr_checksum):
       the generation tags will differ.   The simplest option for checksumming then is to use the name of the
       product, which is generally the same from all the processing chains.  
       """
+      update_buffer = True
 
       def registered_as(self):
           return 'n'
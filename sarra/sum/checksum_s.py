@@ -15,6 +15,7 @@ class checksum_s(sr_checksum):
       """
       The SHA512 algorithm to checksum the entire file, which is called 's'.
       """
+      update_buffer = True
 
       def get_value(self):
           return self.filehash.hexdigest()
@@ -26,8 +27,8 @@ class checksum_s(sr_checksum):
           self.filehash = sha512()
 
       def update(self,chunk):
-          if type(chunk) == bytes : self.filehash.update(chunk)
-          else                    : self.filehash.update(bytes(chunk,'utf-8'))
+          if type(chunk) == str : self.filehash.update(bytes(chunk,'utf-8'))
+          else                  : self.filehash.update(chunk)
 
 self.add_sumalgo=checksum_s()
 
@@ -204,7 +204,7 @@ nbr_fail=0
 
 count_of_checks=$((${count_of_checks}+1))
 
-for t in sr_util sr_credentials sr_config sr_cache sr_retry sr_consumer sr_http sr_sftp sr_instances; do
+for t in sr_util sr_file sr_credentials sr_config sr_matcher sr_cache sr_shared_cache sr_retry sr_breaker sr_bandwidth sr_download_pool sr_sum_pool sr_sum_memo sr_inotify sr_walk sr_post sr_amqp sr_consumer sr_http sr_sftp sr_instances; do
     echo "======= testing "${t}  >>  ${testdocroot}/unit_tests.log
     nbr_test=$(( ${nbr_test}+1 ))
 	    ${TESTDIR}/unit_tests/${t}_unit_test.py >> ${testdocroot}/unit_tests.log 2>&1
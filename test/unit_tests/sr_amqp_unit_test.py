@@ -0,0 +1,458 @@
+#!/usr/bin/env python3
+
+import socket,sys,time,types
+
+try :
+         from sr_amqp            import *
+         from sr_consumer        import *
+         from sr_util            import *
+except :
+         from sarra.sr_amqp      import *
+         from sarra.sr_consumer  import *
+         from sarra.sr_util      import *
+
+# ===================================
+# self_test
+# ===================================
+
+class test_logger:
+      def silence(self,str):
+          pass
+      def __init__(self):
+          self.debug   = self.silence
+          self.error   = print
+          self.info    = self.silence
+          self.warning = self.silence
+
+# broker : what the channels of a test_hc did, across reconnections
+
+class test_broker:
+      def __init__(self):
+          self.calls       = []
+          self.pending     = []
+          self.published   = []
+          self.committed   = []
+          self.fail_commit = 0
+          self.depth       = 0
+          self.nack        = []
+
+# channel : amqplib like, deliveries pushed through the basic_consume callback
+#           when wait() is called (method_queue : frames not yet processed)
+
+class test_channel:
+      def __init__(self,broker):
+          self.broker       = broker
+          self.callback     = None
+          self.method_queue = broker.pending
+          self.published    = []
+
+      def basic_ack(self,tag,multiple=False):
+          self.broker.calls.append( ('basic_ack',tag,multiple) )
+
+      def basic_consume(self,queue,no_ack=False,callback=None):
+          self.broker.calls.append( ('basic_consume',queue) )
+          self.callback = callback
+          return 'ctag'
+
+      def basic_get(self,queue):
+          self.broker.calls.append( ('basic_get',queue) )
+          return None
+
+      def basic_publish(self,msg,exchange,key):
+          self.published.append(msg.body)
+
+      def basic_qos(self,size,count,a_global):
+          self.broker.calls.append( ('basic_qos',count) )
+
+      def queue_declare(self,queue,passive=False):
+          self.broker.calls.append( ('queue_declare',queue,passive) )
+          return (queue, self.broker.depth, 1)
+
+      def tx_commit(self):
+          if self.broker.fail_commit > 0 :
+             self.broker.fail_commit -= 1
+             raise ConnectionError("connection lost")
+          self.broker.committed.extend(self.published)
+          self.published = []
+
+      def tx_select(self):
+          pass
+
+      def wait(self):
+          self.callback(self.broker.pending.pop(0))
+
+# channel : pika like, in confirm mode. the broker confirms what was published
+#           when the connection processes its events, nacks the bodies in broker.nack once
+
+class test_pika_channel:
+      def __init__(self,broker):
+          self.broker    = broker
+          self._impl     = self
+          self.callback  = None
+          self.published = []
+          self.confirmed = 0
+
+      def basic_publish(self,exchange,key,body,properties,mandatory):
+          self.published.append(body)
+
+      def confirm_delivery(self,callback=None):
+          self.broker.calls.append( ('confirm_delivery',) )
+          self.callback = callback
+
+      def confirm(self):
+          while self.confirmed < len(self.published) :
+                body = self.published[self.confirmed]
+                self.confirmed += 1
+                if body in self.broker.nack :
+                   self.broker.nack.remove(body)
+                   method = types.SimpleNamespace(NAME='Basic.Nack',delivery_tag=self.confirmed,multiple=False)
+                else :
+                   self.broker.committed.append(body)
+                   method = types.SimpleNamespace(NAME='Basic.Ack',delivery_tag=self.confirmed,multiple=True)
+                self.callback( types.SimpleNamespace(method=method) )
+
+      def tx_select(self):
+          self.broker.calls.append( ('tx_select',) )
+
+class test_transport:
+      def __init__(self):
+          self.sock, self.peer = socket.socketpair()
+          self._read_buffer    = b''
+
+class test_connection:
+      def __init__(self):
+          self.transport = test_transport()
+          self.channel   = None
+
+      def process_data_events(self,time_limit=0):
+          if self.channel != None : self.channel.confirm()
+
+# hostconnect : new_channel, reconnect rebuilding the consumer/publisher, as HostConnect
+
+class test_hc:
+      def __init__(self,logger,broker):
+          self.logger     = logger
+          self.broker     = broker
+          self.use_pika   = False
+          self.asleep     = False
+          self.loop       = True
+          self.rebuilds   = []
+          self.channels   = []
+          self.connection = test_connection()
+
+      def add_build(self,func):
+          self.rebuilds.append(func)
+
+      def new_channel(self):
+          if self.use_pika :
+             channel = test_pika_channel(self.broker)
+             self.connection.channel = channel
+          else :
+             channel = test_channel(self.broker)
+          self.channels.append(channel)
+          return channel
+
+      def reconnect(self):
+          self.broker.calls.append( ('reconnect',) )
+          for func in self.rebuilds : func()
+
+class test_retry:
+      def get(self):
+          return None
+
+# sr_consumer around a Consumer, without a broker (only what consume uses)
+
+def test_sr_consumer(logger,consumer):
+    c = sr_consumer.__new__(sr_consumer)
+    c.logger          = logger
+    c.parent          = test_broker()
+    c.consumer        = consumer
+    c.retry           = test_retry()
+    c.queue_name      = 'q'
+    c.raw_msg         = None
+    c.msg             = None
+    c.last_msg_failed = False
+    c.sleep_min       = 0.01
+    c.sleep_max       = 0.01
+    c.sleep_now       = 0.01
+    return c
+
+def test_message(logger,tag):
+    msg = raw_message(logger)
+    msg.delivery_tag = tag
+    msg.body         = 'message %d' % tag
+    return msg
+
+def self_test():
+
+    failed = False
+
+    logger = test_logger()
+
+    # test 01: push mode, one basic_consume, deliveries in order, none on an idle queue
+
+    broker   = test_broker()
+    hc       = test_hc(logger,broker)
+    consumer = Consumer(hc)
+    consumer.add_push(True)
+    consumer.build()
+
+    broker.pending.extend( [ test_message(logger,tag) for tag in [1,2,3] ] )
+    tags = []
+    for i in range(4) :
+        msg = consumer.consume('q')
+        if msg != None : tags.append(msg.delivery_tag)
+
+    if tags != [1,2,3] or broker.calls.count( ('basic_consume','q') ) != 1 or ('basic_get','q') in broker.calls :
+       logger.error("test 01: push mode deliveries %s, calls %s" % (tags,broker.calls))
+       failed = True
+
+    if consumer.wait(0.01) :
+       logger.error("test 01: push mode wait on an idle queue")
+       failed = True
+
+    # test 02: push mode, after a reconnection consume starts again on the new channel
+
+    consumer.deliveries.append( test_message(logger,4) )
+    hc.reconnect()
+    broker.pending.append( test_message(logger,1) )
+    msg = consumer.consume('q')
+
+    if msg == None or msg.delivery_tag != 1 or broker.calls.count( ('basic_consume','q') ) != 2 :
+       logger.error("test 02: push mode after reconnect")
+       failed = True
+
+    # test 03: ack_batch, one basic_ack multiple for the last tag, before_ack called first
+
+    broker   = test_broker()
+    hc       = test_hc(logger,broker)
+    consumer = Consumer(hc)
+    consumer.add_prefetch(20)
+    consumer.add_ack_batch(5,60)
+    consumer.add_before_ack(lambda : broker.calls.append( ('before_ack',) ) or True)
+    consumer.build()
+
+    for tag in range(1,13) : consumer.ack( test_message(logger,tag) )
+    acks = [ c for c in broker.calls if c[0] in ['basic_ack','before_ack'] ]
+
+    if acks != [ ('before_ack',), ('basic_ack',5,True), ('before_ack',), ('basic_ack',10,True) ] or consumer.ack_pending != 2 :
+       logger.error("test 03: batched acks %s" % acks)
+       failed = True
+
+    # test 04: never more pending than prefetch, nor older than ack_interval
+
+    broker.calls = []
+    consumer.flush_acks()
+    consumer.add_prefetch(3)
+    consumer.add_ack_batch(100,0.2)
+    for tag in range(13,17) : consumer.ack( test_message(logger,tag) )
+    time.sleep(0.3)
+    consumer.ack( test_message(logger,17) )
+    acks = [ c for c in broker.calls if c[0] == 'basic_ack' ]
+
+    if acks != [ ('basic_ack',12,True), ('basic_ack',15,True), ('basic_ack',17,True) ] :
+       logger.error("test 04: acks bounded by prefetch and interval %s" % acks)
+       failed = True
+
+    # test 05: sr_consumer flushes the pending acks when the queue is idle
+
+    broker.calls = []
+    consumer.add_prefetch(20)
+    consumer.add_ack_batch(100,60)
+    c = test_sr_consumer(logger,consumer)
+    c.raw_msg = test_message(logger,18)
+    c.raw_msg.isRetry = False
+    ok, msg = c.consume()
+    acks = [ call for call in broker.calls if call[0] in ['basic_ack','basic_get'] ]
+
+    if ok or acks != [ ('basic_get','q'), ('basic_ack',18,True) ] :
+       logger.error("test 05: idle flush %s" % acks)
+       failed = True
+
+    # test 06: adaptive prefetch, about prefetch_window seconds of work, capped by the
+    #          queue depth (passive declare) and by prefetch_min/prefetch_max
+
+    broker   = test_broker()
+    hc       = test_hc(logger,broker)
+    consumer = Consumer(hc)
+    consumer.add_prefetch(20)
+    consumer.add_prefetch_bounds(2,100)
+    consumer.add_push(True)
+    consumer.prefetch_check = 0
+    consumer.build()
+    consumer.consume('q')
+
+    qos = []
+    # (0.5 sec/msg : 4, too close to 5 to issue basic_qos again)
+
+    for depth, elapse in [ (1000,0.01), (1000,0.01), (5,0.01), (1000,0.5), (1000,5.0) ] :
+        broker.depth = depth
+        consumer.avg_time = None
+        consumer.observe(elapse)
+        qos.append(consumer.prefetch)
+
+    if qos != [ 100, 100, 5, 5, 2 ] or broker.calls.count( ('queue_declare','q',True) ) != 5 or \
+       [ c for c in broker.calls if c[0] == 'basic_qos' ] != [ ('basic_qos',q) for q in [ 20, 100, 5, 2 ] ] :
+       logger.error("test 06: adaptive prefetch %s, calls %s" % (qos,broker.calls))
+       failed = True
+
+    # test 07: prefetch_adaptive turns push mode on in sr_consumer
+
+    cfg = sr_config()
+    cfg.defaults()
+    cfg.logger = logger
+    cfg.option( ['prefetch_adaptive','True'] )
+    c = test_sr_consumer(logger,None)
+    c.parent = cfg
+    c.hc     = hc
+    c.retry  = sr_retry.__new__(sr_retry)
+    c.retry.message = None
+    c.build_consumer()
+
+    if not cfg.use_basic_consume or not c.consumer.push or c.consumer.prefetch_max != cfg.prefetch_max :
+       logger.error("test 07: prefetch_adaptive without push mode")
+       failed = True
+
+    # test 08: post_batch, messages staged until the batch is full, then committed at once
+    # (the messages published are amqplib ones)
+
+    try    :
+             amqp.Message
+             publisher_test = True
+    except :
+             print("sr_amqp Publisher not tested : amqplib unavailable")
+             publisher_test = False
+
+    if publisher_test :
+       broker    = test_broker()
+       hc        = test_hc(logger,broker)
+       publisher = Publisher(hc)
+       publisher.add_batch(3,60)
+       publisher.build()
+
+       for i in range(1,3) : publisher.publish('xpublic','v02.post.test','notice %d' % i,{ 'n':'%d' % i })
+       staged = len(publisher.staged)
+       publisher.publish('xpublic','v02.post.test','notice 3',{ 'n':'3' })
+
+       if staged != 2 or broker.committed != [ 'notice 1', 'notice 2', 'notice 3' ] or publisher.staged != [] :
+          logger.error("test 08: batch committed %s" % broker.committed)
+          failed = True
+
+    # test 09: commit lost : after the reconnection the staged messages are published again
+    #          on the new channel, committed once, in order (reconnect sleeps 5 sec)
+
+    if publisher_test :
+       broker.fail_commit = 1
+       for i in range(4,6) : publisher.publish('xpublic','v02.post.test','notice %d' % i,{ 'n':'%d' % i })
+       publisher.publish_many( [ ('xpublic','v02.post.test','notice 6',{ 'n':'6' },0) ] )
+
+       if broker.committed != [ 'notice %d' % i for i in range(1,7) ] or broker.calls != [ ('reconnect',) ] or \
+          len(hc.channels) != 2 or publisher.staged != [] :
+          logger.error("test 09: replay after reconnect committed %s" % broker.committed)
+          failed = True
+
+    # test 10: publishing fails without loop : the messages are kept, not acknowledged
+    #          until they are committed
+
+    if publisher_test :
+       broker    = test_broker()
+       hc        = test_hc(logger,broker)
+       hc.loop   = False
+       publisher = Publisher(hc)
+       publisher.add_batch(3,60)
+       publisher.build()
+       consumer  = Consumer(hc)
+       consumer.add_ack_batch(3,60)
+       consumer.add_before_ack(publisher.flush)
+       consumer.build()
+
+       broker.fail_commit = 1
+       for i in range(1,3) :
+           publisher.publish('xpublic','v02.post.test','notice %d' % i,{ 'n':'%d' % i })
+           consumer.ack( test_message(logger,i) )
+       ok = consumer.flush_acks()
+       acks = [ c for c in broker.calls if c[0] == 'basic_ack' ]
+
+       if ok or acks or len(publisher.staged) != 2 or consumer.ack_pending != 2 :
+          logger.error("test 10: acked %s with %d messages not published" % (acks,len(publisher.staged)))
+          failed = True
+
+       hc.channels[0].published = []
+       ok   = consumer.flush_acks()
+       acks = [ c for c in broker.calls if c[0] == 'basic_ack' ]
+
+       if not ok or acks != [ ('basic_ack',2,True) ] or broker.committed != [ 'notice 1', 'notice 2' ] :
+          logger.error("test 10: acks %s after commit %s" % (acks,broker.committed))
+          failed = True
+
+    # test 11: pika, post_batch in confirm mode : published right away, waiting for the
+    #          confirms only when the window is full, nacked ones published again
+
+    try    :
+             pika.BasicProperties
+             pika_test = True
+    except :
+             print("sr_amqp Publisher confirms not tested : pika unavailable")
+             pika_test = False
+
+    if pika_test :
+       broker      = test_broker()
+       hc          = test_hc(logger,broker)
+       hc.use_pika = True
+       publisher   = Publisher(hc)
+       publisher.add_batch(3,60)
+       publisher.build()
+
+       broker.nack = [ 'notice 2' ]
+       publisher.publish('xpublic','v02.post.test','notice 1',{ 'n':'1' })
+       published = list(hc.channels[0].published)
+       for i in range(2,4) : publisher.publish('xpublic','v02.post.test','notice %d' % i,{ 'n':'%d' % i })
+
+       if ('tx_select',) in broker.calls or published != [ 'notice 1' ] or \
+          hc.channels[0].published != [ 'notice 1', 'notice 2', 'notice 2', 'notice 3' ] or \
+          broker.committed != [ 'notice 1', 'notice 2', 'notice 3' ] or \
+          publisher.unconfirmed or publisher.staged or publisher.seq != 4 :
+          logger.error("test 11: confirms %s, published %s" % (broker.committed,hc.channels[0].published))
+          failed = True
+
+    # test 12: pika, unconfirmed messages published again on a new channel, from sequence 1
+
+    if pika_test :
+       hc.connection.channel = None
+       publisher.publish('xpublic','v02.post.test','notice 4',{ 'n':'4' })
+       hc.reconnect()
+       hc.connection.channel = hc.channels[1]
+       ok = publisher.flush()
+
+       if not ok or hc.channels[1].published != [ 'notice 4' ] or publisher.seq != 1 or \
+          broker.committed[-1] != 'notice 4' or publisher.unconfirmed :
+          logger.error("test 12: unconfirmed after reconnect %s" % hc.channels[1].published)
+          failed = True
+
+    if not failed :
+                    print("sr_amqp.py TEST PASSED")
+    else :
+                    print("sr_amqp.py TEST FAILED")
+                    sys.exit(1)
+
+# ===================================
+# MAIN
+# ===================================
+
+def main():
+
+    try:    self_test()
+    except:
+            (stype, svalue, tb) = sys.exc_info()
+            print("%s, Value: %s" % (stype, svalue))
+            print("sr_amqp.py TEST FAILED")
+            sys.exit(1)
+
+    sys.exit(0)
+
+# =========================================
+# direct invocation : self testing
+# =========================================
+
+if __name__=="__main__":
+   main()
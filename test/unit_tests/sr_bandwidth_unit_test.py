@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+import io,multiprocessing,sys,tempfile,time
+
+try :
+         from sr_bandwidth         import *
+         from sr_config            import *
+         from sr_util              import *
+except :
+         from sarra.sr_bandwidth   import *
+         from sarra.sr_config      import *
+         from sarra.sr_util        import *
+
+# ===================================
+# self_test
+# ===================================
+
+class test_logger:
+      def silence(self,str):
+          pass
+      def __init__(self):
+          self.debug   = self.silence
+          self.error   = print
+          self.info    = self.silence
+          self.warning = print
+
+def test_config(logger, config_name, kbytes_ps, kbytes_ps_host, shared=True):
+
+    cfg        = sr_config(config=None,args=['test','--debug','False'])
+    cfg.logger = logger
+
+    cfg.debug  = False
+    cfg.defaults()
+    cfg.debug  = False
+    cfg.general()
+
+    cfg.config_name    = config_name
+    cfg.program_name   = 'sr_subscribe'
+    cfg.kbytes_ps      = kbytes_ps
+    cfg.kbytes_ps_host = kbytes_ps_host
+    cfg.bandwidth      = None
+    if shared : cfg.bandwidth = sr_bandwidth(cfg)
+
+    return cfg
+
+# one instance : transfers chunks from destination for duration seconds, as fast as it is allowed
+
+def test_instance(path, config_name, kbytes_ps, kbytes_ps_host, shared, destination, duration, results):
+
+    cfg   = test_config(test_logger(), config_name, kbytes_ps, kbytes_ps_host, shared)
+    proto = sr_proto(cfg)
+    proto.destination = destination
+    if cfg.bandwidth : cfg.bandwidth.open(path)
+
+    chunk  = bytes(64*1024)
+    nbytes = 0
+    end    = time.time() + duration
+
+    while time.time() < end :
+          proto.throttle(chunk)
+          nbytes += len(chunk)
+
+    results.put( (config_name, destination, nbytes) )
+
+def test_instances(path, instances, duration):
+
+    results   = multiprocessing.Queue()
+    processes = []
+    for args in instances :
+        p = multiprocessing.Process(target=test_instance, args=(path,) + args + (duration,results))
+        p.start()
+        processes.append(p)
+
+    totals = [ results.get() for p in processes ]
+    for p in processes : p.join()
+
+    return totals
+
+def self_test():
+
+    failed = False
+
+    logger = test_logger()
+
+    tmpdir   = tempfile.mkdtemp()
+    path     = tmpdir + os.sep + 'bandwidth.shared'
+    duration = 3.0
+    kbytes   = 1024
+
+    # a bucket holds 1 sec of rate (burst) : what can go through in duration seconds,
+    # plus the last chunk of each instance (taken before it waits)
+
+    limit    = kbytes * 1024 * ( duration + sr_bandwidth.burst )
+    chunk    = 64 * 1024
+
+    # test 01: per process kbytes_ps, 4 instances go 4 times over the rate
+
+    totals = test_instances(path, [ ('cfg1', kbytes, 0, False, 'sftp://host1') ] * 4, duration)
+    perproc = sum( [ t[2] for t in totals ] )
+    print("sr_bandwidth kbytes_ps %d per process, 4 instances : %.1f Kbytes/s" % (kbytes, perproc/1024/duration))
+
+    if perproc < 2 * limit :
+       logger.error("test 01: 4 instances transferred %d bytes, expected about 4 * %d" % (perproc,limit))
+       failed = True
+
+    # test 02: bandwidth_shared, 4 instances together stay under the rate of the config
+
+    totals = test_instances(path, [ ('cfg1', kbytes, 0, True, 'sftp://host1') ] * 4, duration)
+    shared = sum( [ t[2] for t in totals ] )
+    print("sr_bandwidth kbytes_ps %d shared, 4 instances : %.1f Kbytes/s" % (kbytes, shared/1024/duration))
+
+    if shared > limit + 4*chunk or shared < limit * 0.8 :
+       logger.error("test 02: 4 instances transferred %d bytes, limit %d" % (shared,limit))
+       failed = True
+
+    # test 03: 1 busy instance, 3 idle ones : the busy one gets the whole rate
+
+    totals = test_instances(path, [ ('cfg2', kbytes, 0, True, 'sftp://host1') ], duration)
+    busy   = totals[0][2]
+    print("sr_bandwidth kbytes_ps %d shared, 1 busy instance : %.1f Kbytes/s" % (kbytes, busy/1024/duration))
+
+    if busy < limit * 0.8 :
+       logger.error("test 03: busy instance transferred %d bytes, not borrowing the idle share %d" % (busy,limit))
+       failed = True
+
+    # test 04: kbytes_ps_host, 2 configs to host1 share its budget, host2 has its own
+
+    instances = [ ('cfg3', 0, kbytes, True, 'sftp://user@host1:22'), ('cfg4', 0, kbytes, True, 'http://host1/data'), \
+                  ('cfg5', 0, kbytes, True, 'sftp://host2') ]
+    totals = test_instances(path, instances, duration)
+    host1  = sum( [ t[2] for t in totals if 'host1' in t[1] ] )
+    host2  = sum( [ t[2] for t in totals if 'host2' in t[1] ] )
+    print("sr_bandwidth kbytes_ps_host %d, 2 configs to host1 : %.1f Kbytes/s, 1 config to host2 : %.1f Kbytes/s" % \
+          (kbytes, host1/1024/duration, host2/1024/duration))
+
+    if host1 > limit + 2*chunk or host2 < limit * 0.8 :
+       logger.error("test 04: host1 %d bytes, host2 %d bytes, limit %d each" % (host1,host2,limit))
+       failed = True
+
+    # test 05: sr_proto transfers go through the shared buckets
+
+    cfg   = test_config(logger, 'cfg6', 256, 0)
+    cfg.bandwidth.open(path)
+    proto = sr_proto(cfg)
+    data  = os.urandom(1024*1024)
+    dst   = io.BytesIO()
+    start = time.time()
+    proto.read_write(io.BytesIO(data), dst)
+    elapse = time.time() - start
+
+    # 1M at 256K/s, 256K of burst : 3 sec
+
+    if dst.getvalue() != data or elapse < 2.5 or cfg.bandwidth.bytes != len(data) :
+       logger.error("test 05: sr_proto read_write 1M at 256 Kbytes/s in %.2fs" % elapse)
+       failed = True
+
+    cfg.bandwidth.close()
+
+    if not failed :
+                    print("sr_bandwidth.py TEST PASSED")
+    else :
+                    print("sr_bandwidth.py TEST FAILED")
+                    sys.exit(1)
+
+# ===================================
+# MAIN
+# ===================================
+
+def main():
+
+    try:    self_test()
+    except:
+            (stype, svalue, tb) = sys.exc_info()
+            print("%s, Value: %s" % (stype, svalue))
+            print("sr_bandwidth.py TEST FAILED")
+            sys.exit(1)
+
+    sys.exit(0)
+
+# =========================================
+# direct invocation : self testing
+# =========================================
+
+if __name__=="__main__":
+   main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+import sys,time
+
+try :
+         from sr_breaker        import *
+except :
+         from sarra.sr_breaker  import *
+
+# ===================================
+# self_test
+# ===================================
+
+class test_logger:
+      def silence(self,str):
+          pass
+      def __init__(self):
+          self.debug   = self.silence
+          self.error   = print
+          self.info    = self.silence
+          self.warning = self.silence
+
+class test_parent:
+      def __init__(self):
+          self.logger            = test_logger()
+          self.breaker_threshold = 3
+          self.breaker_timeout   = 1
+
+def self_test():
+
+    failed  = False
+    logger  = test_logger()
+    breaker = sr_breaker(test_parent())
+
+    # test 01: key is scheme://netloc
+
+    key = breaker.key('sftp://user@host:2222/some/path')
+    if key != 'sftp://user@host:2222' :
+       logger.error("test 01: key %s" % key)
+       failed = True
+
+    # test 02: closed until threshold failures in a row, a success resets the count
+
+    breaker.failure(key)
+    breaker.failure(key)
+    breaker.success(key)
+    breaker.failure(key)
+    breaker.failure(key)
+    if not breaker.allow(key) :
+       logger.error("test 02: breaker should still be closed")
+       failed = True
+
+    # test 03: open, other hosts not affected
+
+    breaker.failure(key)
+    if breaker.allow(key) or not breaker.allow('sftp://user@otherhost') :
+       logger.error("test 03: breaker should be open for %s only" % key)
+       failed = True
+
+    # test 04: half-open after timeout, one probe only, failing probe opens again
+
+    time.sleep(1.1)
+    if not breaker.allow(key) or breaker.allow(key) :
+       logger.error("test 04: half-open should let one probe through")
+       failed = True
+
+    breaker.failure(key)
+    if breaker.allow(key) or breaker.hosts[key][0] != 'open' :
+       logger.error("test 04: failed probe should open the breaker")
+       failed = True
+
+    # test 05: working probe closes
+
+    time.sleep(1.1)
+    breaker.allow(key)
+    breaker.success(key)
+    if not breaker.allow(key) or key in breaker.hosts :
+       logger.error("test 05: breaker should be closed")
+       failed = True
+
+    if not failed :
+                    print("sr_breaker.py TEST PASSED")
+    else :
+                    print("sr_breaker.py TEST FAILED")
+                    sys.exit(1)
+
+# ===================================
+# MAIN
+# ===================================
+
+def main():
+
+    try:    self_test()
+    except:
+            (stype, svalue, tb) = sys.exc_info()
+            print("%s, Value: %s" % (stype, svalue))
+            print("sr_breaker.py TEST FAILED")
+            sys.exit(1)
+
+    sys.exit(0)
+
+# =========================================
+# direct invocation : self testing
+# =========================================
+
+if __name__=="__main__":
+   main()
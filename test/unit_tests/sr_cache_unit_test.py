@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-import tempfile
+import tempfile,tracemalloc
 
 try :
          from sr_cache        import *
@@ -22,6 +22,17 @@ class test_logger:
           self.info    = self.silence
           self.warning = print
 
+def test_entries(cache):
+    return set(cache.expiry.keys())
+
+def test_sums(cache):
+    return set( [ key for key,path,part in cache.expiry ] )
+
+def test_reopen(cfg, path):
+    cache = sr_cache(cfg)
+    cache.open(path)
+    return cache
+
 def self_test():
 
     failed = False
@@ -63,7 +74,7 @@ def self_test():
     cache.load()
 
     # one collision when adding so 2 entries
-    if len(cache.cache_dict) != 2 :
+    if len(test_sums(cache)) != 2 :
        logger.error("test 01: expecting 2 entries...")
        failed = True
 
@@ -74,12 +85,12 @@ def self_test():
     cache.check_expire()
     cache.check('key4','file4',None)
     cache.check('key5','file5','part5')
-    if len(cache.cache_dict) != 3 :
+    if len(test_sums(cache)) != 3 :
        logger.error("test 02: expecting 3 entries...")
        failed = True
 
     #checking cache internals ...
-    #logger.error("%s" % cache.cache_dict)
+    #logger.error("%s" % cache.expiry)
 
     cache.close()
 
@@ -87,7 +98,7 @@ def self_test():
     time.sleep(1)
     cache = sr_cache(cfg)
     cache.open(tmppath)
-    if len(cache.cache_dict) != 0 :
+    if len(test_sums(cache)) != 0 :
        logger.error("test 03: expecting 0 entry...")
        failed = True
     cache.close()
@@ -102,14 +113,14 @@ def self_test():
           cache.check('key%d'%i,'file%d'%i,'part%d'%i)
           i = i + 1
 
-    if len(cache.cache_dict) != 100 :
+    if len(test_sums(cache)) != 100 :
        logger.error("test 04: expecting 100 entries...")
        failed = True
 
     # free cache
     cache.free()
 
-    if len(cache.cache_dict) != 0 :
+    if len(test_sums(cache)) != 0 :
        logger.error("test 05: expecting 0 entry...")
        failed = True
 
@@ -129,14 +140,14 @@ def self_test():
     # delete one
     cache.delete_path('file8')
 
-    if len(cache.cache_dict) != 9 :
-       logger.error("test 06: expecting 9 entries...got %d" % len(cache.cache_dict))
+    if len(test_sums(cache)) != 9 :
+       logger.error("test 06: expecting 9 entries...got %d" % len(test_sums(cache)))
        failed = True
 
     # expire and clean
     time.sleep(1)
     cache.clean()
-    if len(cache.cache_dict) != 0 :
+    if len(test_sums(cache)) != 0 :
        logger.error("test 07: expecting 0 entry...")
        failed = True
 
@@ -144,7 +155,7 @@ def self_test():
     # add one and save
     cache.check('key%d'%i,'file%d'%i,'part2%d'%i)
     cache.save()
-    if len(cache.cache_dict) != 1 :
+    if len(test_sums(cache)) != 1 :
        logger.error("test 08: expecting 1 entry...")
        failed = True
 
@@ -158,6 +169,208 @@ def self_test():
        logger.error("test 10: cache file should have been deleted")
        failed = True
 
+    # expiry order : a refreshed entry is kept, older ones expire
+    cache = sr_cache(cfg)
+    cache.open(tmppath)
+    cache.check('key1','file1','part1')
+    cache.check('key2','file2','part2')
+    time.sleep(0.6)
+    cache.check('key3','file3','part3')
+    cache.check('key1','file1','part1')
+    time.sleep(0.6)
+    cache.clean()
+    if len(test_sums(cache)) != 2 or not 'key1' in test_sums(cache) or len(cache.expiry) != 2 :
+       logger.error("test 11: expecting key1 and key3 entries...")
+       failed = True
+
+    cache.close(unlink=True)
+
+    # bounded cache : least recently seen entries evicted, also on load
+    cfg.cache_max_entries = 10
+    cache = sr_cache(cfg)
+    cache.open(tmppath)
+    for i in range(20):
+          cache.check('key%d'%i,'file%d'%i,'part%d'%i)
+          cache.check('key0','file0','part0')
+    if len(cache.expiry) != 10 or not 'key0' in test_sums(cache) or 'key1' in test_sums(cache) :
+       logger.error("test 12: expecting 10 entries with key0...got %d" % len(cache.expiry))
+       failed = True
+    if cache.hits != 20 or cache.misses != 20 or cache.evictions != 10 :
+       logger.error("test 12: hits %d misses %d evictions %d" % (cache.hits,cache.misses,cache.evictions))
+       failed = True
+    cache.close()
+
+    cfg.cache_max_entries = 5
+    cache = sr_cache(cfg)
+    cache.open(tmppath)
+    if len(cache.expiry) != 5 or not 'key0' in test_sums(cache) or not 'key19' in test_sums(cache) :
+       logger.error("test 13: expecting 5 most recent entries on load...got %d" % len(cache.expiry))
+       failed = True
+    cache.close(unlink=True)
+    cfg.cache_max_entries = 0
+
+    cfg.cache_max_bytes = 10 * ( cache.entry_size + 15 )
+    cache = sr_cache(cfg)
+    cache.open(tmppath)
+    for i in range(100):
+          cache.check('key%d'%i,'file%d'%i,'part%d'%i)
+    if len(cache.expiry) > 10 or cache.bytes > cfg.cache_max_bytes :
+       logger.error("test 14: expecting cache within %d bytes...got %d" % (cfg.cache_max_bytes,cache.bytes))
+       failed = True
+    cache.close(unlink=True)
+    cfg.cache_max_bytes = 0
+
+    # journal : entries appended, replayed on load after the (empty) snapshot
+
+    cfg.caching = 3600
+    cache = test_reopen(cfg, tmppath)
+    for i in range(10):
+          cache.check('key%d'%i,'file%d'%i,'part%d'%i)
+    expected = test_entries(cache)
+    cache.save()
+    cache.close()
+
+    if os.path.getsize(tmppath) != 0 or os.path.exists(cache.journal_old) :
+       logger.error("test 15: small journal compacted")
+       failed = True
+
+    cache = test_reopen(cfg, tmppath)
+    if test_entries(cache) != expected :
+       logger.error("test 15: journal replay %s" % test_entries(cache))
+       failed = True
+
+    # delete_path : tombstone in the journal, entries cached after it are kept
+
+    cache.check('key3b','file3','part3b')
+    cache.delete_path('file3')
+    time.sleep(0.01)
+    cache.check('key3c','file3','part3c')
+    expected -= set([ ('key3','file3','part3') ])
+    expected |= set([ ('key3c','file3','part3c') ])
+    cache.close()
+
+    cache = test_reopen(cfg, tmppath)
+    if test_entries(cache) != expected :
+       logger.error("test 16: delete_path replay %s" % test_entries(cache))
+       failed = True
+
+    # compaction : journal renamed .journal.old, snapshot written to a tmp file and renamed,
+    #              old journal removed, the tombstone is not needed anymore
+
+    cache.journal_min = 0
+    cache.save()
+    cache.compacted()
+
+    snapshot = open(tmppath).read().splitlines()
+    if len(snapshot) != len(expected) or os.path.exists(cache.journal_old) or \
+       os.path.exists(tmppath + '.tmp') or os.path.getsize(cache.journal) != 0 :
+       logger.error("test 17: compaction snapshot of %d lines" % len(snapshot))
+       failed = True
+    cache.close()
+
+    cache = test_reopen(cfg, tmppath)
+    if test_entries(cache) != expected :
+       logger.error("test 17: load after compaction %s" % test_entries(cache))
+       failed = True
+
+    # interrupted compactions : after the journal rename, while writing the tmp file,
+    #                           after the snapshot rename (old journal left)
+
+    write_snapshot = cache.write_snapshot
+
+    def renamed(entries):
+        pass
+
+    def writing(entries):
+        with open(tmppath + '.tmp','w') as fp : fp.write("key99 %f fi" % time.time())
+
+    def snapshot_renamed(entries):
+        old = open(cache.journal_old).read()
+        write_snapshot(entries)
+        with open(cache.journal_old,'w') as fp : fp.write(old)
+
+    for n, interrupted in enumerate([ renamed, writing, snapshot_renamed ]) :
+        cache.check('key%d'%(20+n),'file%d'%(20+n),'part')
+        expected.add( ('key%d'%(20+n),'file%d'%(20+n),'part') )
+        cache.delete_path('file%d'%n)
+        expected -= set([ ('key%d'%n,'file%d'%n,'part%d'%n) ])
+
+        cache.journal_min    = 0
+        cache.journal_ratio  = 0
+        cache.write_snapshot = interrupted
+        cache.save()
+        cache.compacted()
+
+        cache.check('key%d'%(30+n),'file%d'%(30+n),'part')
+        expected.add( ('key%d'%(30+n),'file%d'%(30+n),'part') )
+        cache.close()
+
+        if not os.path.exists(cache.journal_old) :
+           logger.error("test 18: %s, old journal missing" % interrupted.__name__)
+           failed = True
+
+        cache = test_reopen(cfg, tmppath)
+        if test_entries(cache) != expected :
+           logger.error("test 18: %s, load %s" % (interrupted.__name__,test_entries(cache)))
+           failed = True
+
+        # next compaction completes, appending the journal to the old one
+
+        write_snapshot      = cache.write_snapshot
+        cache.journal_min   = 0
+        cache.journal_ratio = 0
+        cache.save()
+        cache.compacted()
+        cache.close()
+
+        if os.path.exists(cache.journal_old) or os.path.exists(tmppath + '.tmp') :
+           logger.error("test 19: %s, compaction not completed" % interrupted.__name__)
+           failed = True
+
+        cache = test_reopen(cfg, tmppath)
+        if test_entries(cache) != expected :
+           logger.error("test 19: %s, load after compaction %s" % (interrupted.__name__,test_entries(cache)))
+           failed = True
+
+    cache.close(unlink=True)
+
+    # test 20: count is the number of entries. bytes, within 20% of the memory measured
+
+    cache = test_reopen(cfg, tmppath)
+    n     = 20000
+    tracemalloc.start()
+    for i in range(n) :
+        cache.check('d,%032x' % i, '/data/path/file%08d' % i, '1,%d,1,0,0' % i)
+        cache.check('d,%032x' % i, '/data/path/file%08d' % i, '1,%d,1,0,0' % i)
+    measured = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    if cache.count != n or abs(measured - cache.bytes) > 0.2 * measured :
+       logger.error("test 20: %d entries (count %d), %d bytes per entry measured, %d estimated" % \
+                    (n,cache.count,measured/n,cache.bytes/n))
+       failed = True
+
+    counts = []
+    cache.max_entries = n // 2
+    cache.evict()
+    counts.append( (cache.count,len(cache.expiry)) )
+    cache.delete_path('/data/path/file%08d' % (n-1))
+    counts.append( (cache.count,len(cache.expiry)) )
+    cache.check('key0','file0','part0')
+    counts.append( (cache.count,len(cache.expiry)) )
+    cache.close()
+    cfg.cache_max_entries = n // 4
+    cache = test_reopen(cfg, tmppath)
+    counts.append( (cache.count,len(cache.expiry)) )
+
+    if counts != [ (n//2,n//2), (n//2-1,n//2-1), (n//2,n//2), (n//4,n//4) ] :
+       logger.error("test 20: count, entries %s" % counts)
+       failed = True
+
+    cache.close(unlink=True)
+    cfg.cache_max_entries = 0
+    cfg.caching = 1
+
     if not failed :
                     print("sr_cache.py TEST PASSED")
     else :          
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+import hashlib,tempfile
+
+try :
+         from sr_file         import *
+except :
+         from sarra.sr_file   import *
+
+# ===================================
+# self_test
+# ===================================
+
+class test_md5:
+      def set_path(self,path):
+          self.filehash = hashlib.md5()
+      def update(self,chunk):
+          self.filehash.update(chunk)
+      def get_value(self):
+          return self.filehash.hexdigest()
+
+def self_test():
+
+    failed = False
+
+    tmpdirname = tempfile.TemporaryDirectory().name
+    try    : os.mkdir(tmpdirname)
+    except : pass
+    src_file   = tmpdirname + os.sep + 'copy_src'
+    dst_file   = tmpdirname + os.sep + 'copy_dst'
+
+    data = os.urandom(3 * 1024 * 1024 + 123)
+    fp   = open(src_file,'wb')
+    fp.write(data)
+    fp.close()
+
+    # test 01: whole file with checksum
+
+    chk = test_md5()
+    chk.set_path(src_file)
+    src = open(src_file,'rb')
+    dst = open(dst_file,'wb+')
+    n   = file_copy(src, dst, len(data), 65536, chk)
+    src.close()
+    dst.close()
+
+    fp   = open(dst_file,'rb')
+    copy = fp.read()
+    fp.close()
+
+    if n != len(data) or copy != data or chk.get_value() != hashlib.md5(data).hexdigest() :
+       print("test 01: file_copy whole file : Failed")
+       failed = True
+
+    # test 02: a part, at an offset in both files, file positions after the copy
+
+    chk = test_md5()
+    chk.set_path(src_file)
+    src = open(src_file,'rb')
+    dst = open(dst_file,'r+b')
+    src.seek(100000)
+    dst.seek(5000)
+    n   = file_copy(src, dst, 200000, 65536, chk)
+    if n != 200000 or src.tell() != 300000 or dst.tell() != 205000 :
+       print("test 02: file_copy positions after copy %d %d : Failed" % (src.tell(),dst.tell()))
+       failed = True
+    src.close()
+    dst.close()
+
+    fp   = open(dst_file,'rb')
+    copy = fp.read()
+    fp.close()
+
+    if copy[:5000] != data[:5000] or copy[5000:205000] != data[100000:300000] or \
+       copy[205000:] != data[205000:] or chk.get_value() != hashlib.md5(data[100000:300000]).hexdigest() :
+       print("test 02: file_copy part : Failed")
+       failed = True
+
+    # test 03: src shorter than length
+
+    src = open(src_file,'rb')
+    dst = open(dst_file,'r+b')
+    src.seek(len(data) - 1000)
+    n   = file_copy(src, dst, 5000, 65536)
+    src.close()
+    dst.close()
+
+    if n != 1000 :
+       print("test 03: file_copy short source copied %d : Failed" % n)
+       failed = True
+
+    # test 04: python copy when the kernel copy does not work
+
+    if hasattr(os,'copy_file_range') :
+       copy_file_range = os.copy_file_range
+       def no_copy_file_range(*args) :
+           raise OSError(errno.EXDEV,'cross device')
+       os.copy_file_range = no_copy_file_range
+    sendfile = os.sendfile
+    def no_sendfile(*args) :
+        raise OSError(errno.EINVAL,'invalid')
+    os.sendfile = no_sendfile
+
+    chk = test_md5()
+    chk.set_path(src_file)
+    src = open(src_file,'rb')
+    dst = open(dst_file,'wb+')
+    n   = file_copy(src, dst, len(data), 65536, chk)
+    src.close()
+    dst.close()
+
+    if hasattr(os,'copy_file_range') : os.copy_file_range = copy_file_range
+    os.sendfile = sendfile
+
+    fp   = open(dst_file,'rb')
+    copy = fp.read()
+    fp.close()
+
+    if n != len(data) or copy != data or chk.get_value() != hashlib.md5(data).hexdigest() :
+       print("test 04: file_copy without kernel copy : Failed")
+       failed = True
+
+    os.unlink(src_file)
+    os.unlink(dst_file)
+
+    if not failed :
+                    print("sr_file.py TEST PASSED")
+    else :
+                    print("sr_file.py TEST FAILED")
+                    sys.exit(1)
+
+# ===================================
+# MAIN
+# ===================================
+
+def main():
+
+    try:    self_test()
+    except:
+            (stype, svalue, tb) = sys.exc_info()
+            print("%s, Value: %s" % (stype, svalue))
+            print("sr_file.py TEST FAILED")
+            sys.exit(1)
+
+    sys.exit(0)
+
+# =========================================
+# direct invocation : self testing
+# =========================================
+
+if __name__=="__main__":
+   main()
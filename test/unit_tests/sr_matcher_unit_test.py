@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+import random,re,sys,time
+
+try :
+         from sr_matcher        import *
+except :
+         from sarra.sr_matcher  import *
+
+# ===================================
+# the original linear loop of sr_config.isMatchingPattern
+# ===================================
+
+def linear_match(masks,chaine):
+    for i,mask in enumerate(masks):
+        pattern, maskDir, maskFileOption, mask_regexp, accepting = mask
+        if mask_regexp.match(chaine) : return i
+    return None
+
+def build_masks(patterns):
+    masks = []
+    for pattern,accepting in patterns:
+        masks.append( (pattern, '/dir', None, re.compile(pattern), accepting) )
+    return masks
+
+# ===================================
+# self_test
+# ===================================
+
+def self_test():
+
+    failed = False
+
+    # test 01: first match wins and the right mask is returned in a folded run
+
+    masks   = build_masks( [ ('.*\.tmp$',False), ('.*/(a)/.*',True), ('.*/b/.*',True), ('.*',False) ] )
+    matcher = sr_matcher(masks)
+
+    tests = [ ('http://host/a/file.tmp',0), ('http://host/a/file',1), ('http://host/b/file',2), ('http://host/c/file',3) ]
+    for chaine,expected in tests :
+        i = matcher.match(chaine)
+        if i != expected :
+           print("test 01: %s matched mask %s expected %s" % (chaine,i,expected))
+           failed = True
+
+    # test 02: literal prefixes
+
+    tests = [ ('http://host/a/.*','http://host/a/'), ('.*','') , ('ab?c','a'), ('abc|xyz',''), ('a\.b','a') ]
+    for pattern,expected in tests :
+        prefix = matcher.literal_prefix(pattern)
+        if prefix != expected :
+           print("test 02: prefix of %s is %s expected %s" % (pattern,prefix,expected))
+           failed = True
+
+    # test 03: patterns that cannot be folded (back references, inline flags)
+
+    masks   = build_masks( [ ('.*/(x)/\\1.*',True), ('(?i).*/Y/.*',True), ('.*/z/.*',False) ] )
+    matcher = sr_matcher(masks)
+
+    tests = [ ('http://h/x/x1',0), ('http://h/y/f',1), ('http://h/z/f',2), ('http://h/w/f',None) ]
+    for chaine,expected in tests :
+        i = matcher.match(chaine)
+        if i != expected :
+           print("test 03: %s matched mask %s expected %s" % (chaine,i,expected))
+           failed = True
+
+    # test 04: same results as the linear loop on random masks and paths
+
+    random.seed(1)
+    dirs     = [ 'http://host/data/%s/%02d/' % (d,h) for d in ['radar','sat','obs','nwp'] for h in range(24) ]
+    patterns = []
+    for i in range(300):
+        d = random.choice(dirs)
+        c = random.choice( [ d + '.*%d.*' % i, '.*%d\.grib2$' % i, d[:-3] + '.*', '.*/obs/.*_%d_.*' % i ] )
+        patterns.append( (c, random.random() < 0.6) )
+
+    masks   = build_masks(patterns)
+    matcher = sr_matcher(masks)
+    chaines = [ random.choice(dirs) + 'file_%d_%d.grib2' % (random.randint(0,400),random.randint(0,400)) for i in range(5000) ]
+
+    for chaine in chaines :
+        if matcher.match(chaine) != linear_match(masks,chaine) :
+           print("test 04: %s differs from linear match" % chaine)
+           failed = True
+           break
+
+    # microbenchmark against the linear loop, with a typical subscribe config : 
+    # a few rejects, a lot of accepts in given directories, and reject everything else.
+
+    patterns  = [ ('.*\.tmp$',False) ] + [ ('.*_%d_.*\.bad$' % i,False) for i in range(20) ]
+    patterns += [ (random.choice(dirs) + '.*_%d\.grib2$' % i,True) for i in range(280) ]
+    patterns += [ ('.*',False) ]
+
+    masks   = build_masks(patterns)
+    matcher = sr_matcher(masks)
+
+    for chaine in chaines :
+        if matcher.match(chaine) != linear_match(masks,chaine) :
+           print("test 05: %s differs from linear match" % chaine)
+           failed = True
+           break
+
+    start = time.time()
+    for chaine in chaines : linear_match(masks,chaine)
+    linear = time.time() - start
+
+    start = time.time()
+    for chaine in chaines : matcher.match(chaine)
+    compiled = time.time() - start
+
+    print("sr_matcher benchmark %d masks %d paths: linear %.3fs compiled %.3fs (%.1fx) lru hits %d misses %d" % \
+          (len(masks),len(chaines),linear,compiled,linear/max(compiled,1e-9),matcher.hits,matcher.misses))
+
+    if not failed :
+                    print("sr_matcher.py TEST PASSED")
+    else :
+                    print("sr_matcher.py TEST FAILED")
+                    sys.exit(1)
+
+# ===================================
+# MAIN
+# ===================================
+
+def main():
+
+    try:    self_test()
+    except:
+            (stype, svalue, tb) = sys.exc_info()
+            print("%s, Value: %s" % (stype, svalue))
+            print("sr_matcher.py TEST FAILED")
+            sys.exit(1)
+
+    sys.exit(0)
+
+# =========================================
+# direct invocation : self testing
+# =========================================
+
+if __name__=="__main__":
+   main()
@@ -146,55 +146,98 @@ def test_retry_msg_append_get_file(retry,message):
 
     os.unlink(path)
 
+# segment files on disk
+def segment_files(retry):
+    dirname, basename = os.path.split(retry.retry_path)
+    return sorted( [ f for f in os.listdir(dirname) if f.startswith(basename + '.0') ] )
+
 # test retry_get simple
 def test_retry_get_simple(retry,message):
+    global failed
 
     # first case... retry.get with nothing
 
     if retry.get():
-       retry.logger.error("test 11: append_get retry.get message should be None")
+       retry.logger.error("test 11: retry.get message should be None")
        failed = True
 
-    # second case... retry.get with 3 retry messages
+    # second case... retry.get with 3 retry messages, due now
 
-    fp   = None
-    path = retry.retry_path
-    i    = 0 
+    retry.backoff_min = 0
+    i = 0 
     while i < 3 :
           i = i+1
           message.body = '%s xyz://user@host /my/terrible/path%.10d' % (timeflt2str(time.time()),i)
-          fp = retry.msg_append_to_file(fp,path,message)
-    fp.close()
+          retry.add_msg_to_new_file(message)
 
     # read them in
     t = 0
     while True :
           msg = retry.get()
           if not msg : break
+          retry.add_msg_to_state_file(msg,done=True)
           t = t + 1
 
     if t != 3 :
        retry.logger.error("test 12: get simple problem reading 3 retry messages")
        failed = True
 
-    if os.path.isfile(path):
-       retry.logger.error("test 13: get simple complete reading implies unlink")
+    retry.on_heartbeat(retry.parent)
+    if segment_files(retry):
+       retry.logger.error("test 13: get simple no more retry implies unlink")
+       failed = True
+
+# test backoff : only due messages are returned
+def test_retry_backoff(retry,message):
+    global failed
+
+    retry.backoff_min = 10
+    retry.backoff_max = 60
+
+    if retry.backoff(1) != 10 or retry.backoff(3) != 40 or retry.backoff(100) != 60 :
+       retry.logger.error("test 14: backoff %d %d %d" % (retry.backoff(1),retry.backoff(3),retry.backoff(100)))
+       failed = True
+
+    message.body = '%s xyz://user@host /my/terrible/path%.10d' % (timeflt2str(time.time()),1)
+    retry.add_msg_to_new_file(message)
+    if retry.get() != None :
+       retry.logger.error("test 15: message returned before it is due")
        failed = True
 
+    # make it due, fail it again : attempts goes up, not due again
+
+    retry.heap = [ (0.0,id,seg,offset) for next,id,seg,offset in retry.heap ]
+    msg = retry.get()
+    if msg == None or msg.retry_attempts != 1 :
+       retry.logger.error("test 15: due message not returned")
+       failed = True
+    retry.add_msg_to_state_file(msg)
+    if retry.get() != None or retry.heap[0][0] < time.time() + 15 :
+       retry.logger.error("test 15: failed message should wait 20 secs")
+       failed = True
+
+    retry.heap = [ (0.0,id,seg,offset) for next,id,seg,offset in retry.heap ]
+    msg = retry.get()
+    if msg == None or msg.retry_attempts != 2 :
+       retry.logger.error("test 15: second attempt not returned")
+       failed = True
+    retry.add_msg_to_state_file(msg,done=True)
+
+    retry.backoff_min = 0
+    retry.on_heartbeat(retry.parent)
+
 # overall case
 def test_retry_overall(retry,message):
+    global failed
 
-    # retry file has 10 messages...  half fails   ... and every 4 messages processed one new added
+    # retry has 10 messages...  half fails ... and every 4 messages processed one new added
     # on_heartbeat every time needed
 
-    # add 10 messages to retry file
-    fp        = None
     msg_count = 0 
     while msg_count < 10 :
           message.body = '%s xyz://user@host /my/terrible/path%.10d' % (timeflt2str(time.time()),msg_count)
-          fp = retry.msg_append_to_file(fp,retry.retry_path,message)
+          retry.add_msg_to_new_file(message)
           msg_count = msg_count + 1
-    fp.close()
 
     # read them with half success
 
@@ -239,124 +282,226 @@ def test_retry_overall(retry,message):
     # msg_count != done d_count ...
 
     if msg_count != d_count :
-       retry.logger.error("test 14: overall count failed msg_count %d  done_count %d ( failed %d, heartb %d)" % \
+       retry.logger.error("test 16: overall count failed msg_count %d  done_count %d ( failed %d, heartb %d)" % \
        (msg_count,d_count,f_count,h_count))
        failed = True
 
-    if os.path.isfile(retry.retry_path) :
-       retry.logger.error("test 15: overall retry_path completely read, should have been deleted")
+    retry.on_heartbeat(retry.parent)
+    if segment_files(retry) :
+       retry.logger.error("test 17: overall retry_path completely read, should have been deleted")
        failed = True
 
+# crash case : the index is rebuilt from the file by a new instance
+def test_retry_crash(retry,message):
+    global failed
 
-# ctrl_c case
-def test_retry_ctrl_c(retry,message):
-
-    # retry file has 10 messages...  half fails   ... and every 4 messages processed one new added
-    # on_heartbeat every time needed
-
-    # add 10 messages to retry file
-    fp        = None
-    msg_count = 0 
+    msg_count = 0
     while msg_count < 10 :
           message.body = '%s xyz://user@host /my/terrible/path%.10d' % (timeflt2str(time.time()),msg_count)
-          fp = retry.msg_append_to_file(fp,retry.retry_path,message)
+          retry.add_msg_to_new_file(message)
           msg_count = msg_count + 1
+
+    # 4 done, 2 failed again, 1 inflight when crashing
+
+    for i in range(7) :
+        msg = retry.get()
+        if   i < 4 : retry.add_msg_to_state_file(msg,done=True)
+        elif i < 6 : retry.add_msg_to_state_file(msg)
+
+    # last line partially written
+
+    fp = open(retry.segment_path(retry.segments[-1]),'a')
+    fp.write('["v02.post.partial", {"sum": ')
     fp.close()
 
-    # read them with half success
+    retry = sr_retry(retry.parent)
+    retry.backoff_min = 0
 
-    i       = 0
-    h_done  = 1 # heartbeat done
-    h_count = 0 # heartbeat count
-    d_count = 0 # done      count
-    f_count = 0 # failed    count
-    a_count = 0 # added     count when 4  ctrl_c
+    bodies = set()
     while True :
           msg = retry.get()
+          if not msg : break
+          bodies.add(msg.body)
+          retry.add_msg_to_state_file(msg,done=True)
 
-          # heartbeat or done
-          if not msg :
-             if h_done : break
-             retry.on_heartbeat(retry.parent)
-             h_count = h_count + 1
-             h_done  = 1
-             continue
-          h_done = 0
+    if len(bodies) != 6 :
+       retry.logger.error("test 18: crash expecting 6 messages to retry, got %d" % len(bodies))
+       failed = True
 
-          # processing another message
-          i = i+1
+    # older version files : retry, new and state
 
-          # success or fail
-          r = i%2
-          if r == 1 :
-             retry.add_msg_to_state_file(msg)
-             f_count = f_count + 1
-          else :
-             retry.add_msg_to_state_file(msg,done=True)
-             d_count = d_count + 1
+    retry.on_heartbeat(retry.parent)
 
-          # every 4 success add a new retry
-          r = i % 4
-          if r == 0 :
-             try   : del message.properties['application_headers']['_retry_tag_']
-             except: pass
-             message.body = '%s xyz://user@host /my/terrible/path%.10d' % (timeflt2str(time.time()),msg_count)
-             retry.add_msg_to_new_file(message)
-             msg_count = msg_count + 1
-             a_count   = a_count + 1
-             if a_count == 2 : break
+    fp = None
+    for i in range(3) :
+        message.body = '%s xyz://user@host /my/old/path%.10d' % (timeflt2str(time.time()),i)
+        fp = retry.msg_append_to_file(fp,retry.retry_path,message)
+    fp.close()
+    retry.msg_append_to_file(None,retry.new_path,message).close()
+    message.body = '%s xyz://user@host /my/old/path%.10d' % (timeflt2str(time.time()),5)
+    retry.msg_append_to_file(None,retry.state_path,message).close()
+    try   : del message.properties['application_headers']['_retry_tag_']
+    except: pass
 
-    # ctrl_c heartbeat
-    
-    retry.close()
+    retry = sr_retry(retry.parent)
+    retry.backoff_min = 0
+    count = len(retry.heap)
+    retry.heap = [ (0.0,id,seg,offset) for next,id,seg,offset in retry.heap ]
+    while True :
+          msg = retry.get()
+          if not msg : break
+          retry.add_msg_to_state_file(msg,done=True)
     retry.on_heartbeat(retry.parent)
 
-    # start same loop
+    if count != 5 or os.path.isfile(retry.new_path) or os.path.isfile(retry.state_path) :
+       retry.logger.error("test 19: older version files expecting 5 messages, got %d" % count)
+       failed = True
+
+# segments : heartbeat deletes only consumed segments
+def test_retry_segments(retry,message):
+    global failed
+
+    retry = sr_retry(retry.parent)
+    retry.backoff_min   = 0
+    retry.segment_lines = 10
+
+    for i in range(30) :
+        message.body = '%s xyz://user@host /my/terrible/path%.10d' % (timeflt2str(time.time()),i)
+        retry.add_msg_to_new_file(message)
+
+    # first 10 done, next 10 failed again : the first 2 segments are consumed,
+    # the one with the tombstones is kept while the third is there.
+
+    for i in range(20) :
+        msg = retry.get()
+        retry.add_msg_to_state_file(msg,done= i < 10)
+
+    before = segment_files(retry)
+    retry.on_heartbeat(retry.parent)
+    after  = segment_files(retry)
+
+    if len(before) != 5 or after != before[2:] :
+       retry.logger.error("test 20: segments expecting %s to drop first two, got %s" % (before,after))
+       failed = True
+
+    # the others done : all segments deleted
+
     while True :
           msg = retry.get()
+          if not msg : break
+          retry.add_msg_to_state_file(msg,done=True)
 
-          # heartbeat or done
-          if not msg :
-             if h_done : break
-             retry.on_heartbeat(retry.parent)
-             h_count = h_count + 1
-             h_done  = 1
-             continue
-          h_done = 0
+    retry.on_heartbeat(retry.parent)
+    if segment_files(retry) :
+       retry.logger.error("test 21: all segments consumed, still %s" % segment_files(retry))
+       failed = True
 
-          # processing another message
-          i = i+1
+    # expired segment deleted, even if not consumed
 
-          # success or fail
-          r = i%2
-          if r == 1 :
-             retry.add_msg_to_state_file(msg)
-             f_count = f_count + 1
-          else :
-             retry.add_msg_to_state_file(msg,done=True)
-             d_count = d_count + 1
+    retry.retry_ttl = 2
+    message.body = '%s xyz://user@host /my/terrible/path%.10d' % (timeflt2str(time.time()-10),1)
+    retry.add_msg_to_new_file(message)
+    retry.on_heartbeat(retry.parent)
+    if segment_files(retry) or retry.get() != None :
+       retry.logger.error("test 22: expired segment not deleted")
+       failed = True
 
-          # every 4 success add a new retry
-          r = i % 4
-          if r == 0 :
-             try   : del message.properties['application_headers']['_retry_tag_']
-             except: pass
-             message.body = '%s xyz://user@host /my/terrible/path%.10d' % (timeflt2str(time.time()),msg_count)
-             retry.add_msg_to_new_file(message)
-             msg_count = msg_count + 1
-             
+    retry.retry_ttl     = 100000
+    retry.segment_lines = 100000
 
-    # msg_count != done d_count ...
+# a retry returned by get, never done nor failed (rejected by accept/reject)
+def test_retry_abandoned(retry,message):
+    global failed
 
-    if msg_count != d_count :
-       retry.logger.error("test 16: ctrl_c count failed msg_count %d  done_count %d ( failed %d, heartb %d)" % \
-       (msg_count,d_count,f_count,h_count))
+    retry = sr_retry(retry.parent)
+    retry.backoff_min   = 0
+    retry.segment_lines = 10
+
+    for i in range(20) :
+        message.body = '%s xyz://user@host /my/terrible/path%.10d' % (timeflt2str(time.time()),i)
+        retry.add_msg_to_new_file(message)
+
+    # the first one abandoned, the others done
+
+    abandoned = retry.get()
+    while True :
+          msg = retry.get()
+          if not msg : break
+          retry.add_msg_to_state_file(msg,done=True)
+
+    # still inflight at the first heartbeat : its segment is kept
+
+    retry.on_heartbeat(retry.parent)
+    if len(retry.inflight) != 1 or len(segment_files(retry)) < 1 :
+       retry.logger.error("test 23: abandoned retry dropped too early %s" % segment_files(retry))
        failed = True
 
-    if os.path.isfile(retry.retry_path) :
-       retry.logger.error("test 17: ctrl_c retry_path completely read, should have been deleted")
+    # still inflight at the next one : done, all segments deleted
+
+    retry.on_heartbeat(retry.parent)
+    if retry.inflight or segment_files(retry) :
+       retry.logger.error("test 24: abandoned retry kept %s %s" % (retry.inflight,segment_files(retry)))
+       failed = True
+
+    # and not back when loading
+
+    retry.load()
+    if retry.get() != None :
+       retry.logger.error("test 25: abandoned retry back when loading")
        failed = True
 
+    retry.close()
+    retry.segment_lines = 100000
+
+# benchmark : N retries queued, loaded, all due and done
+def test_retry_benchmark(retry,message,top):
+
+    retry.backoff_min = 0
+
+    now = time.time()
+    for i in range(top):
+        message.body = '%s xyz://user@host /my/terrible/path%.10d' % (timeflt2str(now),i)
+        retry.add_msg_to_new_file(message)
+    add = time.time() - now
+    retry.close()
+
+    now   = time.time()
+    retry = sr_retry(retry.parent)
+    retry.backoff_min = 0
+    load  = time.time() - now
+
+    # a broken destination : nothing due
+
+    retry.heap = [ (next+3600,id,seg,offset) for next,id,seg,offset in retry.heap ]
+    now = time.time()
+    for i in range(1000): retry.get()
+    idle = (time.time() - now) / 1000
+
+    retry.heap = [ (next-3600,id,seg,offset) for next,id,seg,offset in retry.heap ]
+    heapq.heapify(retry.heap)
+    now = time.time()
+    for i in range(top//2):
+        msg = retry.get()
+        retry.add_msg_to_state_file(msg,done=True)
+    get = time.time() - now
+
+    # heartbeat with half of the retries done
+
+    now = time.time()
+    retry.on_heartbeat(retry.parent)
+    heartbeat = time.time() - now
+
+    for i in range(top-top//2):
+        msg = retry.get()
+        retry.add_msg_to_state_file(msg,done=True)
+
+    now = time.time()
+    retry.on_heartbeat(retry.parent)
+    heartbeat_done = time.time() - now
+
+    print("sr_retry benchmark %d retries: add %.1fs load %.1fs get+done (half) %.1fs heartbeat %.3fs (all done %.3fs), get with none due %.1f usec" % \
+          (top,add,load,get,heartbeat,heartbeat_done,idle*1000000))
+
 def self_test():
 
     retry_path = '/tmp/retry'
@@ -368,6 +513,8 @@ def self_test():
     except: pass
     try   : os.unlink(retry_path+'.heart')
     except: pass
+    for f in os.listdir('/tmp') :
+        if f.startswith('retry.0') : os.unlink('/tmp/' + f)
 
     logger = test_logger()
 
@@ -411,13 +558,35 @@ def self_test():
 
     test_retry_get_simple(retry,message)
 
+    # test backoff
+
+    test_retry_backoff(retry,message)
+
     # test complex case no interrup
 
     test_retry_overall(retry,message)
 
-    # test ctrl_c
+    # test crash
+
+    test_retry_crash(retry,message)
 
-    test_retry_ctrl_c(retry,message)
+    # test segments
+
+    test_retry_segments(retry,message)
+
+    # test abandoned retries
+
+    test_retry_abandoned(retry,message)
+
+    # benchmark, number of retries as argument
+
+    top = 100000
+    if len(sys.argv) > 1 : top = int(sys.argv[1])
+
+    retry.close()
+    try   : os.unlink(retry_path)
+    except: pass
+    test_retry_benchmark(retry,message,top)
 
     # test close
 
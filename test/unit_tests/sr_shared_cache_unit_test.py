@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+import hashlib,multiprocessing,random,tempfile
+
+try :
+         from sr_shared_cache        import *
+         from sr_config              import *
+except :
+         from sarra.sr_shared_cache  import *
+         from sarra.sr_config        import *
+
+# ===================================
+# self_test
+# ===================================
+
+class test_logger:
+      def silence(self,str):
+          pass
+      def __init__(self):
+          self.debug   = self.silence
+          self.error   = print
+          self.info    = self.silence
+          self.warning = print
+
+# stress : one process, checking the same entries as the others in another order
+
+def stress(cfg,tmppath,entries,seed,results):
+    random.seed(seed)
+    random.shuffle(entries)
+
+    cache = sr_shared_cache(cfg)
+    cache.open(tmppath)
+    new = 0
+    for key,path,part in entries :
+        if cache.check(key,path,part) : new += 1
+    cache.close()
+
+    results.put(new)
+
+# an instance in the middle of a check : the bucket of an entry locked for delay seconds
+
+def hold_bucket(cfg,tmppath,locked,delay):
+    cache  = sr_shared_cache(cfg)
+    cache.open(tmppath)
+    digest = hashlib.blake2b( 'key1 file1 part1'.encode('utf-8'), digest_size=16 ).digest()
+    offset = cache.bucket(digest)
+    cache.lock(offset)
+    locked.put(True)
+    time.sleep(delay)
+    cache.check('key1','file1','part1')
+    cache.unlock(offset)
+    cache.close()
+
+def self_test():
+
+    failed = False
+
+    logger = test_logger()
+
+    # creating a temporary cache directory/file
+
+    tmpdirname = tempfile.TemporaryDirectory().name
+    try    : os.mkdir(tmpdirname)
+    except : pass
+    tmppath    = tmpdirname + os.sep + 'shared_cache_test_file'
+
+    cfg        = sr_config(config=None,args=['test','--debug','False'])
+    cfg.logger = logger
+    cfg.config_name = "test"
+
+    cfg.debug  = False
+    cfg.defaults()
+    cfg.debug  = False
+
+    cfg.general()
+
+    optH = "caching 1"
+    cfg.option( optH.split()  )
+    cfg.option( ['cache_max_entries','1000'] )
+
+    # check creation addition close and reopen
+
+    cache = sr_shared_cache(cfg)
+    cache.open(tmppath)
+    if not cache.check('key1','file1','part1') or not cache.check('key2','file2','part2') :
+       logger.error("test 01: new entries not seen as new")
+       failed = True
+    if cache.check('key1','file1','part1') :
+       logger.error("test 01: duplicate seen as new")
+       failed = True
+    cache.close()
+
+    cache = sr_shared_cache(cfg)
+    cache.open(tmppath)
+    if cache.count != 2 or cache.check('key2','file2','part2') :
+       logger.error("test 02: expecting 2 entries after reopen...got %d" % cache.count)
+       failed = True
+
+    # delete_path, expiry
+
+    cache.check('key3','file3','part3')
+    cache.check('key4','file3','part4')
+    cache.delete_path('file3')
+    if not cache.check('key3','file3','part3') :
+       logger.error("test 03: deleted path still in cache")
+       failed = True
+
+    time.sleep(1.1)
+    cache.clean()
+    if cache.count != 0 or not cache.check('key1','file1','part1') :
+       logger.error("test 04: expecting expired entries...got %d" % cache.count)
+       failed = True
+
+    # a full table evicts its oldest entries
+
+    for i in range(5000):
+        cache.check('key%d'%i,'file%d'%i,'part%d'%i)
+    cache.save()
+    if cache.count > 1000 or cache.evictions == 0 :
+       logger.error("test 05: expecting at most 1000 entries...got %d" % cache.count)
+       failed = True
+
+    cache.free()
+    if cache.count != 0 :
+       logger.error("test 06: expecting empty cache after free...got %d" % cache.count)
+       failed = True
+
+    # free waits for the checks in progress in other instances
+
+    cache.check('key1','file1','part1')
+    locked = multiprocessing.Queue()
+    proc   = multiprocessing.Process(target=hold_bucket,args=(cfg,tmppath,locked,0.5))
+    proc.start()
+    locked.get()
+    start  = time.time()
+    cache.free()
+    elapse = time.time() - start
+    proc.join()
+
+    if elapse < 0.3 or not cache.check('key1','file1','part1') :
+       logger.error("test 06: free did not wait for a bucket locked (%.2fs)" % elapse)
+       failed = True
+
+    cache.close(unlink=True)
+    if os.path.exists(tmppath) :
+       logger.error("test 07: cache file should have been deleted")
+       failed = True
+
+    # stress : several processes checking the same entries, each entry
+    #          must be seen as new by one process only.
+
+    cfg.caching           = 300
+    cfg.cache_max_entries = 1000000
+
+    nprocs  = 8
+    entries = [ ('key%d'%i, 'dir%d/file%d' % (i%100,i), '1,%d,1,0,0' % i) for i in range(20000) ]
+
+    results = multiprocessing.Queue()
+    procs   = [ multiprocessing.Process(target=stress,args=(cfg,tmppath,list(entries),n,results)) for n in range(nprocs) ]
+
+    start = time.time()
+    for p in procs : p.start()
+    new   = sum( [ results.get() for p in procs ] )
+    for p in procs : p.join()
+    elapse = time.time() - start
+
+    if new != len(entries) :
+       logger.error("test 08: %d processes, expecting %d new entries...got %d" % (nprocs,len(entries),new))
+       failed = True
+
+    print("sr_shared_cache stress %d processes %d checks in %.2fs (%d checks/s)" % \
+          (nprocs, nprocs*len(entries), elapse, nprocs*len(entries)/elapse))
+
+    cache = sr_shared_cache(cfg)
+    cache.open(tmppath)
+    if cache.count != len(entries) :
+       logger.error("test 09: expecting %d entries...got %d" % (len(entries),cache.count))
+       failed = True
+    cache.close(unlink=True)
+
+    if not failed :
+                    print("sr_shared_cache.py TEST PASSED")
+    else :
+                    print("sr_shared_cache.py TEST FAILED")
+                    sys.exit(1)
+
+
+# ===================================
+# MAIN
+# ===================================
+
+def main():
+
+    try:    self_test()
+    except:
+            (stype, svalue, tb) = sys.exc_info()
+            print("%s, Value: %s" % (stype, svalue))
+            print("sr_shared_cache.py TEST FAILED")
+            sys.exit(1)
+
+    sys.exit(0)
+
+# =========================================
+# direct invocation : self testing
+# =========================================
+
+if __name__=="__main__":
+   main()
@@ -1,12 +1,156 @@
 #!/usr/bin/env python3
 
-import tempfile
+import filecmp,hashlib,tempfile
 
 try :
          from sr_util         import *
 except :
          from sarra.sr_util   import *
 
+# ===================================
+# sr_proto test parent, sources and checksum
+# ===================================
+
+class test_logger:
+      def silence(self,str):
+          pass
+      def __init__(self):
+          self.debug   = self.silence
+          self.error   = print
+          self.info    = self.silence
+          self.warning = print
+
+class test_parent:
+      def __init__(self):
+          self.logger    = test_logger()
+          self.bufsize   = 65536
+          self.kbytes_ps = 0
+          self.timeout   = 0
+
+class test_md5:
+      def set_path(self,path):
+          self.filehash = hashlib.md5()
+          self.types    = set()
+      def update(self,chunk):
+          self.types.add(type(chunk))
+          self.filehash.update(chunk)
+      def get_value(self):
+          return self.filehash.hexdigest()
+
+# as checksum_d : update accepts a memoryview of the transfer buffer
+
+class test_md5_buffer(test_md5):
+      update_buffer = True
+
+# stream without readinto
+
+class test_stream:
+      def __init__(self,path):
+          self.fp = open(path,'rb')
+      def read(self,size):
+          return self.fp.read(size)
+      def seek(self,offset):
+          self.fp.seek(offset)
+      def close(self):
+          self.fp.close()
+
+# simulated sftp like source : paramiko readinto is a read copied into the buffer
+
+class test_sftp_file(test_stream):
+      def readinto(self,buff):
+          data = self.read(len(buff))
+          buff[:len(data)] = data
+          return len(data)
+
+# source taking delay seconds per chunk
+
+class test_slow_file(test_stream):
+      def __init__(self,path,delay):
+          test_stream.__init__(self,path)
+          self.delay = delay
+      def readinto(self,buff):
+          time.sleep(self.delay)
+          data = self.read(len(buff))
+          buff[:len(data)] = data
+          return len(data)
+
+# read_write as it was : new chunk per read, one alarm per chunk
+
+def read_write_alarm(proto, src, dst, length=0):
+    rw_length = 0
+    while True :
+          if proto.iotime: alarm_set(proto.iotime)
+          chunk = src.read(proto.bufsize)
+          if chunk :
+             dst.write(chunk)
+             rw_length += len(chunk)
+          alarm_cancel()
+          if not chunk : break
+          if proto.sumalgo  : proto.sumalgo.update(chunk)
+    return rw_length
+
+# ftplib retrbinary : the callback gets a new chunk per recv
+
+def ftp_chunks(path,bufsize):
+    fp = open(path,'rb')
+    while True :
+          chunk = fp.read(bufsize)
+          if not chunk : break
+          yield chunk
+    fp.close()
+
+def benchmark(path,size):
+
+    for sumalgo in [ None, test_md5_buffer() ] :
+        benchmark_loops(path,size,sumalgo)
+
+def benchmark_loops(path,size,sumalgo):
+
+    proto         = sr_proto(test_parent())
+    proto.sumalgo = sumalgo
+    mbytes        = size / 1024.0 / 1024.0
+    checksum      = 'md5'
+    if sumalgo == None : checksum = 'none'
+
+    for transport in [ 'file', 'sftp-like (simulated)' ] :
+        rates = []
+        for loop in [ 'alarm', 'readinto' ] :
+            if transport == 'file' : src = open(path,'rb')
+            else                   : src = test_sftp_file(path)
+            dst   = open(path + '.copy','wb')
+            if sumalgo : sumalgo.set_path(path)
+            start = time.time()
+            if loop == 'alarm' : read_write_alarm(proto,src,dst)
+            else               : proto.read_write(src,dst)
+            rates.append( mbytes / (time.time() - start) )
+            src.close()
+            dst.close()
+        print("sr_proto %-21s sum %-4s read_write  %6.1f MB/s before, %6.1f MB/s now" % (transport,checksum,rates[0],rates[1]))
+
+    # ftp : same callback, one alarm per chunk before, watchdog now
+
+    rates = []
+    for loop in [ 'alarm', 'watchdog' ] :
+        dst   = open(path + '.copy','wb')
+        if sumalgo : sumalgo.set_path(path)
+        start = time.time()
+        if loop == 'alarm' :
+           for chunk in ftp_chunks(path,proto.bufsize) :
+               dst.write(chunk)
+               alarm_cancel()
+               if sumalgo : sumalgo.update(chunk)
+               alarm_set(proto.iotime)
+           alarm_cancel()
+        else :
+           proto.write_chunk_init(dst)
+           for chunk in ftp_chunks(path,proto.bufsize) : proto.write_chunk(chunk)
+           proto.write_chunk_end()
+        rates.append( mbytes / (time.time() - start) )
+        dst.close()
+    print("sr_proto %-21s sum %-4s write_chunk %6.1f MB/s before, %6.1f MB/s now" % ('ftp',checksum,rates[0],rates[1]))
+
+    os.unlink(path + '.copy')
+
 # ===================================
 # self_test
 # ===================================
@@ -124,9 +268,102 @@ def self_test():
     if status == 4 : print("test 14: alarm_cancel 2 NOT OK")
 
 
+    # ===================================
+    # TESTING sr_proto read_write
+    # ===================================
+
+    print("testing sr_util sr_proto read_write ")
+
+    tmpdirname = tempfile.TemporaryDirectory().name
+    try    : os.mkdir(tmpdirname)
+    except : pass
+    src_file   = tmpdirname + os.sep + 'read_write_src'
+    dst_file   = tmpdirname + os.sep + 'read_write_dst'
+
+    size = 16 * 1024 * 1024
+    if len(sys.argv) > 1 : size = int(sys.argv[1]) * 1024 * 1024
+
+    data = os.urandom(1000000)
+    fp   = open(src_file,'wb')
+    for i in range(size // len(data)) : fp.write(data)
+    fp.write(data[:size % len(data)])
+    fp.close()
+
+    proto = sr_proto(test_parent())
+    proto.set_sumalgo(test_md5())
+
+    fp   = open(src_file,'rb')
+    md5  = hashlib.md5(fp.read()).hexdigest()
+    fp.close()
+
+    rw_length = proto.read_writelocal(src_file, open(src_file,'rb'), dst_file)
+    if rw_length != size or proto.checksum != md5 or not filecmp.cmp(src_file,dst_file,shallow=False) :
+       print("test 15: read_write whole file : Failed")
+       failed = True
+
+    # exact length from an offset, from a source without readinto
+
+    src = test_stream(src_file)
+    src.seek(1000)
+    rw_length = proto.read_writelocal(src_file, src, dst_file, 0, 300000)
+    src.close()
+    fp   = open(dst_file,'rb')
+    part = fp.read()
+    fp.close()
+    if rw_length != 300000 or part != data[1000:301000] :
+       print("test 16: read_write part without readinto : Failed")
+       failed = True
+
+    dst       = open(dst_file,'wb')
+    rw_length = proto.readlocal_write(src_file, 70000, 100000, dst)
+    dst.close()
+    fp   = open(dst_file,'rb')
+    part = fp.read()
+    fp.close()
+    if rw_length != 100000 or part != data[70000:170000] or proto.checksum != hashlib.md5(part).hexdigest() :
+       print("test 17: readlocal_write part : Failed")
+       failed = True
+
+    # checksums not known to accept a memoryview (plugins) get bytes
+
+    for sumalgo, types in [ (test_md5(), set([bytes])), (test_md5_buffer(), set([memoryview])) ] :
+        proto.set_sumalgo(sumalgo)
+        rw_length = proto.read_writelocal(src_file, open(src_file,'rb'), dst_file)
+        if sumalgo.types != types or proto.checksum != md5 :
+           print("test 20: read_write checksum given %s, expected %s : Failed" % (sumalgo.types,types))
+           failed = True
+
+    # io timeout : a transfer longer than iotime, but never idle for iotime, is fine
+
+    proto.set_iotime(1)
+    try:
+            src       = test_slow_file(src_file,0.3)
+            rw_length = proto.read_writelocal(src_file, src, dst_file, 0, 8*65536)
+            src.close()
+    except: rw_length = 0
+
+    if rw_length != 8*65536 :
+       print("test 18: read_write slow transfer timed out : Failed")
+       failed = True
+
+    try:
+            status    = 4
+            src       = test_slow_file(src_file,2.5)
+            rw_length = proto.read_writelocal(src_file, src, dst_file, 0, 65536)
+    except TimeoutException : status = 0
+    src.close()
+
+    if status == 4 :
+       print("test 19: read_write stalled transfer not timed out : Failed")
+       failed = True
+
+    benchmark(src_file,size)
+
+    os.unlink(src_file)
+    os.unlink(dst_file)
+
 ###### missing coverage ######
 # class raw_message
-# class sr_proto()
 # class sr_transport()
 
 